@@ -0,0 +1,117 @@
+"""best match statement trigger
+
+Revision ID: a91d3c5e7f20
+Revises: e4b8a2c6d913
+Create Date: 2026-10-20 09:14:52.603218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a91d3c5e7f20'
+down_revision = 'e4b8a2c6d913'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+
+
+def upgrade():
+    # refresh best_match once per statement instead of once per row, so that bulk writes do not take
+    # an advisory lock and do a delete and an insert for every row they touch
+    op.execute("DROP TRIGGER IF EXISTS docmatch_best_match ON docmatch")
+    op.execute("DROP FUNCTION IF EXISTS docmatch_best_match_trigger()")
+    op.execute("DROP FUNCTION IF EXISTS refresh_best_match(VARCHAR)")
+
+    # the pub_bibcodes are hashed into at most 1024 advisory locks, taken in ascending order
+    op.execute("""
+        CREATE OR REPLACE FUNCTION refresh_best_matches(the_pub_bibcodes VARCHAR[]) RETURNS VOID AS $$
+        DECLARE
+            bucket INTEGER;
+        BEGIN
+            FOR bucket IN SELECT DISTINCT hashtext(pub_bibcode) & 1023 FROM unnest(the_pub_bibcodes) AS pub_bibcode ORDER BY 1 LOOP
+                PERFORM pg_advisory_xact_lock(hashtext('best_match'), bucket);
+            END LOOP;
+            DELETE FROM best_match WHERE pub_bibcode = ANY(the_pub_bibcodes);
+            INSERT INTO best_match (pub_bibcode, eprint_bibcode, confidence, date)
+                SELECT d.pub_bibcode, d.eprint_bibcode, d.confidence, d.date FROM docmatch d
+                JOIN (SELECT pub_bibcode, max(confidence) AS confidence FROM docmatch
+                      WHERE pub_bibcode = ANY(the_pub_bibcodes) GROUP BY pub_bibcode) h
+                ON d.pub_bibcode = h.pub_bibcode AND d.confidence = h.confidence;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION docmatch_best_match_trigger() RETURNS TRIGGER AS $$
+        DECLARE
+            pub_bibcodes VARCHAR[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                pub_bibcodes := ARRAY(SELECT DISTINCT pub_bibcode FROM new_rows);
+            ELSIF TG_OP = 'UPDATE' THEN
+                pub_bibcodes := ARRAY(SELECT pub_bibcode FROM old_rows UNION SELECT pub_bibcode FROM new_rows);
+            ELSE
+                pub_bibcodes := ARRAY(SELECT DISTINCT pub_bibcode FROM old_rows);
+            END IF;
+            IF cardinality(pub_bibcodes) > 0 THEN
+                PERFORM refresh_best_matches(pub_bibcodes);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    # a trigger can have transition tables for one event only, hence one trigger per event
+    op.execute("""
+        CREATE TRIGGER docmatch_best_match_insert AFTER INSERT ON docmatch
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE docmatch_best_match_trigger()
+    """)
+    op.execute("""
+        CREATE TRIGGER docmatch_best_match_update AFTER UPDATE ON docmatch
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE docmatch_best_match_trigger()
+    """)
+    op.execute("""
+        CREATE TRIGGER docmatch_best_match_delete AFTER DELETE ON docmatch
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE docmatch_best_match_trigger()
+    """)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS docmatch_best_match_insert ON docmatch")
+    op.execute("DROP TRIGGER IF EXISTS docmatch_best_match_update ON docmatch")
+    op.execute("DROP TRIGGER IF EXISTS docmatch_best_match_delete ON docmatch")
+    op.execute("DROP FUNCTION IF EXISTS docmatch_best_match_trigger()")
+    op.execute("DROP FUNCTION IF EXISTS refresh_best_matches(VARCHAR[])")
+
+    # back to the row level trigger
+    op.execute("""
+        CREATE OR REPLACE FUNCTION refresh_best_match(the_pub_bibcode VARCHAR) RETURNS VOID AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext(the_pub_bibcode));
+            DELETE FROM best_match WHERE pub_bibcode = the_pub_bibcode;
+            INSERT INTO best_match (pub_bibcode, eprint_bibcode, confidence, date)
+                SELECT pub_bibcode, eprint_bibcode, confidence, date FROM docmatch
+                WHERE pub_bibcode = the_pub_bibcode
+                  AND confidence = (SELECT max(confidence) FROM docmatch WHERE pub_bibcode = the_pub_bibcode);
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE OR REPLACE FUNCTION docmatch_best_match_trigger() RETURNS TRIGGER AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM refresh_best_match(OLD.pub_bibcode);
+            END IF;
+            IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND NEW.pub_bibcode <> OLD.pub_bibcode) THEN
+                PERFORM refresh_best_match(NEW.pub_bibcode);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+    """)
+    op.execute("""
+        CREATE TRIGGER docmatch_best_match AFTER INSERT OR UPDATE OR DELETE ON docmatch
+            FOR EACH ROW EXECUTE PROCEDURE docmatch_best_match_trigger()
+    """)
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+    asgi
+    ~~~~
+
+    entrypoint asgi script for the asyncio matching engine, to run next to the wsgi application,
+    e.g. uvicorn asgi:application --port 5001
+"""
+
+from oraclesrv.async_matching import AsyncDocMatchingApp
+
+application = AsyncDocMatchingApp()
@@ -1,11 +1,58 @@
 
+from contextlib import contextmanager
+
 from werkzeug.serving import run_simple
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import scoped_session, sessionmaker
 
 from flask_discoverer import Discoverer
 
 from adsmutils import ADSFlask
 
 from oraclesrv.views import bp
+from oraclesrv.write_behind import WriteBehind
+from oraclesrv.db_metrics import PoolMetrics
+from oraclesrv.solr_cache import SolrCache
+from oraclesrv.solr_client import SolrClient
+from oraclesrv.jobs import mark_stale_cleanup_jobs
+
+def create_read_session_scope(app):
+    """
+    session scope for the read only queries on the read replica, if the replica cannot be
+    reached falls back to the primary
+
+    :param app:
+    :return:
+    """
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    options.setdefault('pool_pre_ping', True)
+    engine = create_engine(app.config['SQLALCHEMY_READ_REPLICA_URI'], **options)
+    read_session = scoped_session(sessionmaker(bind=engine))
+
+    @contextmanager
+    def read_session_scope():
+        session = read_session()
+        try:
+            # check out a connection now, so that an unreachable replica is detected before querying
+            session.connection()
+        except OperationalError as e:
+            app.logger.warning('read replica is not available, reading from primary: %s' % str(e))
+            session.close()
+            read_session.remove()
+            session = None
+        if session is None:
+            with app.session_scope() as primary_session:
+                yield primary_session
+            return
+        try:
+            yield session
+        finally:
+            session.close()
+            read_session.remove()
+
+    read_session_scope.engine = engine
+    return read_session_scope
 
 def create_app(**config):
     """
@@ -23,6 +70,35 @@ def create_app(**config):
     Discoverer(app)
 
     app.register_blueprint(bp)
+
+    # route the read only queries to the read replica, if there is one
+    app.read_session_scope = None
+    if app.config.get('SQLALCHEMY_READ_REPLICA_URI', None):
+        app.read_session_scope = create_read_session_scope(app)
+
+    # keep track of the connection pools
+    app.pool_metrics = {}
+    if getattr(app, 'db', None) is not None:
+        with app.app_context():
+            app.pool_metrics['primary'] = PoolMetrics(app.db.engine)
+        # the cleanup jobs of a worker that went away are left running otherwise
+        mark_stale_cleanup_jobs(app)
+    if app.read_session_scope:
+        app.pool_metrics['read_replica'] = PoolMetrics(app.read_session_scope.engine)
+
+    # all the queries to solr go through this client
+    app.solr_client = SolrClient(app)
+
+    # cache the results of solr queries
+    app.solr_cache = None
+    if app.config.get('ORACLE_SERVICE_SOLR_CACHE_ENABLED', False):
+        app.solr_cache = SolrCache(app)
+
+    # save the matches from docmatch_add in the background
+    app.write_behind = None
+    if app.config.get('ORACLE_SERVICE_WRITE_BEHIND_ENABLED', False):
+        app.write_behind = WriteBehind(app)
+        app.write_behind.start()
     return app
 
 if __name__ == '__main__':
@@ -0,0 +1,681 @@
+import hmac
+import json
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import requests
+from flask import current_app
+
+from oraclesrv.app import create_app
+from oraclesrv.doc_matching import DocMatching, get_requests_params, speculative_metrics, candidate_pruning_metrics
+from oraclesrv.keras_model import PredictionBatcher
+from oraclesrv.score import confidence_model
+from oraclesrv.utils import get_solr_docs, get_solr_params_match, get_solr_params_match_doi, \
+    get_solr_params_match_pubnote, get_solr_params_match_doctype_case
+
+
+def make_http_error(status_code, reason):
+    """
+    the error get_solr_data raises when solr does not return success, so that it is handled the same way
+
+    :param status_code:
+    :param reason:
+    :return:
+    """
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.reason = reason
+    return requests.exceptions.HTTPError('%d: %s' % (status_code, reason), response=response)
+
+
+class AsyncSolrClient(object):
+    """
+    sends the queries to solr without blocking the event loop, over a pool of up to
+    ORACLE_SERVICE_ASYNC_SOLRQUERY_POOL_SIZE keep-alive connections, the retries, circuit breaker,
+    and metrics are shared with the solr client of the app
+    """
+
+    def __init__(self, app):
+        """
+
+        :param app:
+        """
+        self.solr_client = app.solr_client
+        self.pool_size = app.config['ORACLE_SERVICE_ASYNC_SOLRQUERY_POOL_SIZE']
+        self.timeout = aiohttp.ClientTimeout(sock_connect=app.config['ORACLE_SERVICE_SOLRQUERY_CONNECT_TIMEOUT'],
+                                             sock_read=app.config['ORACLE_SERVICE_SOLRQUERY_READ_TIMEOUT'])
+        self.session = None
+        # queries in flight, keyed on their params, for the identical queries to wait on
+        self.in_flight = {}
+
+    def get_session(self):
+        """
+        session is created on first use, so that it belongs to the running event loop
+
+        :return:
+        """
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size), timeout=self.timeout)
+        return self.session
+
+    async def close(self):
+        """
+
+        :return:
+        """
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    def get_headers(self, request_headers):
+        """
+
+        :param request_headers: headers of the original request
+        :return:
+        """
+        return {
+            # Propagate key information from the original request
+            u'X-Original-Uri': request_headers.get(u'x-original-uri', u'-'),
+            u'X-Original-Forwarded-For': request_headers.get(u'x-original-forwarded-for', u'-'),
+            u'X-Forwarded-For': request_headers.get(u'x-forwarded-for', u'-'),
+            u'X-Amzn-Trace-Id': request_headers.get(u'x-amzn-trace-id', '-'),
+            u'Authorization': 'Bearer ' + self.solr_client.token,
+        }
+
+    async def fetch(self, params, headers):
+        """
+
+        :param params:
+        :param headers:
+        :return: status code, reason, and decoded json if successful
+        """
+        async with self.get_session().get(self.solr_client.url, params=params, headers=headers) as response:
+            if response.status >= 400:
+                return response.status, response.reason, None
+            return response.status, response.reason, await response.json(content_type=None)
+
+    async def query(self, params, query_type='other', request_headers=None):
+        """
+        if the same query is already in flight, wait for its result instead of sending it again
+
+        :param params:
+        :param query_type:
+        :param request_headers: headers of the original request
+        :return: status code, reason, and decoded json if successful
+        """
+        if not self.solr_client.coalesce:
+            return await self.send(params, query_type, request_headers)
+
+        key = self.solr_client.make_key(params)
+        call = self.in_flight.get(key, None)
+        leader = call is None
+        if leader:
+            # the query is sent in a task of its own, so that if the match that sent it is cancelled,
+            # ie. its client went away, the query goes on for the others waiting on it
+            call = asyncio.ensure_future(self.send(params, query_type, request_headers))
+            self.in_flight[key] = call
+            call.add_done_callback(functools.partial(self.query_done, key))
+        else:
+            self.solr_client.record(query_type, 'num_coalesced')
+
+        try:
+            status_code, reason, from_solr = await asyncio.shield(call)
+        except asyncio.CancelledError:
+            if call.cancelled():
+                # the shared query was cancelled, not this match, so fail it as if solr could not be reached
+                raise requests.exceptions.ConnectionError('solr query was cancelled')
+            raise
+        if leader:
+            return status_code, reason, from_solr
+        # each waiter gets its own copy of the docs, the matching modifies them
+        return status_code, reason, json.loads(json.dumps(from_solr))
+
+    def query_done(self, key, call):
+        """
+        the query is no longer in flight
+
+        :param key:
+        :param call:
+        :return:
+        """
+        if self.in_flight.get(key, None) is call:
+            del self.in_flight[key]
+        # retrieve the exception, so that it is not reported as never retrieved when no one is waiting anymore
+        if not call.cancelled():
+            call.exception()
+
+    async def send(self, params, query_type='other', request_headers=None):
+        """
+
+        :param params:
+        :param query_type:
+        :param request_headers: headers of the original request
+        :return: status code, reason, and decoded json if successful, raises SolrCircuitOpenError if the circuit is open,
+                 or requests ConnectionError if solr could not be reached after the last retry
+        """
+        solr_client = self.solr_client
+        solr_client.check_circuit(query_type)
+
+        headers = self.get_headers(request_headers or {})
+        params = {key: str(value) for key, value in params.items()}
+        start_time = time.time()
+        try:
+            for attempt in range(solr_client.retries + 1):
+                if attempt > 0:
+                    await asyncio.sleep(solr_client.get_retry_delay(attempt, query_type))
+                try:
+                    status_code, reason, from_solr = await self.fetch(params, headers)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if solr_client.should_retry(attempt, query_type, failed=True):
+                        continue
+                    raise requests.exceptions.ConnectionError(str(e) or e.__class__.__name__)
+                if solr_client.should_retry(attempt, query_type, failed=status_code >= 500):
+                    continue
+                return status_code, reason, from_solr
+        finally:
+            solr_client.record(query_type, 'num_queries', (time.time() - start_time) * 1000)
+
+
+def run_in_app_context(app, func, *args):
+    """
+
+    :param app:
+    :param func:
+    :param args:
+    :return:
+    """
+    with app.app_context():
+        return func(*args)
+
+
+class AsyncSpeculativeQuery(object):
+    """
+    same as SpeculativeQuery of doc_matching, with the query sent in a task on the event loop instead of on a thread
+    """
+
+    def __init__(self, func, *args):
+        """
+
+        :param func: coroutine function of the query
+        :param args:
+        """
+        self.start_time = time.time()
+        self.duration = 0
+        self.started = False
+        self.task = asyncio.ensure_future(self.run(func, *args))
+        self.task.add_done_callback(self.done)
+        speculative_metrics.record_sent()
+
+    async def run(self, func, *args):
+        """
+
+        :param func:
+        :param args:
+        :return:
+        """
+        self.started = True
+        start_time = time.time()
+        try:
+            return await func(*args)
+        finally:
+            self.duration = (time.time() - start_time) * 1000
+
+    def done(self, task):
+        """
+        retrieve the exception, so that it is not reported as never retrieved when the result is discarded
+
+        :param task:
+        :return:
+        """
+        if not task.cancelled():
+            task.exception()
+
+    async def result(self):
+        """
+        wait for the result, the time saved is how much of the query overlapped with what was done since it was sent
+
+        :return:
+        """
+        waited_from = time.time()
+        result = await self.task
+        speculative_metrics.record_used(min((waited_from - self.start_time) * 1000, self.duration))
+        return result
+
+    def discard(self):
+        """
+        result is not needed, cancel the query, it was cancelled before it was sent to solr if the task had not started
+
+        :return:
+        """
+        cancelled = not self.started
+        self.task.cancel()
+        speculative_metrics.record_discarded(cancelled)
+
+
+class AsyncDocMatching(DocMatching):
+    """
+    DocMatching that awaits solr instead of blocking on it, scoring, predicting the confidence,
+    and reading from and writing to the db are done on the thread pool of the engine,
+    the decisions of matching are the same flow as DocMatching, see run_flow
+    """
+
+    def __init__(self, engine, payload, save=True, request_headers=None):
+        """
+
+        :param engine:
+        :param payload:
+        :param save:
+        :param request_headers: headers of the original request, lowercased
+        """
+        super(AsyncDocMatching, self).__init__(payload, save=save, predictor=engine.predictor)
+        self.engine = engine
+        self.request_headers = request_headers or {}
+
+    async def run_sync(self, func, *args):
+        """
+        call the blocking func on the thread pool of the engine
+
+        :param func:
+        :param args:
+        :return:
+        """
+        return await self.engine.run_sync(func, *args)
+
+    async def run_flow(self, flow):
+        """
+        same as run_flow of DocMatching, the steps that are coroutine functions are awaited,
+        and the rest are blocking and so are run on the thread pool
+
+        :param flow: generator of the steps, see match_flow of DocMatching
+        :return: what the flow returns
+        """
+        try:
+            step = next(flow)
+            while True:
+                func, args = step[0], step[1:]
+                if asyncio.iscoroutinefunction(func):
+                    result = await func(*args)
+                else:
+                    result = await self.run_sync(func, *args)
+                step = flow.send(result)
+        except StopIteration as e:
+            return e.value
+
+    async def send_query(self, func, *args):
+        """
+        send the query in a task of its own
+
+        :param func: coroutine function of the query
+        :param args:
+        :return: the query sent, to wait for or discard
+        """
+        return AsyncSpeculativeQuery(func, *args)
+
+    async def wait_for(self, query):
+        """
+
+        :param query: query sent in the background
+        :return: its result
+        """
+        return await query.result()
+
+    async def discard_queries(self, *queries):
+        """
+        the tasks are cancelled on the event loop, and not on the thread pool
+
+        :param queries:
+        :return:
+        """
+        super(AsyncDocMatching, self).discard_queries(*queries)
+
+    async def get_solr_data(self, rows, query, fl, query_type='other'):
+        """
+        same as get_solr_data of utils, with the same cache
+
+        :param rows:
+        :param query:
+        :param fl:
+        :param query_type:
+        :return:
+        """
+        # if the same query was sent recently, return the cached result
+        solr_cache = getattr(current_app, 'solr_cache', None)
+        if solr_cache:
+            cache_key = solr_cache.make_key(query, fl, rows)
+            if self.request_headers.get('x-oracle-solr-cache-bypass', 'false').lower() == 'true':
+                solr_cache.record(query_type, 'bypassed')
+            else:
+                cached = await self.run_cache(solr_cache.get, query_type, cache_key)
+                if cached is not None:
+                    return cached[0], cached[1]
+
+        status_code, reason, from_solr = await self.engine.solr_client.query({'fl': fl, 'rows': rows, 'q': query}, query_type, self.request_headers)
+        if status_code >= 400:
+            raise make_http_error(status_code, reason)
+
+        result = get_solr_docs(from_solr, fl)
+
+        if solr_cache and status_code == 200:
+            await self.run_cache(solr_cache.set, cache_key, [result, status_code])
+        return result, status_code
+
+    async def run_cache(self, func, *args):
+        """
+        the in process cache is called directly, but when the cache is also kept on disk,
+        it is called on the thread pool, so that it does not block the event loop
+
+        :param func: get or set of the solr cache
+        :param args:
+        :return:
+        """
+        if current_app.solr_cache.is_blocking:
+            return await self.run_sync(func, *args)
+        return func(*args)
+
+    async def query_solr_data(self, solr_params):
+        """
+        same as query_solr_data of utils
+
+        :param solr_params: rows, query, fl, and query type
+        :return:
+        """
+        rows, query, fl, query_type = solr_params
+        try:
+            result, status_code = await self.get_solr_data(rows, query, fl, query_type)
+        except requests.exceptions.HTTPError as e:
+            current_app.logger.error(e)
+            result = {'error from solr': '%d: %s' % (e.response.status_code, e.response.reason)}
+            status_code = e.response.status_code
+        return result, query, status_code
+
+    async def query_solr_data_match(self, abstract, title):
+        """
+        same as query_solr_data_match of DocMatching
+
+        :param abstract:
+        :param title:
+        :return:
+        """
+        prune = self.prunes_title_candidates()
+        solr_params = get_solr_params_match(abstract, title, self.match_doctype, self.extra_filter, with_abstract=not prune)
+        if not solr_params:
+            return [], '', 200
+        if not prune:
+            return await self.query_solr_data(solr_params)
+
+        results, query, solr_status_code = await self.query_solr_data(solr_params)
+        if solr_status_code != 200 or len(results) == 0:
+            return results, query, solr_status_code
+        return self.prune_candidates(results), query, 200
+
+    async def query_doctype(self, comment):
+        """
+
+        :param comment:
+        :return:
+        """
+        results, query, solr_status_code = await self.query_solr_data(
+            get_solr_params_match_doctype_case(self.author, self.year, '"%s"' % '" OR "'.join(self.match_doctype)))
+        return await self.run_sync(self.match_doctype_results, results, query, comment)
+
+    async def query_doi(self, comment):
+        """
+
+        :param comment:
+        :return:
+        """
+        doi_filter = '"%s"' % '" OR "'.join(self.doi)
+        current_app.logger.debug('with parameter: doi=({doi})'.format(doi=doi_filter))
+        solr_params = get_solr_params_match_doi(doi_filter, self.match_doctype)
+        found = await self.run_sync(self.lookup_doi_index, 'doi', solr_params[1])
+        if found:
+            results, query, solr_status_code = found
+        else:
+            results, query, solr_status_code = await self.query_solr_data(solr_params)
+            await self.run_sync(self.add_doi_index, results, solr_status_code)
+        return await self.run_sync(self.match_doi_results, results, query, comment)
+
+    async def query_pubnote(self, comment):
+        """
+
+        :param comment:
+        :return:
+        """
+        doi_filter = '"%s"' % '" OR "'.join(self.doi)
+        current_app.logger.debug('with parameter: pubnote=({doi})'.format(doi=doi_filter))
+        solr_params = get_solr_params_match_pubnote(doi_filter, self.match_doctype)
+        found = await self.run_sync(self.lookup_doi_index, 'pubnote', solr_params[1])
+        if found:
+            results, query, solr_status_code = found
+        else:
+            results, query, solr_status_code = await self.query_solr_data(solr_params)
+            await self.run_sync(self.add_doi_index, results, solr_status_code)
+        return await self.run_sync(self.match_doi_results, results, query, comment, ' in pubnote')
+
+    async def query_abstract_or_title(self, comment, abstract_query=None, title_query=None):
+        """
+        same as query_abstract_or_title of DocMatching
+
+        :param comment:
+        :param abstract_query: query on abstract, if it has already been sent in the background
+        :param title_query: query on title, if it has already been sent in the background
+        :return:
+        """
+        return await self.run_flow(self.abstract_or_title_flow(comment, abstract_query, title_query))
+
+    async def process(self):
+        """
+        same as process of DocMatching
+
+        :return:
+        """
+        return await self.run_flow(self.match_flow())
+
+
+class AsyncMatchingEngine(object):
+    """
+    state shared by all the matches of the process: the app, the solr client, the thread pool for the blocking work,
+    and the predictor batching the confidence predictions of the concurrent matches
+    """
+
+    def __init__(self, app):
+        """
+
+        :param app:
+        """
+        self.app = app
+        self.solr_client = AsyncSolrClient(app)
+        self.executor = ThreadPoolExecutor(max_workers=app.config['ORACLE_SERVICE_ASYNC_WORKERS'], thread_name_prefix='async_matching')
+        # the predictions are made on the threads of the pool, so a batch has at most as many as there are threads
+        self.predictor = PredictionBatcher(confidence_model,
+                                           max_batch_size=min(app.config['ORACLE_SERVICE_DOCMATCH_BATCH_PREDICT_SIZE'],
+                                                              app.config['ORACLE_SERVICE_ASYNC_WORKERS']),
+                                           max_wait=app.config['ORACLE_SERVICE_DOCMATCH_BATCH_PREDICT_WAIT_MS'] / 1000.0)
+        self.semaphore = None
+        self.num_in_flight = 0
+        self.max_in_flight = 0
+
+    async def match(self, payload, save=True, request_headers=None):
+        """
+        at most ORACLE_SERVICE_ASYNC_MAX_IN_FLIGHT matches are processed at a time, the rest wait their turn
+
+        :param payload:
+        :param save:
+        :param request_headers: headers of the original request, lowercased
+        :return:
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.app.config['ORACLE_SERVICE_ASYNC_MAX_IN_FLIGHT'])
+        async with self.semaphore:
+            self.num_in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.num_in_flight)
+            try:
+                with self.app.app_context():
+                    if get_requests_params(payload, 'doctype'):
+                        doc_matching = AsyncDocMatching(self, payload, save=save, request_headers=request_headers)
+                    else:
+                        # doctype is then decided from the bibcode, looking up the eprint bibstems in db
+                        doc_matching = await self.run_sync(AsyncDocMatching, self, payload, save, request_headers)
+                    return await doc_matching.process()
+            finally:
+                self.num_in_flight -= 1
+
+    async def run_sync(self, func, *args):
+        """
+        call the blocking func on the thread pool, in the app context
+
+        :param func:
+        :param args:
+        :return:
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(run_in_app_context, self.app, func, *args))
+
+    async def close(self):
+        """
+
+        :return:
+        """
+        await self.solr_client.close()
+        self.executor.shutdown(wait=False)
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        metrics = {'num_in_flight': self.num_in_flight, 'max_in_flight': self.max_in_flight,
+                   'solr': self.solr_client.solr_client.get_metrics()}
+        if self.app.config.get('ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED', False):
+            metrics['title_candidate_pruning'] = candidate_pruning_metrics.get_metrics()
+        return metrics
+
+
+class AsyncDocMatchingApp(object):
+    """
+    ASGI application serving docmatch and docmatch_add, to run next to the WSGI application,
+    docmatch_add is served only with ORACLE_SERVICE_ASYNC_DOCMATCH_ADD_TOKEN set, and requires it
+    """
+
+    routes = {
+        '/docmatch': False,
+        '/docmatch_add': True,
+    }
+
+    def __init__(self, app=None):
+        """
+
+        :param app: flask app to take the config, db, and solr cache from, created if not given
+        """
+        self.app = app or create_app()
+        self.engine = AsyncMatchingEngine(self.app)
+
+    async def __call__(self, scope, receive, send):
+        """
+
+        :param scope:
+        :param receive:
+        :param send:
+        :return:
+        """
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        path = scope['path']
+        root_path = scope.get('root_path', '')
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        path = path.rstrip('/')
+
+        if path == '/metrics' and scope['method'] == 'GET':
+            await self.send_response(send, self.engine.get_metrics(), 200)
+            return
+        if path not in self.routes or (self.routes[path] and not self.app.config.get('ORACLE_SERVICE_ASYNC_DOCMATCH_ADD_TOKEN', None)):
+            await self.send_response(send, {'error': 'not found'}, 404)
+            return
+        if scope['method'] != 'POST':
+            await self.send_response(send, {'error': 'method not allowed'}, 405)
+            return
+
+        try:
+            payload = json.loads(await self.read_body(receive))
+        except ValueError:
+            payload = None
+        if not payload:
+            await self.send_response(send, {'error': 'no information received'}, 400)
+            return
+
+        request_headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope.get('headers', [])}
+        if self.routes[path] and not self.is_authorized(request_headers):
+            await self.send_response(send, {'error': 'not authorized to add matches'}, 401)
+            return
+
+        start_time = time.time()
+        try:
+            results, status_code = await self.engine.match(payload, save=self.routes[path], request_headers=request_headers)
+        except Exception as e:
+            self.app.logger.error('unable to match the document: %s' % str(e))
+            results, status_code = {'error': 'unable to match the document: %s' % str(e)}, 500
+        self.app.logger.debug("Matched doc in {duration} ms".format(duration=(time.time() - start_time) * 1000))
+        await self.send_response(send, results, status_code)
+
+    def is_authorized(self, request_headers):
+        """
+        docmatch_add writes to the db, and unlike the WSGI application this is not behind the api gateway
+        checking the ads:oracle-service scope, so it requires ORACLE_SERVICE_ASYNC_DOCMATCH_ADD_TOKEN
+
+        :param request_headers: headers of the request, lowercased
+        :return:
+        """
+        token = self.app.config.get('ORACLE_SERVICE_ASYNC_DOCMATCH_ADD_TOKEN', None)
+        if not token:
+            return False
+        return hmac.compare_digest(request_headers.get('authorization', '').encode('utf-8'), ('Bearer ' + token).encode('utf-8'))
+
+    async def lifespan(self, receive, send):
+        """
+
+        :param receive:
+        :param send:
+        :return:
+        """
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def read_body(self, receive):
+        """
+
+        :param receive:
+        :return:
+        """
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body', False):
+                return body
+
+    async def send_response(self, send, results, status_code):
+        """
+
+        :param send:
+        :param results:
+        :param status_code:
+        :return:
+        """
+        body = json.dumps(results).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status_code,
+                    'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode('latin-1'))]})
+        await send({'type': 'http.response.body', 'body': body})
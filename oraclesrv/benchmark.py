@@ -0,0 +1,201 @@
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from oraclesrv import fake_solr
+
+
+WORDS = ['galaxy', 'cluster', 'dark', 'matter', 'halo', 'stellar', 'mass', 'function', 'redshift', 'survey', 'spectra',
+         'emission', 'line', 'quasar', 'black', 'hole', 'accretion', 'disk', 'magnetic', 'field', 'solar', 'wind',
+         'planet', 'orbit', 'transit', 'exoplanet', 'atmosphere', 'cosmic', 'ray', 'neutrino', 'gravitational', 'wave',
+         'merger', 'binary', 'pulsar', 'timing', 'radio', 'telescope', 'observation', 'simulation', 'model', 'data']
+
+
+def make_payloads(num_payloads, doi_ratio=0.5, seed=0):
+    """
+    synthetic eprints to match
+
+    :param num_payloads:
+    :param doi_ratio: fraction of the eprints that have a doi
+    :param seed:
+    :return:
+    """
+    rnd = random.Random(seed)
+    payloads = []
+    for i in range(num_payloads):
+        payload = {
+            'abstract': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(80, 200))) + '.',
+            'title': ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 15))).capitalize(),
+            'author': 'Fake, A.; Standin, B.',
+            'year': str(rnd.randint(2015, 2023)),
+            'doctype': 'eprint',
+            'bibcode': '%sarXiv%09dF' % (2021, i),
+        }
+        if rnd.random() < doi_ratio:
+            payload['doi'] = ['10.1000/fake.%d' % i]
+        payloads.append(payload)
+    return payloads
+
+
+def load_payloads(filename):
+    """
+
+    :param filename: json lines file, each line a payload of docmatch
+    :return:
+    """
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def get_percentile(sorted_values, percentile):
+    """
+    nearest rank percentile
+
+    :param sorted_values:
+    :param percentile:
+    :return:
+    """
+    if not sorted_values:
+        return 0
+    rank = max(1, int(round(percentile / 100.0 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def run_benchmark(url, payloads, concurrency, num_requests, headers=None, timeout=60):
+    """
+    send num_requests requests, concurrency of them at a time, each with the next payload
+
+    :param url:
+    :param payloads: payloads are reused from the start when there are fewer than num_requests
+    :param concurrency:
+    :param num_requests:
+    :param headers:
+    :param timeout:
+    :return: requests per second, and latency percentiles in milliseconds
+    """
+    local = threading.local()
+
+    def send(i):
+        """
+
+        :param i:
+        :return: latency in milliseconds and status code, or None if the request failed
+        """
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start_time = time.time()
+        try:
+            response = session.post(url, json=payloads[i % len(payloads)], headers=headers, timeout=timeout)
+            # read all of it, the batch endpoints stream the response
+            response.content
+            status_code = response.status_code
+        except requests.exceptions.RequestException:
+            status_code = None
+        return (time.time() - start_time) * 1000, status_code
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(send, range(num_requests)))
+    duration = time.time() - start_time
+
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'concurrency': concurrency,
+        'num_requests': num_requests,
+        'num_errors': sum(1 for _, status_code in results if status_code != 200),
+        'requests_per_second': num_requests / duration if duration else 0,
+        'p50_ms': get_percentile(latencies, 50),
+        'p95_ms': get_percentile(latencies, 95),
+        'p99_ms': get_percentile(latencies, 99),
+        'max_ms': latencies[-1] if latencies else 0,
+    }
+
+
+def start_local_service(solr_url, port=0, prune_title_candidates=False):
+    """
+    serve the app in the background, with its queries sent to the fake solr
+
+    :param solr_url:
+    :param port:
+    :param prune_title_candidates: if True the candidates of the query on title are returned without their abstracts,
+                                   and pruned, when there is no abstract to compare them with
+    :return: server, and url of the service
+    """
+    from werkzeug.serving import make_server
+    from oraclesrv import app as application
+
+    app = application.create_app(ORACLE_SERVICE_SOLRQUERY_URL=solr_url, ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED=prune_title_candidates)
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='oracle_service', daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+def format_results(endpoint, results):
+    """
+
+    :param endpoint:
+    :param results:
+    :return:
+    """
+    lines = ['%-20s %11s %9s %7s %10s %9s %9s %9s' % ('endpoint', 'concurrency', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')]
+    for result in results:
+        lines.append('%-20s %11d %9d %7d %10.1f %9.1f %9.1f %9.1f' % (endpoint, result['concurrency'], result['num_requests'], result['num_errors'],
+                                                                   result['requests_per_second'], result['p50_ms'], result['p95_ms'], result['p99_ms']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Throughput and latency of the docmatch endpoints')
+    parser.add_argument('--url', dest='url', default=None,
+                        help='url of the service, if not given the service is started locally with a fake solr')
+    parser.add_argument('--endpoint', dest='endpoint', default='docmatch',
+                        help='docmatch, docmatch_add, docmatch_batch, or docmatch_add_batch')
+    parser.add_argument('--concurrency', dest='concurrency', default='1,8,32',
+                        help='comma separated list of the number of requests sent at a time')
+    parser.add_argument('--requests', dest='num_requests', type=int, default=200, help='number of requests sent for each concurrency')
+    parser.add_argument('--payloads', dest='payloads', default=None, help='json lines file of the payloads, synthetic eprints if not given')
+    parser.add_argument('--doi-ratio', dest='doi_ratio', type=float, default=0.5, help='fraction of the synthetic eprints that have a doi')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=10, help='number of payloads sent to the batch endpoints at a time')
+    parser.add_argument('--token', dest='token', default=None, help='api token to send the requests with')
+    parser.add_argument('--prune-title-candidates', dest='prune_title_candidates', action='store_true', default=False,
+                        help='prune the candidates of the query on title, when the service is started locally')
+    parser.add_argument('--json', dest='as_json', action='store_true', default=False, help='print the results as json')
+    fake_solr.add_arguments(parser)
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.payloads) if args.payloads else make_payloads(max(args.num_requests, 1), args.doi_ratio)
+    if args.endpoint.endswith('_batch'):
+        payloads = [payloads[i:i + args.batch_size] for i in range(0, len(payloads), args.batch_size)]
+
+    solr, server, url = None, None, args.url
+    if not url:
+        solr = fake_solr.create_fake_solr(args).start()
+        server, url = start_local_service(solr.url, prune_title_candidates=args.prune_title_candidates)
+
+    headers = {'Authorization': 'Bearer ' + args.token} if args.token else None
+    results = []
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            results.append(run_benchmark('%s/%s' % (url.rstrip('/'), args.endpoint), payloads, concurrency, args.num_requests, headers))
+    finally:
+        if server:
+            server.shutdown()
+        if solr:
+            solr.stop()
+
+    if args.as_json:
+        print(json.dumps({'endpoint': args.endpoint, 'results': results, 'solr_queries': solr.get_metrics() if solr else None,
+                          'solr_bytes': solr.get_bytes() if solr else None}))
+    else:
+        print(format_results(args.endpoint, results))
+        if solr:
+            print('solr queries: %s' % json.dumps(solr.get_metrics()))
+            print('solr bytes: %s' % json.dumps(solr.get_bytes()))
+    sys.exit(0)
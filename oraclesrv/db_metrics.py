@@ -0,0 +1,184 @@
+import time
+import inspect
+import threading
+import functools
+
+from sqlalchemy import event
+
+
+# upper bounds of the histogram buckets in milliseconds
+HISTOGRAM_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+class Histogram(object):
+    """
+    counts of the observed durations in buckets of HISTOGRAM_BUCKETS_MS, with their count, sum, and max
+    """
+
+    def __init__(self, buckets=HISTOGRAM_BUCKETS_MS):
+        """
+
+        :param buckets:
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self.lock = threading.Lock()
+
+    def observe(self, duration):
+        """
+
+        :param duration: in milliseconds
+        :return:
+        """
+        index = len(self.buckets)
+        for i, bucket in enumerate(self.buckets):
+            if duration <= bucket:
+                index = i
+                break
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += duration
+            self.max = max(self.max, duration)
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            buckets = {str(bucket): count for bucket, count in zip(self.buckets, self.counts)}
+            buckets['+inf'] = self.counts[-1]
+            return {
+                'count': self.count,
+                'sum_ms': self.sum,
+                'max_ms': self.max,
+                'avg_ms': self.sum / self.count if self.count else 0,
+                'buckets_ms': buckets,
+            }
+
+
+class PoolMetrics(object):
+    """
+    state of the connection pool of an engine, and the histogram of the time waited to check out a connection
+    """
+
+    def __init__(self, engine):
+        """
+
+        :param engine:
+        """
+        self.engine = engine
+        self.checkout_wait = Histogram()
+        self.num_checkout_errors = 0
+        self.lock = threading.Lock()
+        self.instrument(engine.pool)
+        # the pool is replaced when the engine is disposed
+        event.listen(engine, 'engine_disposed', lambda engine: self.instrument(engine.pool))
+
+    def instrument(self, pool):
+        """
+        time the checkouts of the pool
+
+        :param pool:
+        :return:
+        """
+        do_get = pool._do_get
+
+        def timed_do_get():
+            start_time = time.time()
+            try:
+                return do_get()
+            except Exception:
+                with self.lock:
+                    self.num_checkout_errors += 1
+                raise
+            finally:
+                self.checkout_wait.observe((time.time() - start_time) * 1000)
+
+        pool._do_get = timed_do_get
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        pool = self.engine.pool
+        metrics = {
+            'pool_class': pool.__class__.__name__,
+            'checkout_wait': self.checkout_wait.get_metrics(),
+            'num_checkout_errors': self.num_checkout_errors,
+        }
+        # only QueuePool keeps track of its size and overflow
+        for name in ['size', 'checkedin', 'checkedout', 'overflow']:
+            if hasattr(pool, name):
+                metrics[name] = getattr(pool, name)()
+        if hasattr(pool, '_max_overflow'):
+            metrics['max_overflow'] = pool._max_overflow
+        return metrics
+
+
+class QueryMetrics(object):
+    """
+    histogram of the duration of each db helper function
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, duration):
+        """
+
+        :param name:
+        :param duration: in milliseconds
+        :return:
+        """
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+        histogram.observe(duration)
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {name: histogram.get_metrics() for name, histogram in sorted(histograms.items())}
+
+
+query_metrics = QueryMetrics()
+
+def timed_query(func):
+    """
+    decorator recording the duration of a db helper function in query_metrics,
+    for the generators the duration is from the first to the last record
+
+    :param func:
+    :return:
+    """
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            start_time = time.time()
+            try:
+                for item in func(*args, **kwargs):
+                    yield item
+            finally:
+                query_metrics.observe(func.__name__, (time.time() - start_time) * 1000)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start_time = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            query_metrics.observe(func.__name__, (time.time() - start_time) * 1000)
+    return wrapper
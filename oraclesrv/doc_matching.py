@@ -1,8 +1,14 @@
+import time
+import threading
+
 from flask import current_app
 
 from oraclesrv.utils import get_solr_data_match, get_solr_data_match_doi, get_solr_data_match_doctype_case, \
-    get_solr_data_match_pubnote, add_a_record, is_eprint_bibcode
-from oraclesrv.score import clean_metadata, get_matches, encode_author, format_author, get_doi_match, get_db_match
+    get_solr_data_match_pubnote, add_a_record, is_eprint_bibcode, submit_solr_query, lookup_doi_index, \
+    get_solr_params_match_doi, get_solr_params_match_pubnote, get_solr_params_match, \
+    query_solr_data, add_doi_index
+from oraclesrv.score import clean_metadata, get_matches, encode_author, format_author, get_doi_match, get_db_match, \
+    prune_candidates
 
 def get_requests_params(payload, param, default_value=None, default_type=str):
     """
@@ -22,13 +28,197 @@ def get_requests_params(payload, param, default_value=None, default_type=str):
     return default_value
 
 
+class SpeculativeMetrics(object):
+    """
+    counts of the solr queries sent before knowing if their results are needed, the time saved when they were,
+    and the extra queries sent to solr when they were not
+    """
+
+    def __init__(self):
+        """
+
+        """
+        self.lock = threading.Lock()
+        self.metrics = {
+            'num_sent': 0,
+            'num_used': 0,
+            'num_discarded': 0,
+            'num_cancelled': 0,
+            'total_saved_ms': 0,
+        }
+
+    def record_sent(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.metrics['num_sent'] += 1
+
+    def record_used(self, saved_ms):
+        """
+
+        :param saved_ms:
+        :return:
+        """
+        with self.lock:
+            self.metrics['num_used'] += 1
+            self.metrics['total_saved_ms'] += saved_ms
+
+    def record_discarded(self, cancelled):
+        """
+
+        :param cancelled: True if the query was cancelled before it was sent to solr
+        :return:
+        """
+        with self.lock:
+            self.metrics['num_discarded'] += 1
+            if cancelled:
+                self.metrics['num_cancelled'] += 1
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics['extra_solr_queries'] = metrics['num_discarded'] - metrics['num_cancelled']
+        metrics['avg_saved_ms'] = metrics['total_saved_ms'] / metrics['num_used'] if metrics['num_used'] else 0
+        return metrics
+
+speculative_metrics = SpeculativeMetrics()
+
+
+class DOIIndexMetrics(object):
+    """
+    counts of the dois looked up in the local index, that were found, not found, or found but stale
+    """
+
+    def __init__(self):
+        """
+
+        """
+        self.lock = threading.Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'stale': 0}
+
+    def record(self, outcome):
+        """
+
+        :param outcome:
+        :return:
+        """
+        with self.lock:
+            self.metrics[outcome] += 1
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            metrics = dict(self.metrics)
+        lookups = metrics['hits'] + metrics['misses'] + metrics['stale']
+        metrics['hit_ratio'] = metrics['hits'] / lookups if lookups else 0
+        return metrics
+
+doi_index_metrics = DOIIndexMetrics()
+
+
+class CandidatePruningMetrics(object):
+    """
+    counts of the candidates returned without their abstracts by the query on title, and how many of them were pruned
+    """
+
+    def __init__(self):
+        """
+
+        """
+        self.lock = threading.Lock()
+        self.metrics = {'num_queries': 0, 'num_candidates': 0, 'num_pruned': 0}
+
+    def record(self, num_candidates, num_pruned):
+        """
+
+        :param num_candidates:
+        :param num_pruned:
+        :return:
+        """
+        with self.lock:
+            self.metrics['num_queries'] += 1
+            self.metrics['num_candidates'] += num_candidates
+            self.metrics['num_pruned'] += num_pruned
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics['pruned_ratio'] = metrics['num_pruned'] / metrics['num_candidates'] if metrics['num_candidates'] else 0
+        return metrics
+
+candidate_pruning_metrics = CandidatePruningMetrics()
+
+
+class SpeculativeQuery(object):
+    """
+    solr query sent in the background before it is known if its result is needed
+    """
+
+    def __init__(self, func, *args):
+        """
+
+        :param func:
+        :param args:
+        """
+        self.start_time = time.time()
+        self.duration = 0
+        self.future = submit_solr_query(self.run, func, *args)
+        speculative_metrics.record_sent()
+
+    def run(self, func, *args):
+        """
+
+        :param func:
+        :param args:
+        :return:
+        """
+        start_time = time.time()
+        try:
+            return func(*args)
+        finally:
+            self.duration = (time.time() - start_time) * 1000
+
+    def result(self):
+        """
+        wait for the result, the time saved is how much of the query overlapped with what was done since it was sent
+
+        :return:
+        """
+        waited_from = time.time()
+        result = self.future.result()
+        speculative_metrics.record_used(min((waited_from - self.start_time) * 1000, self.duration))
+        return result
+
+    def discard(self):
+        """
+        result is not needed, cancel the query if it has not been sent yet, otherwise ignore its result
+
+        :return:
+        """
+        speculative_metrics.record_discarded(self.future.cancel())
+
+
 class DocMatching(object):
 
-    def __init__(self, payload, save=True):
+    def __init__(self, payload, save=True, predictor=None):
         """
 
         :param payload:
         :param save:
+        :param predictor: to predict the confidence with, if not the model itself
         """
         # read required params
         self.abstract = get_requests_params(payload, 'abstract')
@@ -41,6 +231,7 @@ class DocMatching(object):
         self.match_doctype = get_requests_params(payload, 'match_doctype', default_type=list)
         self.source_bibcode = get_requests_params(payload, 'bibcode')
         self.save_to_db = save
+        self.predictor = predictor
         self.extra_filter = get_requests_params(payload, 'extra_filter')
 
         if not self.doctype:
@@ -69,11 +260,22 @@ class DocMatching(object):
         :param comment: 
         :return: 
         """
-        doctype = ';'.join(self.match_doctype)
         results, query, solr_status_code = get_solr_data_match_doctype_case(self.author, self.year, self.doctype, '"%s"' % '" OR "'.join(self.match_doctype))
+        return self.match_doctype_results(results, query, comment)
+
+    def match_doctype_results(self, results, query, comment):
+        """
+        see if any of the records solr returned for the doctype is a match
+
+        :param results:
+        :param query:
+        :param comment:
+        :return:
+        """
+        doctype = ';'.join(self.match_doctype)
         # if any records from solr
         if isinstance(results, list) and len(results) > 0:
-            match = get_matches(self.source_bibcode, self.doctype, self.abstract, self.title, self.author, self.year, None, results)
+            match = get_matches(self.source_bibcode, self.doctype, self.abstract, self.title, self.author, self.year, None, results, predictor=self.predictor)
             if not match:
                 current_app.logger.debug('No result from solr for %s.'%doctype)
                 comment += ' No result from solr for %s.'%doctype
@@ -91,21 +293,13 @@ class DocMatching(object):
         """
         doi_filter = '"%s"'%'" OR "'.join(self.doi)
         current_app.logger.debug('with parameter: doi=({doi})'.format(doi='"%s"'%'" OR "'.join(self.doi)))
-        results, query, solr_status_code = get_solr_data_match_doi(doi_filter, self.doctype, self.match_doctype)
-        # if any records from solr
-        # compute the score, if score is 0 doi was wrong, so continue on to query using similar
-        if isinstance(results, list) and len(results) > 0:
-            match = get_doi_match(self.source_bibcode, self.doctype, self.abstract, self.title, self.author, self.year, self.doi, results)
-            if match:
-                return self.create_and_return_response(match, query), ''
-            else:
-                current_app.logger.debug('No matches with DOI %s, trying Abstract.' % self.doi)
-                comment += ' No matches with DOI %s, trying Abstract.' % self.doi
+        found = self.lookup_doi_index('doi', get_solr_params_match_doi(doi_filter, self.match_doctype)[1])
+        if found:
+            results, query, solr_status_code = found
         else:
-            current_app.logger.debug('No result from solr with DOI %s.' % self.doi)
-            comment += ' No result from solr with DOI %s.' % self.doi
-        
-        return None, comment
+            results, query, solr_status_code = get_solr_data_match_doi(doi_filter, self.doctype, self.match_doctype)
+            self.add_doi_index(results, solr_status_code)
+        return self.match_doi_results(results, query, comment)
 
     def query_pubnote(self, comment):
         """
@@ -116,7 +310,56 @@ class DocMatching(object):
         """
         doi_filter = '"%s"' % '" OR "'.join(self.doi)
         current_app.logger.debug('with parameter: pubnote=({doi})'.format(doi='"%s"' % '" OR "'.join(self.doi)))
-        results, query, solr_status_code = get_solr_data_match_pubnote(doi_filter, self.doctype, self.match_doctype)
+        found = self.lookup_doi_index('pubnote', get_solr_params_match_pubnote(doi_filter, self.match_doctype)[1])
+        if found:
+            results, query, solr_status_code = found
+        else:
+            results, query, solr_status_code = get_solr_data_match_pubnote(doi_filter, self.doctype, self.match_doctype)
+            self.add_doi_index(results, solr_status_code)
+        return self.match_doi_results(results, query, comment, ' in pubnote')
+
+    def lookup_doi_index(self, source, query):
+        """
+        if enabled, look up the dois in the local index, so that solr is queried only if they are not there,
+        or their entries are stale
+
+        :param source: `doi` or `pubnote`
+        :param query: solr query the index lookup stands in for
+        :return: results, query, and status code, same as from solr, None if solr needs to be queried
+        """
+        if not current_app.config.get('ORACLE_SERVICE_DOI_INDEX_ENABLED', False):
+            return None
+        docs, num_stale, status_code = lookup_doi_index(self.doi, source, self.match_doctype)
+        if docs:
+            doi_index_metrics.record('hits')
+            current_app.logger.debug('Found DOI %s in the index.' % self.doi)
+            # solr is queried for one record
+            return docs[:1], query, 200
+        doi_index_metrics.record('stale' if num_stale else 'misses')
+        return None
+
+    def add_doi_index(self, results, solr_status_code):
+        """
+        if enabled, keep the records solr returned for the doi, or pubnote, query in the local index, before matching
+        modifies them, only these are queried with all the fields that matching on doi needs
+
+        :param results:
+        :param solr_status_code:
+        :return:
+        """
+        if current_app.config.get('ORACLE_SERVICE_DOI_INDEX_ENABLED', False) and solr_status_code == 200 and results:
+            add_doi_index(results)
+
+    def match_doi_results(self, results, query, comment, where=''):
+        """
+        see if any of the records solr returned for the doi is a match
+
+        :param results:
+        :param query:
+        :param comment:
+        :param where: where in solr the doi was looked up, for the comment
+        :return:
+        """
         # if any records from solr
         # compute the score, if score is 0 doi was wrong, so continue on to query using similar
         if isinstance(results, list) and len(results) > 0:
@@ -124,23 +367,159 @@ class DocMatching(object):
             if match:
                 return self.create_and_return_response(match, query), ''
             else:
-                current_app.logger.debug('No matches with DOI %s in pubnote, trying Abstract.' % self.doi)
-                comment += ' No matches with DOI %s in pubnote, trying Abstract.' % self.doi
+                current_app.logger.debug('No matches with DOI %s%s, trying Abstract.' % (self.doi, where))
+                comment += ' No matches with DOI %s%s, trying Abstract.' % (self.doi, where)
         else:
-            current_app.logger.debug('No result from solr with DOI %s in pubnote.' % self.doi)
-            comment += ' No result from solr with DOI %s in pubnote.' % self.doi
+            current_app.logger.debug('No result from solr with DOI %s%s.' % (self.doi, where))
+            comment += ' No result from solr with DOI %s%s.' % (self.doi, where)
 
         return None, comment
 
-    def query_abstract_or_title(self, comment):
+    def should_send_title_query(self):
+        """
+        if enabled, and there is an abstract to query on first, the query on title is sent in the background,
+        so that if abstract does not find a match its result is ready without another round trip to solr
+
+        :return:
+        """
+        return bool(current_app.config.get('ORACLE_SERVICE_PARALLEL_TITLE_QUERY_ENABLED', False) and self.title and self.needs_abstracts())
+
+    def send_query(self, func, *args):
         """
+        send the query in the background
+
+        :param func: query function
+        :param args:
+        :return: the query sent, to wait for or discard
+        """
+        return SpeculativeQuery(func, *args)
+
+    def wait_for(self, query):
+        """
+
+        :param query: query sent in the background
+        :return: its result
+        """
+        return query.result()
+
+    def discard_queries(self, *queries):
+        """
+        results of the queries sent in the background are not needed
+
+        :param queries:
+        :return:
+        """
+        for query in queries:
+            if query:
+                query.discard()
+
+    def get_title_query_step(self, title_query):
+        """
+
+        :param title_query: query on title sent in the background, if any
+        :return: step that gets the result of the query on title
+        """
+        if title_query:
+            return (self.wait_for, title_query)
+        return (self.query_solr_data_match, '', self.title)
+
+    def run_flow(self, flow):
+        """
+        run the steps of the flow one after the other, each step is a function with its args,
+        the result of each step is sent back to the flow
+
+        :param flow: generator of the steps, see match_flow
+        :return: what the flow returns
+        """
+        try:
+            step = next(flow)
+            while True:
+                step = flow.send(step[0](*step[1:]))
+        except StopIteration as e:
+            return e.value
+
+    def needs_abstracts(self):
+        """
+        abstracts of the candidates are scored only if there is an abstract to compare them with
+
+        :return:
+        """
+        return len(self.abstract) > 0 and not self.abstract.lower().startswith('not available')
+
+    def prunes_title_candidates(self):
+        """
+        candidates are returned without their abstracts only if there is no abstract to compare them with,
+        otherwise none of them can be pruned and their abstracts are all needed
+
+        :return:
+        """
+        return current_app.config.get('ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED', False) and not self.needs_abstracts()
+
+    def prune_candidates(self, results):
+        """
+        drop the candidates that get_matches would discard anyway, so that they are not scored
+
+        :param results: candidates returned without their abstracts
+        :return: candidates kept
+        """
+        kept, num_pruned = prune_candidates(self.abstract, self.author, self.doi, results)
+        candidate_pruning_metrics.record(len(results), num_pruned)
+        if num_pruned:
+            current_app.logger.debug('Pruned {num_pruned} of {num_candidates} candidates without an abstract to compare.'.format(
+                num_pruned=num_pruned, num_candidates=len(results)))
+        return kept
+
+    def query_solr_data_match(self, abstract, title):
+        """
+        query solr on abstract, or on title if there is no abstract, if pruning is enabled and there is
+        no abstract to compare, the candidates are returned without their abstracts and the ones that cannot be
+        matched are pruned
+
+        :param abstract:
+        :param title:
+        :return:
+        """
+        if not self.prunes_title_candidates():
+            return get_solr_data_match(abstract, title, self.doctype, self.match_doctype, self.extra_filter)
+
+        solr_params = get_solr_params_match(abstract, title, self.match_doctype, self.extra_filter, with_abstract=False)
+        if not solr_params:
+            return [], '', 200
+        results, query, solr_status_code = query_solr_data(*solr_params)
+        if solr_status_code != 200 or len(results) == 0:
+            return results, query, solr_status_code
+        return self.prune_candidates(results), query, 200
+
+    def query_abstract_or_title(self, comment, abstract_query=None, title_query=None):
+        """
+
+        :param comment:
+        :param abstract_query: query on abstract, if it has already been sent in the background
+        :param title_query: query on title, if it has already been sent in the background
+        :return:
+        """
+        return self.run_flow(self.abstract_or_title_flow(comment, abstract_query, title_query))
+
+    def abstract_or_title_flow(self, comment, abstract_query=None, title_query=None):
+        """
+        match on abstract, and on title if abstract does not find a match, the queries to solr and db,
+        and the scoring, are yielded as steps, see match_flow
 
         :param comment:
+        :param abstract_query: query on abstract, if it has already been sent in the background
+        :param title_query: query on title, if it has already been sent in the background
         :return:
         """
+        if title_query is None and self.should_send_title_query():
+            title_query = yield (self.send_query, self.query_solr_data_match, '', self.title)
+
         # query solr using similar with abstract
-        results, query, solr_status_code = get_solr_data_match(self.abstract, self.title, self.doctype, self.match_doctype, self.extra_filter)
+        if abstract_query:
+            results, query, solr_status_code = yield (self.wait_for, abstract_query)
+        else:
+            results, query, solr_status_code = yield (self.query_solr_data_match, self.abstract, self.title)
         if solr_status_code != 200:
+            yield (self.discard_queries, title_query)
             return self.create_and_return_response([], query, 'status code: %d'%solr_status_code)
 
         # if solr was not able to find any matches with abstract, attempt it again with title
@@ -148,20 +527,21 @@ class DocMatching(object):
         if len(results) == 0:
             current_app.logger.debug('No result from solr with Abstract, trying Title.')
             comment += ' No result from solr with Abstract, trying Title.'
-            results, query, solr_status_code = get_solr_data_match('', self.title, self.doctype, self.match_doctype, self.extra_filter)
+            results, query, solr_status_code = yield self.get_title_query_step(title_query)
             if solr_status_code != 200:
                 return self.create_and_return_response([], query, 'status code: %d' % solr_status_code)
         # got records from solr, see if we can get a match
         else:
-            match = get_matches(self.source_bibcode, self.doctype, self.abstract, self.title, self.author, self.year, self.doi, results)
+            match = yield (get_matches, self.source_bibcode, self.doctype, self.abstract, self.title, self.author, self.year, self.doi, results, self.predictor)
             if len(match) > 0:
+                yield (self.discard_queries, title_query)
                 return self.create_and_return_response(match, query, comment)
             # otherwise if no match with abstract, and we think we should have this in solr
             # and thus have a much, try with title, this could be the case when abstract has changed
             # so drastically between the arXiv version and the publisher version
             current_app.logger.debug('No matches with Abstract, trying Title.')
             comment += ' No matches with Abstract, trying Title.'
-            results, query, solr_status_code = get_solr_data_match('', self.title, self.doctype, self.match_doctype, self.extra_filter)
+            results, query, solr_status_code = yield self.get_title_query_step(title_query)
             if solr_status_code != 200:
                 return self.create_and_return_response([], query, 'status code: %d' % solr_status_code)
 
@@ -173,7 +553,7 @@ class DocMatching(object):
             # here means no matches were found in solr
             # this could be also when trying to match with eprint, when the record has already been matched
             # and not in solr anymore, as a last attempt see if it is in database
-            match = get_db_match(self.source_bibcode)
+            match = yield (get_db_match, self.source_bibcode)
             if len(match) > 0:
                 comment += ' Fetched from database.'
                 return self.create_and_return_response(match, query, comment)
@@ -181,7 +561,7 @@ class DocMatching(object):
             return self.create_and_return_response(match='', query=query, comment=comment)
 
         # got results with title, see if it can be matched
-        match = get_matches(self.source_bibcode, self.doctype, self.abstract, self.title, self.author, self.year, None, results)
+        match = yield (get_matches, self.source_bibcode, self.doctype, self.abstract, self.title, self.author, self.year, None, results, self.predictor)
         return self.create_and_return_response(match, query, comment)
 
     def save_match(self, result):
@@ -195,22 +575,28 @@ class DocMatching(object):
                 the_match = result[0]['match']
                 # if there is only one record, and the confidence is high enough to be considered a match
                 if len(the_match) == 1 and the_match[0]['matched'] == 1:
-                    add_a_record({'source_bibcode': the_match[0]['source_bibcode'],
-                                  'matched_bibcode': the_match[0]['matched_bibcode'],
-                                  'confidence': the_match[0]['confidence']},
-                                 source_bibcode_doctype=self.doctype)
-
-    def process(self):
+                    match = {'source_bibcode': the_match[0]['source_bibcode'],
+                             'matched_bibcode': the_match[0]['matched_bibcode'],
+                             'confidence': the_match[0]['confidence']}
+                    # if write behind is enabled queue it to be saved in the background,
+                    # save it now if not enabled or the queue is full
+                    write_behind = getattr(current_app, 'write_behind', None)
+                    if write_behind and write_behind.put(match, source_bibcode_doctype=self.doctype):
+                        return
+                    add_a_record(match, source_bibcode_doctype=self.doctype)
+
+    def check_params(self):
         """
+        validate the params, and decide on the doctypes to match against
 
-        :return:
+        :return: error response if params are not valid, None otherwise, and the comment to start with
         """
         # need either abstract or title, with author and year and doctype
         if not ((self.abstract or self.title) and self.author and self.year and self.doctype):
             current_app.logger.error('missing required parameter(s)')
             results = {'error': 'the following parameters are required: `abstract` or `title`, `author`, `year`,  and `doctype`'}
             status_code = 400
-            return results, status_code
+            return (results, status_code), ''
 
         self.author = format_author(encode_author(self.author))
         comment = ''
@@ -222,26 +608,29 @@ class DocMatching(object):
                 current_app.logger.error('invalid doctype `%s`'%self.doctype)
                 results = {'error': 'invalid doctype `%s`' % self.doctype}
                 status_code = 400
-                return results, status_code
+                return (results, status_code), comment
         else:
             if isinstance(self.match_doctype, list):
                 comment = 'Matching doctype `%s`.'%';'.join(self.match_doctype)
             else:
                 comment = 'Matching doctype `%s`.'%(self.match_doctype)
+        return None, comment
 
-            # special cases: thesis, erratum, or bookreview
-            for case in ['thesis', 'erratum', 'bookreview']:
-                is_special_case = any(input in self.match_doctype for input in current_app.config['ORACLE_SERVICE_MATCH_DOCTYPE'].get(case))
-                if is_special_case:
-                    result = self.query_doctype(comment)
-                    if result:
-                        if result[0].get('match', None):
-                            self.save_match(result)
-                            return result
-                        # if no doi, return that nothing was found, but if there is a doi, try it
-                        elif not self.doi:
-                            return result
+    def get_special_cases(self):
+        """
+        special cases: thesis, erratum, or bookreview, that the doctypes to match against fall in
 
+        :return:
+        """
+        return [case for case in ['thesis', 'erratum', 'bookreview']
+                if any(input in self.match_doctype for input in current_app.config['ORACLE_SERVICE_MATCH_DOCTYPE'].get(case))]
+
+    def prepare_queries(self):
+        """
+        clean up the metadata to query solr on
+
+        :return:
+        """
         self.abstract = clean_metadata(self.abstract)
         self.title = clean_metadata(self.title)
         # remove REFEREED for now
@@ -249,23 +638,73 @@ class DocMatching(object):
         self.extra_filter = ''
         self.match_doctype = ' OR '.join(self.match_doctype)
 
+    def log_query_params(self):
+        """
+
+        :return:
+        """
+        current_app.logger.debug('with parameters: abstract={abstract}, title={title}, author={author}, year={year}, doctype={doctype}'.format(
+            abstract=self.abstract[:100]+'...', title=self.title, author=self.author, year=self.year, doctype=self.doctype))
+
+    def process(self):
+        """
+
+        :return:
+        """
+        return self.run_flow(self.match_flow())
+
+    def match_flow(self):
+        """
+        the decisions of matching, the special doctypes, then doi, then abstract, then title, as a generator
+        that yields the steps querying solr or db, or scoring, each a function with its args, and is sent back
+        their results, so that the sync and the async matching run the same flow, see run_flow
+
+        :return:
+        """
+        match_doctype_requested = bool(self.match_doctype)
+        error, comment = self.check_params()
+        if error:
+            return error
+
+        if match_doctype_requested:
+            for case in self.get_special_cases():
+                result = yield (self.query_doctype, comment)
+                if result:
+                    if result[0].get('match', None):
+                        yield (self.save_match, result)
+                        return result
+                    # if no doi, return that nothing was found, but if there is a doi, try it
+                    elif not self.doi:
+                        return result
+
+        self.prepare_queries()
+
+        # if enabled, send the query on abstract, and on title if that is enabled too, now, so that if doi does not
+        # find a match their results are ready without waiting for another round trip to solr
+        abstract_query, title_query = None, None
+        if self.doi and current_app.config.get('ORACLE_SERVICE_SPECULATIVE_QUERIES_ENABLED', False):
+            abstract_query = yield (self.send_query, self.query_solr_data_match, self.abstract, self.title)
+            if self.should_send_title_query():
+                title_query = yield (self.send_query, self.query_solr_data_match, '', self.title)
+
         # if doi is available from the eprint try query on doi first
         if self.doi and self.doctype == current_app.config['ORACLE_DOCTYPE_EPRINT']:
-            result, comment = self.query_doi(comment)
+            result, comment = yield (self.query_doi, comment)
             if result:
-                self.save_match(result)
+                yield (self.discard_queries, abstract_query, title_query)
+                yield (self.save_match, result)
                 return result
         # if doi is available on the side of publisher metadata
         # query pubnote
         elif self.doi:
-            result, comment = self.query_pubnote(comment)
+            result, comment = yield (self.query_pubnote, comment)
             if result:
-                self.save_match(result)
+                yield (self.discard_queries, abstract_query, title_query)
+                yield (self.save_match, result)
                 return result
 
-        current_app.logger.debug('with parameters: abstract={abstract}, title={title}, author={author}, year={year}, doctype={doctype}'.format(
-            abstract=self.abstract[:100]+'...', title=self.title, author=self.author, year=self.year, doctype=self.doctype))
+        self.log_query_params()
 
-        result = self.query_abstract_or_title(comment)
-        self.save_match(result)
+        result = yield from self.abstract_or_title_flow(comment, abstract_query, title_query)
+        yield (self.save_match, result)
         return result
@@ -0,0 +1,404 @@
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+re_similar = re.compile(r'similar\("(.*?)",\s*input\s+(abstract|title)', re.DOTALL)
+re_topn = re.compile(r'topn\((\d+),')
+re_identifier = re.compile(r'identifier:\((.*?)\)\s*(?:doctype:|$)')
+re_pubnote = re.compile(r'pubnote:\((.*?)\)\s*(?:doctype:|$)')
+re_author_norm = re.compile(r'author_norm:"(.*?)"')
+re_year_range = re.compile(r'year:\[(\d+) TO (\d+)\]')
+re_doctype = re.compile(r'doctype:\((.*?)\)')
+re_quoted = re.compile(r'"([^"]+)"')
+
+
+class FakeSolrHandler(BaseHTTPRequestHandler):
+    """
+    answers the queries sent to the search endpoint, keeping the connection alive
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """
+
+        :return:
+        """
+        params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        status_code, from_solr = self.server.fake_solr.handle(params)
+        body = json.dumps(from_solr).encode('utf-8')
+        self.server.fake_solr.record_bytes(FakeSolr.get_shape(params.get('q', '')), len(body))
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        do not log every request
+
+        :param format:
+        :param args:
+        :return:
+        """
+        pass
+
+
+class FakeSolr(object):
+    """
+    local stand-in for the solr search endpoint, answers the query shapes sent for matching: similar(),
+    identifier:, pubnote:, and author_norm:, with the recorded response of the query if there is one,
+    otherwise with synthetic docs, after the configured latency, the queries and the bytes of their responses
+    are counted per shape
+    """
+
+    SHAPES = ['similar', 'identifier', 'pubnote', 'author_norm']
+
+    # synthetic docs kept to answer the queries on their bibcodes with
+    MAX_DOCS = 100000
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, jitter_ms=0, shape_latency_ms=None, recorded=None, related_ratio=1.0):
+        """
+
+        :param host:
+        :param port: 0 to pick a free port
+        :param latency_ms: time to wait before answering a query
+        :param jitter_ms: up to this many milliseconds more or less is waited
+        :param shape_latency_ms: latency per query shape, overrides latency_ms for the shapes given
+        :param recorded: dict of query to the solr response to answer it with
+        :param related_ratio: fraction of the docs similar() returns that have the synthetic authors and year,
+                              the rest are by other authors and years earlier, similar to the query only in text
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.shape_latency_ms = shape_latency_ms or {}
+        self.recorded = recorded or {}
+        self.related_ratio = related_ratio
+        self.server = ThreadingHTTPServer((host, port), FakeSolrHandler)
+        self.server.daemon_threads = True
+        self.server.fake_solr = self
+        self.thread = None
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.num_bytes = {}
+        self.docs = {}
+
+    @property
+    def url(self):
+        """
+
+        :return: url to set ORACLE_SERVICE_SOLRQUERY_URL to
+        """
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d/v1/search/query' % (host, port)
+
+    def start(self):
+        """
+        serve in the background
+
+        :return:
+        """
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake_solr', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+
+        :return:
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    @staticmethod
+    def load_recorded(filename):
+        """
+
+        :param filename: json lines, each with the query `q` and the solr `response` to answer it with
+        :return:
+        """
+        recorded = {}
+        with open(filename) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    recorded[record['q']] = record['response']
+        return recorded
+
+    @staticmethod
+    def get_shape(query):
+        """
+
+        :param query:
+        :return: shape of the query, or None if it is not one of the matching queries
+        """
+        if 'similar(' in query:
+            return 'similar'
+        if query.startswith('identifier:'):
+            return 'identifier'
+        if query.startswith('pubnote:'):
+            return 'pubnote'
+        if query.startswith('author_norm:'):
+            return 'author_norm'
+        return None
+
+    def get_latency(self, shape):
+        """
+
+        :param shape:
+        :return: in seconds
+        """
+        latency_ms = self.shape_latency_ms.get(shape, self.latency_ms)
+        if self.jitter_ms:
+            latency_ms += random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(0, latency_ms) / 1000.0
+
+    def record(self, shape):
+        """
+
+        :param shape:
+        :return:
+        """
+        with self.lock:
+            self.metrics[shape] = self.metrics.get(shape, 0) + 1
+
+    def record_bytes(self, shape, num_bytes):
+        """
+
+        :param shape:
+        :param num_bytes: of the response body
+        :return:
+        """
+        shape = shape or 'other'
+        with self.lock:
+            self.num_bytes[shape] = self.num_bytes.get(shape, 0) + num_bytes
+
+    def handle(self, params):
+        """
+
+        :param params:
+        :return: status code and solr response
+        """
+        query = params.get('q', '')
+        shape = self.get_shape(query)
+        self.record(shape or 'other')
+        time.sleep(self.get_latency(shape))
+
+        if query in self.recorded:
+            return 200, self.recorded[query]
+
+        rows = int(params.get('rows', 10))
+        fl = [field.strip() for field in params.get('fl', '').split(',') if field.strip()]
+        if shape == 'similar':
+            docs = self.get_similar_docs(query, rows)
+        elif shape == 'identifier':
+            docs = self.get_identifier_docs(query)
+        elif shape == 'pubnote':
+            docs = self.get_pubnote_docs(query)
+        elif shape == 'author_norm':
+            docs = self.get_author_norm_docs(query, rows)
+        else:
+            docs = []
+        docs = [{field: value for field, value in doc.items() if not fl or field in fl} for doc in docs[:rows]]
+        return 200, {
+            'responseHeader': {'status': 0, 'QTime': 1, 'params': params},
+            'response': {'numFound': len(docs), 'start': 0, 'docs': docs},
+        }
+
+    def make_doc(self, seed, query, **fields):
+        """
+
+        :param seed: to derive the bibcode from
+        :param query: to take the doctype from
+        :param fields:
+        :return:
+        """
+        match = re_doctype.search(query)
+        doctype = re_quoted.sub(r'\1', match.group(1)).split(' OR ')[0].strip() if match else 'article'
+        year = str(fields.pop('year', 2021))
+        bibcode = fields.pop('bibcode', None) or '%sFAKE.%sX' % (year, hashlib.sha1(seed.encode('utf-8')).hexdigest()[:9])
+        doc = {
+            'bibcode': bibcode,
+            'abstract': 'Synthetic abstract of %s.' % bibcode,
+            'title': ['Synthetic title of %s' % bibcode],
+            'author_norm': ['Fake, A', 'Standin, B'],
+            'year': year,
+            'doctype': doctype,
+            'identifier': [bibcode],
+            'property': ['REFEREED', 'ARTICLE'],
+        }
+        doc.update(fields)
+        return doc
+
+    def get_similar_docs(self, query, rows):
+        """
+        the first doc has the text queried on, the others have less and less of it
+
+        :param query:
+        :param rows:
+        :return:
+        """
+        match = re_similar.search(query)
+        text, field = (match.group(1), match.group(2)) if match else ('', 'abstract')
+        topn = re_topn.search(query)
+        words = text.split()
+        num_docs = min(rows, int(topn.group(1)) if topn else rows)
+        num_related = int(round(num_docs * self.related_ratio))
+        docs = []
+        for i in range(num_docs):
+            partial = ' '.join(words[:max(1, len(words) * (10 - i) // 10)])
+            fields = {'abstract': partial} if field == 'abstract' else {'title': [partial]}
+            if i >= num_related:
+                fields.update({'author_norm': ['Other, C'], 'year': 1990 + i})
+            docs.append(self.make_doc('%s %d' % (text, i), query, **fields))
+        self.keep_docs(docs)
+        return docs
+
+    def keep_docs(self, docs):
+        """
+        so that a later query on their bibcodes returns the same docs
+
+        :param docs:
+        :return:
+        """
+        with self.lock:
+            for doc in docs:
+                self.docs[doc['bibcode']] = doc
+            while len(self.docs) > self.MAX_DOCS:
+                del self.docs[next(iter(self.docs))]
+
+    def get_identifier_docs(self, query):
+        """
+        one doc for each identifier queried on, doi or bibcode, the doc returned earlier if it is a bibcode of one
+
+        :param query:
+        :return:
+        """
+        match = re_identifier.search(query)
+        docs = []
+        for identifier in re_quoted.findall(match.group(1)) if match else []:
+            with self.lock:
+                kept = self.docs.get(identifier, None)
+            if kept:
+                doc = dict(kept)
+            elif identifier.startswith('10.'):
+                doc = self.make_doc(identifier, query, doi=[identifier])
+                doc['identifier'].append(identifier)
+            else:
+                doc = self.make_doc(identifier, query, bibcode=identifier)
+            docs.append(doc)
+        return docs
+
+    def get_pubnote_docs(self, query):
+        """
+        one doc for each doi queried on, with the doi in its pubnote
+
+        :param query:
+        :return:
+        """
+        match = re_pubnote.search(query)
+        return [self.make_doc(doi, query, pubnote=['doi: %s' % doi])
+                for doi in (re_quoted.findall(match.group(1)) if match else [])]
+
+    def get_author_norm_docs(self, query, rows):
+        """
+        docs by the author queried on, within the years queried on
+
+        :param query:
+        :param rows:
+        :return:
+        """
+        author = re_author_norm.search(query).group(1)
+        years = re_year_range.search(query)
+        start_year, end_year = (int(years.group(1)), int(years.group(2))) if years else (2021, 2021)
+        return [self.make_doc('%s %d' % (author, i), query, author_norm=[author.title()], year=start_year + i % (end_year - start_year + 1))
+                for i in range(rows)]
+
+    def get_metrics(self):
+        """
+
+        :return: number of queries per shape
+        """
+        with self.lock:
+            return dict(self.metrics)
+
+    def get_bytes(self):
+        """
+
+        :return: number of bytes of the responses per shape
+        """
+        with self.lock:
+            return dict(self.num_bytes)
+
+
+def parse_shape_latency(values):
+    """
+
+    :param values: list of shape=milliseconds
+    :return:
+    """
+    shape_latency_ms = {}
+    for value in values or []:
+        shape, latency_ms = value.split('=')
+        if shape not in FakeSolr.SHAPES:
+            raise argparse.ArgumentTypeError('unknown query shape `%s`, expected one of %s' % (shape, ', '.join(FakeSolr.SHAPES)))
+        shape_latency_ms[shape] = float(latency_ms)
+    return shape_latency_ms
+
+
+def add_arguments(parser):
+    """
+    arguments to configure the fake solr with
+
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--latency-ms', dest='latency_ms', type=float, default=0, help='time to wait before answering a query')
+    parser.add_argument('--jitter-ms', dest='jitter_ms', type=float, default=0, help='up to this many milliseconds more or less is waited')
+    parser.add_argument('--shape-latency-ms', dest='shape_latency_ms', nargs='*', metavar='SHAPE=MS',
+                        help='latency for a query shape: %s' % ', '.join(FakeSolr.SHAPES))
+    parser.add_argument('--responses', dest='responses', default=None,
+                        help='json lines file of the recorded responses, each with the query `q` and the solr `response`')
+    parser.add_argument('--related-ratio', dest='related_ratio', type=float, default=1.0,
+                        help='fraction of the similar docs that have the synthetic authors and year, the rest can be pruned')
+
+
+def create_fake_solr(args, host='127.0.0.1', port=0):
+    """
+
+    :param args: parsed arguments added by add_arguments
+    :param host:
+    :param port:
+    :return:
+    """
+    return FakeSolr(host=host, port=port, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                    shape_latency_ms=parse_shape_latency(args.shape_latency_ms),
+                    recorded=FakeSolr.load_recorded(args.responses) if args.responses else None,
+                    related_ratio=args.related_ratio)
+
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Local stand-in for solr, to run the service against')
+    parser.add_argument('--host', dest='host', default='127.0.0.1')
+    parser.add_argument('--port', dest='port', type=int, default=8983)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    fake_solr = create_fake_solr(args, args.host, args.port)
+    print('serving at %s, set ORACLE_SERVICE_SOLRQUERY_URL to it' % fake_solr.url)
+    try:
+        fake_solr.server.serve_forever()
+    except KeyboardInterrupt:
+        fake_solr.server.server_close()
+        sys.exit(0)
@@ -0,0 +1,80 @@
+import sys
+import time
+import argparse
+
+from flask import current_app
+
+from oraclesrv.models import DocMatch
+from oraclesrv.utils import bulk_add_records, query_eprint_bibstem, lookup_confidence
+
+
+def read_matches(filename, confidence=None):
+    """
+    read a tab delimited file having source bibcode, matched bibcode, and an optional confidence column
+
+    :param filename:
+    :param confidence: confidence to use when the file does not have the confidence column
+    :return: list of dicts with eprint_bibcode, pub_bibcode, and confidence
+    """
+    eprint_bibstems, _ = query_eprint_bibstem()
+    rows = []
+    with open(filename) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            columns = line.split('\t')
+            try:
+                if len(columns) >= 3:
+                    the_confidence = float(columns[2])
+                elif confidence is not None:
+                    the_confidence = confidence
+                else:
+                    raise ValueError('missing confidence')
+                # convert to DocMatch so that eprint and pub bibcodes can be identified
+                docmatch = DocMatch(columns[0].strip(), columns[1].strip(), the_confidence, eprint_bibstems)
+            except (ValueError, IndexError) as e:
+                current_app.logger.error('skipping line %d of %s: %s' % (line_number, filename, str(e)))
+                continue
+            rows.append({"eprint_bibcode": docmatch.eprint_bibcode,
+                         "pub_bibcode": docmatch.pub_bibcode,
+                         "confidence": docmatch.confidence})
+    return rows
+
+def ingest(filename, source=None):
+    """
+    bulk load the matches in the file into db
+
+    :param filename:
+    :param source: source name to lookup confidence for the lines with no confidence column
+    :return:
+    """
+    confidence = None
+    if source:
+        confidence, status_code = lookup_confidence(source)
+        if status_code != 200:
+            current_app.logger.error('unable to find confidence value for source %s' % source)
+            return False
+
+    start_time = time.time()
+    rows = read_matches(filename, confidence)
+    status, counts, text = bulk_add_records(rows)
+    current_app.logger.info("Bulk loaded {num_rows} records from {filename} in {duration} ms, {text}".format(
+        num_rows=len(rows), filename=filename, duration=(time.time() - start_time) * 1000, text=text))
+    print(text)
+    return status
+
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Bulk load matches into the docmatch table, a match already in the table '
+                                                 'is updated only if the new confidence is higher, and never if it has been marked incorrect')
+    parser.add_argument('-i', '--input', dest='input', action='store', required=True,
+                        help='tab delimited file of source bibcode, matched bibcode, and optional confidence')
+    parser.add_argument('-s', '--source', dest='source', action='store', default=None,
+                        help='source name from confidence_lookup to use for the lines with no confidence')
+    args = parser.parse_args()
+
+    from oraclesrv import app as application
+    app = application.create_app()
+    with app.app_context():
+        sys.exit(0 if ingest(args.input, args.source) else 1)
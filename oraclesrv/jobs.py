@@ -0,0 +1,82 @@
+import threading
+
+from flask import current_app
+from adsmutils import get_date
+
+import oraclesrv.utils as utils
+
+
+def run_cleanup_job(app, job_id, full=False, lock=None):
+    """
+    run clean_db, recording the phase and counts in the job as it goes
+
+    :param app:
+    :param job_id:
+    :param full:
+    :param lock: if specified, the connection holding the lock of lock_cleanup_job, let go once the job is done
+    :return:
+    """
+    with app.app_context():
+        def progress(phase, counts):
+            utils.update_cleanup_job(job_id, status='running', phase=phase, **counts)
+
+        try:
+            try:
+                counts, status = utils.clean_db(full, progress=progress)
+            except Exception as e:
+                app.logger.error('cleanup job %s failed: %s' % (job_id, str(e)))
+                counts, status = {}, str(e)
+
+            succeeded = len(counts) > 0 and all(count >= 0 for count in counts.values())
+            utils.update_cleanup_job(job_id, status='succeeded' if succeeded else 'failed', phase='done',
+                                     message=status, date_finished=get_date(), **counts)
+            app.logger.info('cleanup job %s finished with counts %s' % (job_id, counts))
+            return succeeded
+        finally:
+            if lock is not None:
+                utils.unlock_cleanup_job(lock)
+
+def start_cleanup_job(full=False):
+    """
+    add a cleanup job and run it in a background thread, unless there is a job queued or running already
+
+    :param full:
+    :return: id of the job, the thread it is running in, and 200,
+             or id of the job queued or running already, None, and 409,
+             or None, None, and 400 if unable to add the job
+    """
+    lock, status = utils.lock_cleanup_job()
+    if lock is None:
+        if status == 409:
+            return utils.get_active_cleanup_job(), None, 409
+        return None, None, 400
+    # the jobs left queued or running do not hold the lock, so their worker is gone
+    utils.fail_stale_cleanup_jobs()
+    job_id = utils.add_cleanup_job(full)
+    if not job_id:
+        utils.unlock_cleanup_job(lock)
+        return None, None, 400
+    thread = threading.Thread(target=run_cleanup_job, args=(current_app._get_current_object(), job_id, full, lock),
+                              name='cleanup_%s' % job_id, daemon=True)
+    thread.start()
+    return job_id, thread, 200
+
+def mark_stale_cleanup_jobs(app):
+    """
+    when the app starts, mark the jobs left queued or running by a worker that has gone away as failed,
+    unless a job is running in another worker
+
+    :param app:
+    :return: number of jobs marked as failed
+    """
+    with app.app_context():
+        lock, _ = utils.lock_cleanup_job()
+        if lock is None:
+            return 0
+        try:
+            count = utils.fail_stale_cleanup_jobs()
+            if count > 0:
+                app.logger.info('marked %d stale cleanup jobs as failed' % count)
+            return max(count, 0)
+        finally:
+            utils.unlock_cleanup_job(lock)
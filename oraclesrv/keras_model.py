@@ -3,6 +3,9 @@ import traceback
 import time
 import argparse
 
+import threading
+
+import numpy as np
 import pandas as pd
 from tensorflow import keras
 from tensorflow.keras import layers
@@ -267,6 +270,28 @@ class KerasModel(object):
         if not success:
             return False
 
+    def select_model(self, scores):
+        """
+
+        :param scores: list of scores for [abstract, title, author, year], and optionally doi
+        :return: model to predict with and its input, None for both if the dimension of scores is not recognized
+        """
+        # no doi
+        if len(scores) == 4:
+            if scores[0] != None:
+                # with abstract
+                return self.model_4dim, scores
+            # no abstract
+            return self.model_3dim, scores[1:]
+        # with addition of doi
+        if len(scores) == 5:
+            if scores[0] != None:
+                # with abstract
+                return self.model_4dim_w_doi, scores
+            # no abstract
+            return self.model_3dim_w_doi, scores[1:]
+        return None, None
+
     def predict(self, scores):
         """
 
@@ -279,25 +304,11 @@ class KerasModel(object):
                 self.model_loaded = True
             current_app.logger.debug("Predict score ...")
             start_time = time.time()
-            # no doi
-            if len(scores) == 4:
-                if scores[0] != None:
-                    # with abstract
-                    prediction_score = self.model_4dim.predict([scores])[0][0].item()
-                else:
-                    # no abstract
-                    prediction_score = self.model_3dim.predict([scores[1:]])[0][0].item()
-            # with addition of doi
-            elif len(scores) == 5:
-                if scores[0] != None:
-                    # with abstract
-                    prediction_score = self.model_4dim_w_doi.predict([scores])[0][0].item()
-                else:
-                    # no abstract
-                    prediction_score = self.model_3dim_w_doi.predict([scores[1:]])[0][0].item()
-            else:
+            model, model_input = self.select_model(scores)
+            if model is None:
                 current_app.logger.error('Unable to predict score, wrong dimension %d received!'%len(scores))
                 return 0
+            prediction_score = model.predict([model_input])[0][0].item()
             current_app.logger.debug("Predict score took {duration} ms".format(duration=(time.time() - start_time) * 1000))
             confidence_format = '%.{}f'.format(current_app.config['ORACLE_SERVICE_CONFIDENCE_SIGNIFICANT_DIGITS'])
             return float(confidence_format % prediction_score)
@@ -305,6 +316,38 @@ class KerasModel(object):
             current_app.logger.error(str(e))
             return 0
 
+    def predict_batch(self, scores_list):
+        """
+        predict the scores of several candidates, with one call to each model
+
+        :param scores_list: list of list of scores
+        :return: list of predictions, in the same order
+        """
+        predictions = [0] * len(scores_list)
+        try:
+            if not self.model_loaded:
+                self.load()
+                self.model_loaded = True
+            start_time = time.time()
+            # group the candidates by the model that scores them
+            groups = {}
+            for i, scores in enumerate(scores_list):
+                model, model_input = self.select_model(scores)
+                if model is None:
+                    current_app.logger.error('Unable to predict score, wrong dimension %d received!'%len(scores))
+                    continue
+                groups.setdefault(id(model), (model, [], []))
+                groups[id(model)][1].append(i)
+                groups[id(model)][2].append(model_input)
+            confidence_format = '%.{}f'.format(current_app.config['ORACLE_SERVICE_CONFIDENCE_SIGNIFICANT_DIGITS'])
+            for model, indices, model_inputs in groups.values():
+                for i, prediction in zip(indices, model.predict(np.array(model_inputs, dtype='float32'))):
+                    predictions[i] = float(confidence_format % prediction[0].item())
+            current_app.logger.debug("Predict {count} scores took {duration} ms".format(count=len(scores_list), duration=(time.time() - start_time) * 1000))
+        except Exception as e:
+            current_app.logger.error(str(e))
+        return predictions
+
     def load(self): # pragma: no cover
         """
 
@@ -318,6 +361,55 @@ class KerasModel(object):
         current_app.logger.debug("Loading model took {duration} ms".format(duration=(time.time() - start_time) * 1000))
 
 
+class PredictionBatcher(object):
+    """
+    collects the predictions requested concurrently, ie. by the records of a batch being matched at the same time,
+    and predicts them together, a batch is predicted once it has max_batch_size predictions, or max_wait seconds
+    after its first prediction was requested, whichever comes first
+    """
+
+    def __init__(self, model, max_batch_size, max_wait):
+        """
+
+        :param model:
+        :param max_batch_size:
+        :param max_wait: in seconds
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.condition = threading.Condition()
+        self.num_batches = 0
+        self.num_predictions = 0
+
+    def predict(self, scores):
+        """
+        the first caller of a batch waits for the rest of the batch and predicts it, the others wait for it
+
+        :param scores:
+        :return:
+        """
+        entry = {'scores': scores, 'done': threading.Event(), 'prediction': 0}
+        with self.condition:
+            self.pending.append(entry)
+            is_first = len(self.pending) == 1
+            if len(self.pending) >= self.max_batch_size:
+                self.condition.notify_all()
+            if is_first:
+                self.condition.wait_for(lambda: len(self.pending) >= self.max_batch_size, timeout=self.max_wait)
+                batch, self.pending = self.pending, []
+                self.num_batches += 1
+                self.num_predictions += len(batch)
+        if is_first:
+            predictions = self.model.predict_batch([one['scores'] for one in batch])
+            for one, prediction in zip(batch, predictions):
+                one['prediction'] = prediction
+                one['done'].set()
+        entry['done'].wait()
+        return entry['prediction']
+
+
 def create_keras_model():  # pragma: no cover
     """
     create a crf text model and save it to a pickle file
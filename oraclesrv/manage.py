@@ -0,0 +1,54 @@
+import sys
+import argparse
+
+from oraclesrv.utils import check_best_match, load_doi_index
+
+
+def best_match(rebuild=False):
+    """
+    report if best_match is in sync with docmatch, and rebuild it if asked
+
+    :param rebuild:
+    :return:
+    """
+    status, differences, text = check_best_match(rebuild)
+    print(text)
+    return status
+
+
+def doi_index(filename):
+    """
+    bulk load the doi index with the records of the bibcodes in the file
+
+    :param filename: one bibcode per line
+    :return:
+    """
+    with open(filename) as f:
+        bibcodes = [line.strip() for line in f if line.strip()]
+    status, num_dois, text = load_doi_index(bibcodes)
+    print(text)
+    return status
+
+
+if __name__ == '__main__':  # pragma: no cover
+    parser = argparse.ArgumentParser(description='Maintenance commands for the oracle db')
+    subparsers = parser.add_subparsers(dest='command')
+    best_match_parser = subparsers.add_parser('best_match', help='check that best_match is in sync with docmatch')
+    best_match_parser.add_argument('-r', '--rebuild', dest='rebuild', action='store_true', default=False,
+                                   help='rebuild best_match from docmatch')
+    doi_index_parser = subparsers.add_parser('doi_index', help='bulk load the doi index from solr')
+    doi_index_parser.add_argument('-f', '--file', dest='filename', required=True,
+                                  help='file of the bibcodes to load, one per line')
+    args = parser.parse_args()
+
+    if not args.command:
+        parser.print_help()
+        sys.exit(1)
+
+    from oraclesrv import app as application
+    app = application.create_app()
+    with app.app_context():
+        if args.command == 'best_match':
+            sys.exit(0 if best_match(args.rebuild) else 1)
+        elif args.command == 'doi_index':
+            sys.exit(0 if doi_index(args.filename) else 1)
@@ -3,7 +3,7 @@ import re
 
 from flask import current_app
 
-from sqlalchemy import Float, String, Column, DateTime, func
+from sqlalchemy import Float, String, Integer, Boolean, Column, DateTime, Text, Index, func, event, DDL, false
 from sqlalchemy.ext.declarative import declarative_base
 
 
@@ -17,6 +17,9 @@ class DocMatch(Base):
     confidence = Column(Float, primary_key=False)
     date = Column(DateTime, default=func.now())
 
+    # lookups by pub_bibcode alone, ie. maintaining best_match, cannot use the primary key
+    __table_args__ = (Index('ix_docmatch_pub_bibcode', 'pub_bibcode'),)
+
     def __init__(self, source_bibcode, matched_bibcode, confidence, eprint_bibstems, date=None, source_bibcode_doctype=None):
         """
 
@@ -164,3 +167,194 @@ class EPrintBibstemLookup(Base):
             'name': self.name,
             'pattern': self.pattern,
         }
+
+
+
+class BestMatch(Base):
+    """
+    for each pub_bibcode the match(es) with the highest confidence, this table is maintained
+    by a trigger on docmatch, so that it is never written to directly
+    """
+    __tablename__ = 'best_match'
+    pub_bibcode = Column(String, primary_key=True)
+    eprint_bibcode = Column(String, primary_key=True)
+    confidence = Column(Float, primary_key=False, nullable=False)
+    date = Column(DateTime(timezone=True), nullable=False)
+
+    def toJSON(self):
+        """
+
+        :return: values formatted as python dict
+        """
+        return {
+            'eprint_bibcode': self.eprint_bibcode,
+            'pub_bibcode': self.pub_bibcode,
+            'confidence': self.confidence,
+            'date' : self.date,
+        }
+
+
+# recomputes the best matches of a set of pub_bibcodes with one delete and one insert, concurrent refreshes of the
+# same pub_bibcode are serialized so that each one sees the other's committed rows, the pub_bibcodes are hashed into
+# at most 1024 advisory locks, taken in ascending order, so that the locks held by a transaction are bounded
+# and two refreshes cannot take them in opposite orders
+BEST_MATCH_REFRESH_FUNCTION = """
+CREATE OR REPLACE FUNCTION refresh_best_matches(the_pub_bibcodes VARCHAR[]) RETURNS VOID AS $$
+DECLARE
+    bucket INTEGER;
+BEGIN
+    FOR bucket IN SELECT DISTINCT hashtext(pub_bibcode) & 1023 FROM unnest(the_pub_bibcodes) AS pub_bibcode ORDER BY 1 LOOP
+        PERFORM pg_advisory_xact_lock(hashtext('best_match'), bucket);
+    END LOOP;
+    DELETE FROM best_match WHERE pub_bibcode = ANY(the_pub_bibcodes);
+    INSERT INTO best_match (pub_bibcode, eprint_bibcode, confidence, date)
+        SELECT d.pub_bibcode, d.eprint_bibcode, d.confidence, d.date FROM docmatch d
+        JOIN (SELECT pub_bibcode, max(confidence) AS confidence FROM docmatch
+              WHERE pub_bibcode = ANY(the_pub_bibcodes) GROUP BY pub_bibcode) h
+        ON d.pub_bibcode = h.pub_bibcode AND d.confidence = h.confidence;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+# once per statement, refresh the distinct pub_bibcodes of the rows the statement touched, from its transition tables
+BEST_MATCH_TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION docmatch_best_match_trigger() RETURNS TRIGGER AS $$
+DECLARE
+    pub_bibcodes VARCHAR[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        pub_bibcodes := ARRAY(SELECT DISTINCT pub_bibcode FROM new_rows);
+    ELSIF TG_OP = 'UPDATE' THEN
+        pub_bibcodes := ARRAY(SELECT pub_bibcode FROM old_rows UNION SELECT pub_bibcode FROM new_rows);
+    ELSE
+        pub_bibcodes := ARRAY(SELECT DISTINCT pub_bibcode FROM old_rows);
+    END IF;
+    IF cardinality(pub_bibcodes) > 0 THEN
+        PERFORM refresh_best_matches(pub_bibcodes);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+# a trigger can have transition tables for one event only, hence one trigger per event
+BEST_MATCH_TRIGGERS = [
+    """
+    CREATE TRIGGER docmatch_best_match_insert AFTER INSERT ON docmatch
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE docmatch_best_match_trigger()
+    """,
+    """
+    CREATE TRIGGER docmatch_best_match_update AFTER UPDATE ON docmatch
+        REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE docmatch_best_match_trigger()
+    """,
+    """
+    CREATE TRIGGER docmatch_best_match_delete AFTER DELETE ON docmatch
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE docmatch_best_match_trigger()
+    """,
+]
+
+for statement in [BEST_MATCH_REFRESH_FUNCTION, BEST_MATCH_TRIGGER_FUNCTION] + BEST_MATCH_TRIGGERS:
+    event.listen(DocMatch.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+
+class DocMatchChange(Base):
+    """
+    log of the bibcodes touched by writes to docmatch since the last cleanup, filled by a trigger on docmatch,
+    so that cleanup can examine only these eprint and pub groups
+    """
+    __tablename__ = 'docmatch_change'
+    id = Column(Integer, primary_key=True)
+    eprint_bibcode = Column(String, nullable=False)
+    pub_bibcode = Column(String, nullable=False)
+    date = Column(DateTime(timezone=True), nullable=False, default=func.now())
+
+
+DOCMATCH_CHANGE_TRIGGER_FUNCTION = """
+CREATE OR REPLACE FUNCTION docmatch_change_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO docmatch_change (eprint_bibcode, pub_bibcode, date) VALUES (OLD.eprint_bibcode, OLD.pub_bibcode, now());
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND (NEW.eprint_bibcode <> OLD.eprint_bibcode OR NEW.pub_bibcode <> OLD.pub_bibcode)) THEN
+        INSERT INTO docmatch_change (eprint_bibcode, pub_bibcode, date) VALUES (NEW.eprint_bibcode, NEW.pub_bibcode, now());
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+DOCMATCH_CHANGE_TRIGGER = """
+CREATE TRIGGER docmatch_change AFTER INSERT OR UPDATE OR DELETE ON docmatch
+    FOR EACH ROW EXECUTE PROCEDURE docmatch_change_trigger()
+"""
+
+for statement in [DOCMATCH_CHANGE_TRIGGER_FUNCTION, DOCMATCH_CHANGE_TRIGGER]:
+    event.listen(DocMatch.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+
+class CleanupJob(Base):
+    """
+    cleanup that is run in the background, with the phase it is in and the counts of each phase
+    """
+    __tablename__ = 'cleanup_job'
+    id = Column(String, primary_key=True)
+    status = Column(String, nullable=False)
+    phase = Column(String)
+    full = Column(Boolean, nullable=False, server_default=false())
+    count_deleted_tmp = Column(Integer, nullable=False, server_default='-1')
+    count_updated_canonical = Column(Integer, nullable=False, server_default='-1')
+    count_deleted_multi_matches = Column(Integer, nullable=False, server_default='-1')
+    message = Column(String)
+    date_created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+    date_finished = Column(DateTime(timezone=True))
+
+    def toJSON(self):
+        """
+
+        :return: values formatted as python dict
+        """
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'phase': self.phase,
+            'full': self.full,
+            'counts': {
+                'count_deleted_tmp': self.count_deleted_tmp,
+                'count_updated_canonical': self.count_updated_canonical,
+                'count_deleted_multi_matches': self.count_deleted_multi_matches,
+            },
+            'message': self.message,
+            'date_created': self.date_created.isoformat() if self.date_created else None,
+            'date_finished': self.date_finished.isoformat() if self.date_finished else None,
+        }
+
+
+class DOIIndex(Base):
+    """
+    dois seen in the records solr returned for matching, with the record, so that matching on doi can skip solr
+    while the entry is fresh, source is `doi` if it is the doi of the record, and `pubnote` if it is the doi
+    in the pubnote of the record, ie. of an eprint pointing to its publication
+    """
+    __tablename__ = 'doi_index'
+    doi = Column(String, primary_key=True)
+    source = Column(String, primary_key=True)
+    bibcode = Column(String, primary_key=True)
+    doctype = Column(String)
+    doc = Column(Text)
+    date = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    def toJSON(self):
+        """
+
+        :return: values formatted as python dict
+        """
+        return {
+            'doi': self.doi,
+            'source': self.source,
+            'bibcode': self.bibcode,
+            'doctype': self.doctype,
+            'date': self.date,
+        }
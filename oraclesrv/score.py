@@ -114,7 +114,31 @@ def get_refereed_score(is_refereed):
         return current_app.config['ORACLE_SERVICE_REFEREED_SCORE']
     return current_app.config['ORACLE_SERVICE_NOT_REFEREED_SCORE']
 
-def get_matches(source_bibcode, doctype, abstract, title, author, year, doi, matched_docs):
+def prune_candidates(abstract, author, doi, matched_docs):
+    """
+    drop the candidates returned without their abstracts that get_matches would discard anyway,
+    those with no matching doi and none of the authors matching, when there is no abstract to compare them on
+
+    :param abstract:
+    :param author:
+    :param doi:
+    :param matched_docs: docs returned by solr without the abstract
+    :return: candidates that are kept, and the number pruned
+    """
+    # with an abstract to compare every candidate can get a confidence
+    if len(abstract) > 0 and not abstract.lower().startswith('not available'):
+        return matched_docs, 0
+    kept = []
+    for doc in matched_docs:
+        match_doi = doc.get('doi', []) + ([doc['doi_pubnote']] if doc.get('doi_pubnote', None) else [])
+        if doi and any(x in doi for x in match_doi):
+            kept.append(doc)
+            continue
+        if get_author_score(author, doc.get('author_norm', [])) > 0:
+            kept.append(doc)
+    return kept, len(matched_docs) - len(kept)
+
+def get_matches(source_bibcode, doctype, abstract, title, author, year, doi, matched_docs, predictor=None):
     """
 
     :param source_bibcode:
@@ -125,8 +149,10 @@ def get_matches(source_bibcode, doctype, abstract, title, author, year, doi, mat
     :param year:
     :param doi:
     :param matched_docs:
+    :param predictor: to predict the confidence with, if not the model itself, ie. one that batches the predictions
     :return:
     """
+    predict = predictor.predict if predictor else confidence_model.predict
     confidence_threshold = current_app.config['ORACLE_SERVICE_CONFIDENCE_THRESHOLD']
     confidence_difference = current_app.config['ORACLE_SERVICE_CONFIDENCE_DIFFERENCE']
     results = []
@@ -179,7 +205,7 @@ def get_matches(source_bibcode, doctype, abstract, title, author, year, doi, mat
         # else check the flag for refereed in the property field
         # if not refereed we want to penalize the confidence score
         match_refereed = True if current_app.config['ORACLE_DOCTYPE_EPRINT'] in doc.get('doctype') else (True if 'REFEREED' in doc.get('property', []) else False)
-        confidence = float(confidence_format % (confidence_model.predict(scores) * get_refereed_score(match_refereed)))
+        confidence = float(confidence_format % (predict(scores) * get_refereed_score(match_refereed)))
 
         # see if either of these bibcodes have already been matched
         prev_match = get_a_record(source_bibcode, match_bibcode)
@@ -0,0 +1,257 @@
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class MemoryBackend(object):
+    """
+    in-process store, least recently used entries are evicted once max_size is reached
+    """
+
+    def __init__(self, max_size):
+        """
+
+        :param max_size:
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+
+        :param key:
+        :return: tuple of value and expiration time, None if not found or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value, expires):
+        """
+
+        :param key:
+        :param value:
+        :param expires: expiration time in seconds since epoch
+        :return:
+        """
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def size(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            return len(self.entries)
+
+
+class SQLiteBackend(object):
+    """
+    store in a sqlite file shared by the worker processes on the same host, expired entries are pruned,
+    and the ones expiring first are evicted once max_size is reached, every prune_interval sets
+    """
+
+    def __init__(self, path, max_size, prune_interval=100):
+        """
+
+        :param path:
+        :param max_size:
+        :param prune_interval:
+        """
+        self.path = path
+        self.max_size = max_size
+        self.prune_interval = prune_interval
+        self.num_sets = 0
+        self.local = threading.local()
+        conn = self.connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS solr_cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_solr_cache_expires ON solr_cache (expires)')
+
+    def connect(self):
+        """
+        one connection per thread, sqlite connections cannot be shared between threads
+
+        :return:
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self.local.conn = conn
+        return conn
+
+    def get(self, key):
+        """
+
+        :param key:
+        :return: tuple of value and expiration time, None if not found or expired
+        """
+        row = self.connect().execute('SELECT value, expires FROM solr_cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0], row[1]
+
+    def set(self, key, value, expires):
+        """
+
+        :param key:
+        :param value:
+        :param expires: expiration time in seconds since epoch
+        :return:
+        """
+        conn = self.connect()
+        conn.execute('INSERT OR REPLACE INTO solr_cache (key, value, expires) VALUES (?, ?, ?)', (key, value, expires))
+        self.num_sets += 1
+        if self.num_sets % self.prune_interval == 0:
+            self.prune()
+
+    def prune(self):
+        """
+        remove the expired entries, and the ones over max_size
+
+        :return:
+        """
+        conn = self.connect()
+        conn.execute('DELETE FROM solr_cache WHERE expires < ?', (time.time(),))
+        conn.execute('DELETE FROM solr_cache WHERE key IN '
+                     '(SELECT key FROM solr_cache ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.max_size,))
+
+    def clear(self):
+        """
+
+        :return:
+        """
+        self.connect().execute('DELETE FROM solr_cache')
+
+    def size(self):
+        """
+
+        :return:
+        """
+        return self.connect().execute('SELECT count(*) FROM solr_cache').fetchone()[0]
+
+
+class SolrCache(object):
+    """
+    caches the results of solr queries for ORACLE_SERVICE_SOLR_CACHE_TTL seconds, keyed on query, fl, and rows,
+    looked up in the in-process store first and then, if configured, in the store shared by the workers on the host,
+    hits and misses are counted per query type
+    """
+
+    def __init__(self, app):
+        """
+
+        :param app:
+        """
+        self.app = app
+        self.ttl = app.config['ORACLE_SERVICE_SOLR_CACHE_TTL']
+        max_size = app.config['ORACLE_SERVICE_SOLR_CACHE_MAX_SIZE']
+        self.backends = [MemoryBackend(max_size)]
+        if app.config['ORACLE_SERVICE_SOLR_CACHE_BACKEND'] == 'local':
+            self.backends.append(SQLiteBackend(app.config['ORACLE_SERVICE_SOLR_CACHE_LOCAL_PATH'], max_size))
+        # the store shared by the workers is on disk, reading and writing it blocks
+        self.is_blocking = len(self.backends) > 1
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    @staticmethod
+    def make_key(query, fl, rows):
+        """
+
+        :param query:
+        :param fl:
+        :param rows:
+        :return:
+        """
+        return hashlib.sha1(json.dumps([query, fl, rows]).encode('utf-8')).hexdigest()
+
+    def record(self, query_type, outcome):
+        """
+        count a hit, miss, or bypass for the query type
+
+        :param query_type:
+        :param outcome:
+        :return:
+        """
+        with self.lock:
+            counts = self.metrics.setdefault(query_type, {'hits': 0, 'misses': 0, 'bypassed': 0})
+            counts[outcome] += 1
+
+    def get(self, query_type, key):
+        """
+
+        :param query_type:
+        :param key:
+        :return: the cached value, None if not in cache
+        """
+        for i, backend in enumerate(self.backends):
+            try:
+                entry = backend.get(key)
+            except sqlite3.Error as e:
+                self.app.logger.warning('unable to read from solr cache: %s' % str(e))
+                entry = None
+            if entry is not None:
+                # keep it in the faster stores for what is left of its ttl
+                for faster in self.backends[:i]:
+                    faster.set(key, entry[0], entry[1])
+                self.record(query_type, 'hits')
+                return json.loads(entry[0])
+        self.record(query_type, 'misses')
+        return None
+
+    def set(self, key, value):
+        """
+
+        :param key:
+        :param value: json serializable, a copy is cached so that the callers can modify what they get back
+        :return:
+        """
+        value = json.dumps(value)
+        expires = time.time() + self.ttl
+        for backend in self.backends:
+            try:
+                backend.set(key, value, expires)
+            except sqlite3.Error as e:
+                self.app.logger.warning('unable to write to solr cache: %s' % str(e))
+
+    def clear(self):
+        """
+
+        :return:
+        """
+        for backend in self.backends:
+            backend.clear()
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            metrics = {query_type: dict(counts) for query_type, counts in self.metrics.items()}
+        for counts in metrics.values():
+            lookups = counts['hits'] + counts['misses']
+            counts['hit_ratio'] = counts['hits'] / lookups if lookups else 0
+        return {'query_types': metrics, 'size': self.backends[0].size()}
@@ -0,0 +1,318 @@
+import time
+import json
+import random
+import threading
+from concurrent.futures import Future
+
+import flask
+import requests
+from requests.adapters import HTTPAdapter
+
+from oraclesrv.db_metrics import Histogram
+
+
+class SolrCircuitOpenError(requests.exceptions.HTTPError):
+    """
+    raised without querying solr while the circuit is open, to the callers it looks like solr returned 503
+    """
+
+    def __init__(self, retry_in):
+        """
+
+        :param retry_in: seconds until solr is tried again
+        """
+        response = requests.models.Response()
+        response.status_code = 503
+        response.reason = 'solr is unavailable, retrying in %d seconds' % retry_in
+        super(SolrCircuitOpenError, self).__init__('solr circuit is open', response=response)
+
+
+class CircuitBreaker(object):
+    """
+    opens after failure_threshold consecutive failures, while open requests are rejected,
+    after reset_timeout seconds one trial request is let through, if it succeeds the circuit is closed again,
+    otherwise it stays open for another reset_timeout seconds
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        """
+
+        :param failure_threshold:
+        :param reset_timeout: in seconds
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.num_failures = 0
+        self.opened_at = 0
+        self.trial_in_progress = False
+        self.num_opened = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        """
+
+        :return: True if the request can be sent
+        """
+        with self.lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN:
+                if self.trial_in_progress:
+                    return False
+                self.trial_in_progress = True
+                return True
+            return self.state == self.CLOSED
+
+    def retry_in(self):
+        """
+
+        :return: seconds until the circuit lets a request through
+        """
+        with self.lock:
+            return max(0, self.opened_at + self.reset_timeout - time.time())
+
+    def record_success(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.state = self.CLOSED
+            self.num_failures = 0
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            self.num_failures += 1
+            self.trial_in_progress = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.num_failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.num_opened += 1
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            return {
+                'state': self.state,
+                'num_consecutive_failures': self.num_failures,
+                'num_opened': self.num_opened,
+            }
+
+
+class SolrClient(object):
+    """
+    sends the queries to solr over one keep-alive pool of connections, with separate connect and read timeouts,
+    retrying with jittered exponential backoff on server errors, timeouts, and connection errors,
+    and failing fast while solr is degraded, identical queries sent at the same time share one request,
+    the queries are counted and timed per query type
+    """
+
+    def __init__(self, app):
+        """
+
+        :param app:
+        """
+        self.url = app.config['ORACLE_SERVICE_SOLRQUERY_URL']
+        self.token = app.config['ORACLE_SERVICE_ADSWS_API_TOKEN']
+        self.timeout = (app.config['ORACLE_SERVICE_SOLRQUERY_CONNECT_TIMEOUT'], app.config['ORACLE_SERVICE_SOLRQUERY_READ_TIMEOUT'])
+        self.retries = app.config['ORACLE_SERVICE_SOLRQUERY_RETRIES']
+        self.retry_delay = app.config['ORACLE_SERVICE_SOLRQUERY_RETRY_DELAY_MS'] / 1000.0
+        self.breaker = CircuitBreaker(app.config['ORACLE_SERVICE_SOLRQUERY_CIRCUIT_FAILURES'],
+                                      app.config['ORACLE_SERVICE_SOLRQUERY_CIRCUIT_RESET_SECONDS'])
+
+        # share the pooled session of the app if enabled, otherwise have a session of its own,
+        # either way solr gets a pool of keep-alive connections sized for the concurrent queries
+        if app.config.get('REQUESTS_CONNECTION_POOL_ENABLED', False) and getattr(app, 'client', None) is not None:
+            self.session = app.client
+        else:
+            self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=app.config['ORACLE_SERVICE_SOLRQUERY_POOL_SIZE'])
+        self.session.mount(self.url, adapter)
+
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+        # queries in flight, keyed on their params, for the identical queries to wait on
+        self.coalesce = app.config.get('ORACLE_SERVICE_SOLRQUERY_COALESCE_ENABLED', True)
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+
+    @staticmethod
+    def make_key(params):
+        """
+
+        :param params:
+        :return:
+        """
+        return json.dumps(params, sort_keys=True)
+
+    def get_headers(self):
+        """
+
+        :return:
+        """
+        headers = {}
+        if flask.has_request_context():
+            # Propagate key information from the original request
+            headers[u'X-Original-Uri'] = flask.request.headers.get(u'X-Original-Uri', u'-')
+            headers[u'X-Original-Forwarded-For'] = flask.request.headers.get(u'X-Original-Forwarded-For', u'-')
+            headers[u'X-Forwarded-For'] = flask.request.headers.get(u'X-Forwarded-For', u'-')
+            headers[u'X-Amzn-Trace-Id'] = flask.request.headers.get(u'X-Amzn-Trace-Id', '-')
+        headers[u'Authorization'] = 'Bearer ' + self.token
+        return headers
+
+    def get_backoff(self, attempt):
+        """
+        seconds to wait before the attempt, doubled for each retry, with jitter so that the retries of
+        concurrent queries are spread out
+
+        :param attempt:
+        :return:
+        """
+        return self.retry_delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+    def check_circuit(self, query_type):
+        """
+        raises SolrCircuitOpenError while the circuit is open, so that solr is not queried,
+        shared with the asyncio client
+
+        :param query_type:
+        :return:
+        """
+        if not self.breaker.allow():
+            self.record(query_type, 'num_rejected')
+            raise SolrCircuitOpenError(self.breaker.retry_in())
+
+    def get_retry_delay(self, attempt, query_type):
+        """
+        count the retry
+
+        :param attempt:
+        :param query_type:
+        :return: seconds to wait before the retry
+        """
+        self.record(query_type, 'num_retries')
+        return self.get_backoff(attempt)
+
+    def should_retry(self, attempt, query_type, failed):
+        """
+        a failed attempt is retried unless it was the last one, the outcome of the last attempt is
+        recorded in the circuit breaker, shared with the asyncio client
+
+        :param attempt:
+        :param query_type:
+        :param failed: True if solr could not be reached, timed out, or returned a server error
+        :return: True if the query is to be sent again
+        """
+        if not failed:
+            self.breaker.record_success()
+            return False
+        if attempt < self.retries:
+            return True
+        self.breaker.record_failure()
+        self.record(query_type, 'num_errors')
+        return False
+
+    def record(self, query_type, name, duration=None):
+        """
+
+        :param query_type:
+        :param name:
+        :param duration: in milliseconds
+        :return:
+        """
+        with self.lock:
+            metrics = self.metrics.get(query_type, None)
+            if metrics is None:
+                metrics = {'num_queries': 0, 'num_errors': 0, 'num_retries': 0, 'num_rejected': 0, 'num_coalesced': 0, 'latency': Histogram()}
+                self.metrics[query_type] = metrics
+            metrics[name] += 1
+        if duration is not None:
+            metrics['latency'].observe(duration)
+
+    def query(self, params, query_type='other'):
+        """
+        if the same query is already in flight, wait for its response instead of sending it again
+
+        :param params:
+        :param query_type:
+        :return: response, if solr still returns a server error after the last retry that response is returned,
+                 raises SolrCircuitOpenError if the circuit is open, or the exception of the last retry
+        """
+        if not self.coalesce:
+            return self.send(params, query_type)
+
+        key = self.make_key(params)
+        with self.in_flight_lock:
+            call = self.in_flight.get(key, None)
+            leader = call is None
+            if leader:
+                call = Future()
+                self.in_flight[key] = call
+        if not leader:
+            self.record(query_type, 'num_coalesced')
+            return call.result()
+
+        try:
+            response = self.send(params, query_type)
+        except BaseException as e:
+            with self.in_flight_lock:
+                del self.in_flight[key]
+            call.set_exception(e)
+            raise
+        with self.in_flight_lock:
+            del self.in_flight[key]
+        call.set_result(response)
+        return response
+
+    def send(self, params, query_type='other'):
+        """
+
+        :param params:
+        :param query_type:
+        :return: response, if solr still returns a server error after the last retry that response is returned,
+                 raises SolrCircuitOpenError if the circuit is open, or the exception of the last retry
+        """
+        self.check_circuit(query_type)
+
+        headers = self.get_headers()
+        start_time = time.time()
+        try:
+            for attempt in range(self.retries + 1):
+                if attempt > 0:
+                    time.sleep(self.get_retry_delay(attempt, query_type))
+                try:
+                    response = self.session.get(url=self.url, headers=headers, params=params, timeout=self.timeout)
+                except requests.exceptions.RequestException:
+                    if self.should_retry(attempt, query_type, failed=True):
+                        continue
+                    raise
+                if self.should_retry(attempt, query_type, failed=response.status_code >= 500):
+                    continue
+                return response
+        finally:
+            self.record(query_type, 'num_queries', (time.time() - start_time) * 1000)
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            metrics = {query_type: dict(counts) for query_type, counts in self.metrics.items()}
+        for counts in metrics.values():
+            counts['latency'] = counts['latency'].get_metrics()
+        return {'circuit': self.breaker.get_metrics(), 'query_types': metrics}
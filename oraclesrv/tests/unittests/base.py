@@ -3,12 +3,17 @@ project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../..
 if project_home not in sys.path:
     sys.path.insert(0, project_home)
 
+import unittest
 from flask_testing import TestCase
 import testing.postgresql
 from oraclesrv import app
 from oraclesrv.models import Base
 
 TestCase.maxDiff = None
+
+# the benchmarks are long running, and are not part of the unit tests, set ORACLE_SERVICE_RUN_BENCHMARKS to run them
+benchmark = unittest.skipUnless(os.environ.get('ORACLE_SERVICE_RUN_BENCHMARKS'), 'set ORACLE_SERVICE_RUN_BENCHMARKS to run the benchmarks')
+
 class TestCaseDatabase(TestCase):
     """
     Base test class for when databases are being used.
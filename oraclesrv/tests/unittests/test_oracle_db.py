@@ -5,20 +5,33 @@ if project_home not in sys.path:
 
 import unittest
 import json
+import tempfile
+import time
 import mock
 import requests
-from datetime import datetime
+from datetime import timedelta
 
 from adsmutils import get_date
 from adsmsg import DocMatchRecordList
 
-from oraclesrv.tests.unittests.base import TestCaseDatabase
+from oraclesrv.tests.unittests.base import TestCaseDatabase, benchmark
 from oraclesrv.utils import get_a_record, del_records, add_a_record, query_docmatch, query_source_score, lookup_confidence, \
     get_a_matched_record, query_docmatch, query_source_score, lookup_confidence, delete_tmp_matches, replace_tmp_with_canonical, \
-    delete_multi_matches, clean_db, get_tmp_bibcodes, get_muti_matches, add_records, get_solr_data_chunk, is_eprint_bibcode
+    delete_multi_matches, clean_db, get_tmp_bibcodes, get_muti_matches, add_records, get_solr_data_chunk, is_eprint_bibcode, \
+    export_docmatch, bulk_add_records, check_best_match, get_docmatch_changes, add_cleanup_job, update_cleanup_job, \
+    get_cleanup_job, count_tmp_bibcodes, stream_tmp_bibcodes, add_doi_index, lookup_doi_index, \
+    load_doi_index
+from oraclesrv.ingest import read_matches, ingest
+from oraclesrv.utils import add_matches
+from oraclesrv.write_behind import WriteBehind
+from oraclesrv.jobs import run_cleanup_job
+from oraclesrv.app import create_read_session_scope
+from oraclesrv.db_metrics import query_metrics, Histogram
+from oraclesrv.solr_client import SolrClient
 from oraclesrv.score import get_matches, get_doi_match
-from oraclesrv.models import DocMatch, ConfidenceLookup, EPrintBibstemLookup
+from oraclesrv.models import DocMatch, ConfidenceLookup, EPrintBibstemLookup, BestMatch, DocMatchChange, CleanupJob, DOIIndex
 
+from sqlalchemy import event, func, or_, and_, distinct
 from sqlalchemy.exc import SQLAlchemyError
 
 
@@ -71,6 +84,9 @@ class TestDatabase(TestCaseDatabase):
 
         with self.current_app.session_scope() as session:
             session.query(DocMatch).delete()
+            session.query(BestMatch).delete()
+            session.query(DocMatchChange).delete()
+            session.query(CleanupJob).delete()
             session.commit()
 
     def add_confidence_lookup_data(self):
@@ -132,6 +148,122 @@ class TestDatabase(TestCaseDatabase):
         record = get_a_record('2021arXiv210312030G', '2021CSF...15311505G')
         self.assertEqual(record, {})
 
+    def test_add_a_record(self):
+        """
+        test upserting a record, with the conflict rules on confidence
+        """
+        self.add_eprint_bibstem_lookup_data()
+
+        match = {'source_bibcode': '2021arXiv210312030S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.9}
+        self.assertEqual(add_a_record(match), (True, 'updated db with a new record successfully'))
+        # same record again is a no-op
+        self.assertEqual(add_a_record(match), (True, 'record already in db'))
+        # lower confidence is a no-op
+        match['confidence'] = 0.8
+        self.assertEqual(add_a_record(match), (True, 'record already in db'))
+        self.assertEqual(get_a_record('2021arXiv210312030S', '2021CSF...15311505S')['confidence'], 0.9)
+        # higher confidence gets updated
+        match['confidence'] = 0.9829099
+        self.assertEqual(add_a_record(match), (True, 'updated confidence of the record in db successfully'))
+        self.assertEqual(get_a_record('2021arXiv210312030S', '2021CSF...15311505S')['confidence'], 0.9829099)
+
+        # match that has been marked incorrect is never updated
+        match = {'source_bibcode': '2017arXiv171111082H', 'matched_bibcode': '2018ConPh..59...16H', 'confidence': -1}
+        self.assertEqual(add_a_record(match), (True, 'updated db with a new record successfully'))
+        match['confidence'] = 0.9877064
+        self.assertEqual(add_a_record(match), (True, 'record already in db'))
+        self.assertEqual(get_a_record('2017arXiv171111082H', '2018ConPh..59...16H')['confidence'], -1)
+
+    def test_add_matches(self):
+        """
+        test upserting a batch of matches from docmatching
+        """
+        self.add_eprint_bibstem_lookup_data()
+
+        matches = [
+            ({'source_bibcode': '2021arXiv210312030S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.9829099}, 'eprint'),
+            ({'source_bibcode': '2018ConPh..59...16H', 'matched_bibcode': '2017arXiv171111082H', 'confidence': 0.9877064}, 'article'),
+            ({'source_bibcode': '2021arXiv210312030S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.5}, 'eprint'),
+            ({'source_bibcode': '2017EaarX....2FDCTH', 'matched_bibcode': '2018Litho.314..360H', 'confidence': 0.9}, None),
+        ]
+        self.assertEqual(add_matches(matches), (True, 2, 'added or updated 2 records of 4 requested'))
+        self.assertEqual(get_a_record('2021arXiv210312030S', '2021CSF...15311505S')['confidence'], 0.9829099)
+        self.assertEqual(get_a_record('2017arXiv171111082H', '2018ConPh..59...16H')['confidence'], 0.9877064)
+
+        # same batch again, nothing changes
+        self.assertEqual(add_matches(matches), (True, 0, 'added or updated 0 records of 4 requested'))
+
+        self.assertEqual(add_matches([]), (True, 0, 'no records to add to the database'))
+
+    def test_write_behind(self):
+        """
+        test queueing matches and flushing them to db in the background
+        """
+        self.add_eprint_bibstem_lookup_data()
+
+        self.current_app.config['ORACLE_SERVICE_WRITE_BEHIND_QUEUE_SIZE'] = 2
+        self.current_app.config['ORACLE_SERVICE_WRITE_BEHIND_BATCH_SIZE'] = 10
+        self.current_app.config['ORACLE_SERVICE_WRITE_BEHIND_FLUSH_INTERVAL_MS'] = 60000
+        write_behind = WriteBehind(self.current_app)
+
+        self.assertTrue(write_behind.put({'source_bibcode': '2021arXiv210312030S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.9829099}, 'eprint'))
+        self.assertTrue(write_behind.put({'source_bibcode': '2017arXiv171111082H', 'matched_bibcode': '2018ConPh..59...16H', 'confidence': 0.9877064}, 'eprint'))
+        # queue is full
+        self.assertFalse(write_behind.put({'source_bibcode': '2018arXiv181105526S', 'matched_bibcode': '2022NuPhB.98015830S', 'confidence': 0.97300124}, 'eprint'))
+        self.assertEqual(write_behind.get_metrics()['queue_depth'], 2)
+
+        # not flushed yet, since neither the batch size nor the interval has been reached
+        self.assertEqual(get_a_record('2021arXiv210312030S', '2021CSF...15311505S'), {})
+
+        # it is flushed on shutdown
+        write_behind.start()
+        write_behind.stop()
+        self.assertEqual(get_a_record('2021arXiv210312030S', '2021CSF...15311505S')['confidence'], 0.9829099)
+        self.assertEqual(get_a_record('2017arXiv171111082H', '2018ConPh..59...16H')['confidence'], 0.9877064)
+
+        metrics = write_behind.get_metrics()
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['num_queued'], 2)
+        self.assertEqual(metrics['num_rejected'], 1)
+        self.assertEqual(metrics['num_flushes'], 1)
+        self.assertEqual(metrics['num_saved'], 2)
+        self.assertEqual(metrics['num_flush_errors'], 0)
+
+    def test_write_behind_flush_error(self):
+        """
+        test a batch that fails to save being retried, and saved one match at a time if it still fails
+        """
+        self.add_eprint_bibstem_lookup_data()
+
+        self.current_app.config['ORACLE_SERVICE_WRITE_BEHIND_RETRIES'] = 2
+        self.current_app.config['ORACLE_SERVICE_WRITE_BEHIND_RETRY_DELAY_MS'] = 1
+        write_behind = WriteBehind(self.current_app)
+        batch = [({'source_bibcode': '2021arXiv210312030S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.9829099}, 'eprint'),
+                 ({'source_bibcode': '2017arXiv171111082H', 'matched_bibcode': '2018ConPh..59...16H', 'confidence': 0.9877064}, 'eprint')]
+
+        # db is back on the retry
+        with mock.patch('oraclesrv.write_behind.add_matches', side_effect=[(False, -1, 'SQLAlchemy: connection lost'), (True, 2, 'added')]) as mock_add_matches:
+            self.assertTrue(write_behind.flush(batch))
+            self.assertEqual(mock_add_matches.call_count, 2)
+        metrics = write_behind.get_metrics()
+        self.assertEqual((metrics['num_flush_retries'], metrics['num_saved'], metrics['num_flush_errors']), (1, 2, 0))
+
+        # batch keeps failing, the matches are saved one at a time
+        with mock.patch('oraclesrv.write_behind.add_matches', return_value=(False, -1, 'SQLAlchemy: connection lost')) as mock_add_matches:
+            self.assertFalse(write_behind.flush(batch))
+            self.assertEqual(mock_add_matches.call_count, 3)
+        self.assertEqual(get_a_record('2021arXiv210312030S', '2021CSF...15311505S')['confidence'], 0.9829099)
+        self.assertEqual(get_a_record('2017arXiv171111082H', '2018ConPh..59...16H')['confidence'], 0.9877064)
+        metrics = write_behind.get_metrics()
+        self.assertEqual((metrics['num_flush_retries'], metrics['num_flush_errors'], metrics['num_saved_one_at_a_time'], metrics['num_lost']), (3, 1, 2, 0))
+
+        # db is down, the matches that could not be saved are counted as lost
+        with mock.patch('oraclesrv.write_behind.add_matches', side_effect=Exception('db is down')), \
+             mock.patch('oraclesrv.write_behind.add_a_record', side_effect=[(True, 'updated db with a new record successfully'), (False, 'SQLAlchemy: db is down')]):
+            self.assertFalse(write_behind.flush(batch))
+        metrics = write_behind.get_metrics()
+        self.assertEqual((metrics['num_flush_errors'], metrics['num_saved_one_at_a_time'], metrics['num_lost']), (2, 3, 1))
+
     def test_delete_endpoint(self):
         """
         test deleting records from db
@@ -343,6 +475,134 @@ class TestDatabase(TestCaseDatabase):
         self.assertEqual(status_code, 200)
         self.assertEqual(result, [])
 
+    def test_export_docmatch(self):
+        """
+        Test export_docmatch returns the same records as paging through query_docmatch
+        """
+        self.add_docmatch_data()
+
+        # add a lower confidence match for one of the pub bibcodes, that should not get exported
+        add_a_record({'source_bibcode': '2021arXiv210312031S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.5})
+
+        expected_results, status_code = query_docmatch({'start': 0, 'rows': 10, 'date_cutoff': get_date('1972/01/01 00:00:00')})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(len(expected_results), 3)
+        self.assertEqual(list(export_docmatch(get_date('1972/01/01 00:00:00'))), expected_results)
+
+        # nothing is returned when the cutoff is in the future
+        self.assertEqual(list(export_docmatch(get_date('2972/01/01 00:00:00'))), [])
+
+        # error is raised, so that the export is not taken as complete
+        with mock.patch.object(self.current_app, 'session_scope') as exception_mock:
+            exception_mock.side_effect = SQLAlchemyError('DB not initialized properly, check: SQLALCHEMY_URL')
+            with self.assertRaises(SQLAlchemyError):
+                list(export_docmatch(get_date('1972/01/01 00:00:00')))
+
+    def test_best_match(self):
+        """
+        Test best_match is kept in sync with docmatch when records are added, updated, and deleted
+        """
+        self.add_docmatch_data()
+        date_cutoff = get_date('1972/01/01 00:00:00')
+
+        def get_best_matches():
+            with self.current_app.session_scope() as session:
+                return sorted([(r.eprint_bibcode, r.pub_bibcode, r.confidence) for r in session.query(BestMatch).all()])
+
+        self.assertEqual(get_best_matches(), [
+            ('2017arXiv171111082H', '2018ConPh..59...16H', 0.9877064),
+            ('2018arXiv181105526S', '2022NuPhB.98015830S', 0.97300124),
+            ('2021arXiv210312030S', '2021CSF...15311505S', 0.9829099),
+        ])
+
+        # a higher confidence match for one of the pub bibcodes replaces the best match
+        add_a_record({'source_bibcode': '2021arXiv210312031S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.99})
+        self.assertIn(('2021arXiv210312031S', '2021CSF...15311505S', 0.99), get_best_matches())
+        self.assertNotIn(('2021arXiv210312030S', '2021CSF...15311505S', 0.9829099), get_best_matches())
+
+        # a lower confidence match does not
+        add_a_record({'source_bibcode': '2018arXiv181105527S', 'matched_bibcode': '2022NuPhB.98015830S', 'confidence': 0.5})
+        self.assertIn(('2018arXiv181105526S', '2022NuPhB.98015830S', 0.97300124), get_best_matches())
+        self.assertEqual(len(get_best_matches()), 3)
+
+        # deleting the best match, brings back the next best
+        docmatch_records = {
+            'status': 2,
+            'docmatch_records': [{'source_bibcode': '2021arXiv210312031S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.99}]
+        }
+        status, _ = del_records(DocMatchRecordList(**docmatch_records))
+        self.assertEqual(status, True)
+        self.assertIn(('2021arXiv210312030S', '2021CSF...15311505S', 0.9829099), get_best_matches())
+
+        # query and export read from best_match
+        result, status_code = query_docmatch({'start': 0, 'rows': 10, 'date_cutoff': date_cutoff})
+        self.assertEqual(status_code, 200)
+        self.assertEqual(sorted(result), get_best_matches())
+        self.assertEqual(list(export_docmatch(date_cutoff)), result)
+
+        # in sync
+        self.assertEqual(check_best_match(), (True, {'missing': 0, 'extra': 0}, 'best_match is in sync'))
+
+        # get it out of sync, and rebuild it
+        with self.current_app.session_scope() as session:
+            session.query(BestMatch).filter(BestMatch.pub_bibcode == '2018ConPh..59...16H').delete(synchronize_session=False)
+            session.add(BestMatch(pub_bibcode='2022ApJ...935...54R', eprint_bibcode='2022arXiv220700058R', confidence=0.9, date=get_date()))
+            session.commit()
+        self.assertEqual(check_best_match(),
+                         (False, {'missing': 1, 'extra': 1}, 'best_match is out of sync, 1 records are missing and 1 are extra'))
+        self.assertEqual(check_best_match(rebuild=True),
+                         (True, {'missing': 1, 'extra': 1}, 'rebuilt best_match, 1 records were missing and 1 were extra'))
+        self.assertEqual(check_best_match(), (True, {'missing': 0, 'extra': 0}, 'best_match is in sync'))
+
+        # one statement touching many rows of the same pub_bibcode, refreshes it once with the highest of them
+        status, count, _ = add_matches([({'source_bibcode': '2022arXiv220700001T', 'matched_bibcode': '2022Test......1A', 'confidence': 0.6}, 'eprint'),
+                                        ({'source_bibcode': '2022arXiv220700002T', 'matched_bibcode': '2022Test......1A', 'confidence': 0.8}, 'eprint'),
+                                        ({'source_bibcode': '2022arXiv220700003T', 'matched_bibcode': '2022Test......2A', 'confidence': 0.7}, 'eprint')])
+        self.assertEqual((status, count), (True, 3))
+        self.assertIn(('2022arXiv220700002T', '2022Test......1A', 0.8), get_best_matches())
+        self.assertNotIn(('2022arXiv220700001T', '2022Test......1A', 0.6), get_best_matches())
+        self.assertIn(('2022arXiv220700003T', '2022Test......2A', 0.7), get_best_matches())
+
+        # pub_bibcode changed, both the old and the new are refreshed
+        with self.current_app.session_scope() as session:
+            session.query(DocMatch).filter(DocMatch.pub_bibcode == '2022Test......2A') \
+                .update({DocMatch.pub_bibcode: '2022Test......1A'}, synchronize_session=False)
+            session.commit()
+        self.assertIn(('2022arXiv220700002T', '2022Test......1A', 0.8), get_best_matches())
+        self.assertFalse(any(pub_bibcode == '2022Test......2A' for _, pub_bibcode, _ in get_best_matches()))
+        self.assertEqual(check_best_match(), (True, {'missing': 0, 'extra': 0}, 'best_match is in sync'))
+
+        # error
+        with mock.patch.object(self.current_app, 'session_scope') as exception_mock:
+            exception_mock.side_effect = SQLAlchemyError('DB not initialized properly, check: SQLALCHEMY_URL')
+            self.assertEqual(check_best_match(), (False, {}, 'SQLAlchemy: DB not initialized properly, check: SQLALCHEMY_URL'))
+
+    def test_read_session_scope(self):
+        """
+        Test read only queries are sent to the read replica when configured, and to the primary when the replica cannot be reached
+        """
+        self.add_docmatch_data()
+        params = {'start': 0, 'rows': 10, 'date_cutoff': get_date('1972/01/01 00:00:00')}
+
+        # use the test db as the replica
+        self.current_app.config['SQLALCHEMY_READ_REPLICA_URI'] = self.postgresql_url
+        self.current_app.read_session_scope = create_read_session_scope(self.current_app)
+        with mock.patch.object(self.current_app, 'session_scope') as primary_mock:
+            result, status_code = query_docmatch(params)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(len(result), 3)
+            self.assertEqual(get_a_record('2021arXiv210312030S', '2021CSF...15311505S')['confidence'], 0.9829099)
+            primary_mock.assert_not_called()
+
+        # replica that cannot be reached
+        self.current_app.config['SQLALCHEMY_READ_REPLICA_URI'] = 'postgresql://postgres@127.0.0.1:1/test'
+        self.current_app.read_session_scope = create_read_session_scope(self.current_app)
+        result, status_code = query_docmatch(params)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(len(result), 3)
+
+        self.current_app.read_session_scope = None
+
     def test_query_source_score(self):
         """
 
@@ -394,6 +654,82 @@ class TestDatabase(TestCaseDatabase):
         result = json.loads(r.data)
         self.assertEqual(result['confidence'], -1.0)
 
+    def test_confidence_lookup_cache(self):
+        """
+        Test confidence_lookup is read from db once and served from the cache after, until it expires
+        """
+        self.add_confidence_lookup_data()
+        self.assertEqual(lookup_confidence('ADS'), (1.3, 200))
+
+        # cached, db is not queried
+        with mock.patch.object(self.current_app, 'session_scope') as session_mock:
+            self.assertEqual(lookup_confidence('publisher'), (1.1, 200))
+            self.assertEqual(lookup_confidence('unknown'), (0, 400))
+            self.assertEqual(len(query_source_score()[0]), 5)
+            session_mock.assert_not_called()
+
+        # change the table, still cached until expired
+        with self.current_app.session_scope() as session:
+            session.query(ConfidenceLookup).filter(ConfidenceLookup.source == 'ADS').update({'confidence': 1.4})
+            session.commit()
+        self.assertEqual(lookup_confidence('ADS'), (1.3, 200))
+        expired = time.time() + self.current_app.config['ORACLE_SERVICE_CONFIDENCE_LOOKUP_CACHE_TTL'] + 1
+        with mock.patch('oraclesrv.utils.time.time', return_value=expired):
+            self.assertEqual(lookup_confidence('ADS'), (1.4, 200))
+
+        # not cached
+        self.current_app.config['ORACLE_SERVICE_CONFIDENCE_LOOKUP_CACHE_TTL'] = 0
+        self.assertEqual(lookup_confidence('ADS'), (1.4, 200))
+        with self.current_app.session_scope() as session:
+            session.query(ConfidenceLookup).filter(ConfidenceLookup.source == 'ADS').update({'confidence': 1.3})
+            session.commit()
+        self.assertEqual(lookup_confidence('ADS'), (1.3, 200))
+
+    def test_confidence_lookup_endpoints_conditional(self):
+        """
+        Test source_score and confidence endpoints return ETag and Cache-Control, and 304 when the client has the response already
+        """
+        self.add_confidence_lookup_data()
+        for path in ['/source_score', '/confidence/ADS']:
+            r = self.client.get(path=path)
+            self.assertEqual(r.status_code, 200)
+            etag = r.headers['ETag']
+            self.assertTrue(etag)
+            self.assertEqual(r.headers['Cache-Control'], 'public, max-age=%d' % self.current_app.config['ORACLE_SERVICE_CONFIDENCE_LOOKUP_CACHE_TTL'])
+
+            r = self.client.get(path=path, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(r.data, b'')
+
+            r = self.client.get(path=path, headers={'If-None-Match': '"something else"'})
+            self.assertEqual(r.status_code, 200)
+
+        # no caching headers for errors
+        r = self.client.get(path='/confidence/unknown')
+        self.assertEqual(r.status_code, 400)
+        self.assertNotIn('ETag', r.headers)
+
+    def test_timed_query(self):
+        """
+        Test the db helper functions, including the generators, are timed
+        """
+        self.add_docmatch_data()
+        count = query_metrics.get_metrics().get('export_docmatch', {}).get('count', 0)
+        self.assertEqual(len(list(export_docmatch(get_date('1972/01/01 00:00:00')))), 3)
+        self.assertEqual(query_metrics.get_metrics()['export_docmatch']['count'], count + 1)
+
+        # the functions that query db are timed, the ones that do not are not
+        count = query_metrics.get_metrics().get('delete_tmp_matches', {}).get('count', 0)
+        delete_tmp_matches(['2021arXiv210312030S'])
+        self.assertEqual(query_metrics.get_metrics()['delete_tmp_matches']['count'], count + 1)
+        self.assertNotIn('get_bibcode_chunks', query_metrics.get_metrics())
+
+        histogram = Histogram(buckets=[1, 10])
+        for duration in [0.5, 1, 5, 20]:
+            histogram.observe(duration)
+        self.assertEqual(histogram.get_metrics(), {'count': 4, 'sum_ms': 26.5, 'max_ms': 20, 'avg_ms': 6.625,
+                                                   'buckets_ms': {'1': 2, '10': 1, '+inf': 1}})
+
     def test_get_solr_data_exception(self):
         """
         Test when there is an SQLAlchemyError exception
@@ -458,6 +794,15 @@ class TestDatabase(TestCaseDatabase):
             self.assertEqual(results, None)
             self.assertEqual(message, 'SQLAlchemy: DB not initialized properly, check: SQLALCHEMY_URL')
 
+            # exception within count_tmp_bibcodes
+            results, message = count_tmp_bibcodes()
+            self.assertEqual(results, None)
+            self.assertEqual(message, 'SQLAlchemy: DB not initialized properly, check: SQLALCHEMY_URL')
+
+            # exception within stream_tmp_bibcodes
+            with self.assertRaises(SQLAlchemyError):
+                list(stream_tmp_bibcodes())
+
             # exception within get_muti_matches
             results, message = get_muti_matches()
             self.assertEqual(results, None)
@@ -632,6 +977,46 @@ class TestDatabase(TestCaseDatabase):
         self.assertEqual(record['pub_bibcode'], '2023MNRAS.523.4624V')
         self.assertEqual(record['confidence'], 0.9942136)
 
+    @benchmark
+    def test_replace_tmp_with_canonical_benchmark(self):
+        """
+        Test replace_tmp_with_canonical with 50k tmp bibcodes against a stand-in solr,
+        every tenth eprint is also matched with the canonical bibcode already and so is marked as delete
+        """
+        self.add_eprint_bibstem_lookup_data()
+        self.add_confidence_lookup_data()
+
+        num_tmps = 50000
+        def get_tmp_bibcode(i):
+            return '2023MNRAS.tmp.%04d%s' % (i % 10000, 'ABCDE'[i // 10000])
+        def get_canonical_bibcode(tmp_bibcode):
+            return tmp_bibcode.replace('.tmp.', '.999.')
+
+        rows = []
+        for i in range(num_tmps):
+            rows.append({'eprint_bibcode': '2023arXiv%09dK' % i, 'pub_bibcode': get_tmp_bibcode(i), 'confidence': 0.99})
+            if i % 10 == 0:
+                rows.append({'eprint_bibcode': '2023arXiv%09dK' % i, 'pub_bibcode': get_canonical_bibcode(get_tmp_bibcode(i)), 'confidence': 0.99})
+        status, counts, _ = bulk_add_records(rows)
+        self.assertEqual(status, True)
+
+        def solr(bibcodes, fl='bibcode, identifier'):
+            return [{'bibcode': get_canonical_bibcode(bibcode), 'identifier': [bibcode, get_canonical_bibcode(bibcode)]}
+                    for bibcode in bibcodes], 200
+
+        with mock.patch('oraclesrv.utils.get_solr_data_chunk', side_effect=solr):
+            start_time = time.time()
+            status, count, message = replace_tmp_with_canonical()
+            duration = time.time() - start_time
+        print('replace_tmp_with_canonical of %d tmp bibcodes took %.2f seconds' % (num_tmps, duration))
+        self.assertEqual(status, True)
+        self.assertEqual(count, num_tmps)
+
+        with self.current_app.session_scope() as session:
+            self.assertEqual(session.query(DocMatch).filter(DocMatch.pub_bibcode.like('%.tmp.%'), DocMatch.confidence != -1).count(), 0)
+            self.assertEqual(session.query(DocMatch).filter(DocMatch.confidence == -1).count(), num_tmps // 10)
+            self.assertEqual(session.query(DocMatch).filter(DocMatch.pub_bibcode.like('%.999.%')).count(), num_tmps)
+
     @mock.patch('oraclesrv.utils.lookup_confidence')
     @mock.patch('oraclesrv.utils.query_eprint_bibstem')
     def test_replace_tmp_with_canonical_error(self, mock_query_eprint_bibstem, mock_lookup_confidence):
@@ -808,6 +1193,162 @@ class TestDatabase(TestCaseDatabase):
         self.assertEqual(counts, {'count_deleted_tmp': 0, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 0})
         self.assertEqual(status, '')
 
+    def test_clean_db_incremental(self):
+        """
+        Test clean_db only examines the bibcodes changed since the last cleanup, unless full is set
+        """
+        self.add_docmatch_data()
+
+        # writes are logged
+        change_ids, eprint_bibcodes, pub_bibcodes = get_docmatch_changes()
+        self.assertEqual(len(change_ids), 3)
+        self.assertEqual(eprint_bibcodes, {'2021arXiv210312030S', '2017arXiv171111082H', '2018arXiv181105526S'})
+        self.assertEqual(pub_bibcodes, {'2021CSF...15311505S', '2018ConPh..59...16H', '2022NuPhB.98015830S'})
+
+        # cleanup consumes the log
+        counts, status = clean_db()
+        self.assertEqual(counts, {'count_deleted_tmp': 0, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 0})
+        self.assertEqual(status, '')
+        self.assertEqual(get_docmatch_changes(), ([], set(), set()))
+
+        # add a multi match directly, bypassing the log, the incremental cleanup does not see it
+        with self.current_app.session_scope() as session:
+            session.add(DocMatch('2021arXiv210312031S', '2021CSF...15311505S', 0.5, [
+                {'name': 'arXiv', 'pattern': r'^(\d\d\d\d(?:arXiv))'},
+                {'name': 'Earth Science', 'pattern': r'^(\d\d\d\d(?:EaArX|esoar))'}]))
+            session.commit()
+            session.query(DocMatchChange).delete()
+            session.commit()
+        counts, status = clean_db()
+        self.assertEqual(counts['count_deleted_multi_matches'], 0)
+
+        # but the full sweep does
+        counts, status = clean_db(full=True)
+        self.assertEqual(counts['count_deleted_multi_matches'], 1)
+        with self.current_app.session_scope() as session:
+            self.assertEqual(session.query(DocMatch).filter(DocMatch.eprint_bibcode == '2021arXiv210312031S').count(), 0)
+
+        # a logged multi match is removed by the incremental cleanup
+        add_a_record({'source_bibcode': '2017arXiv171111083H', 'matched_bibcode': '2018ConPh..59...16H', 'confidence': 0.5})
+        counts, status = clean_db()
+        self.assertEqual(counts, {'count_deleted_tmp': 0, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 1})
+        with self.current_app.session_scope() as session:
+            self.assertEqual(session.query(DocMatch).filter(DocMatch.eprint_bibcode == '2017arXiv171111083H').count(), 0)
+
+        # error reading the log
+        with mock.patch('oraclesrv.utils.get_docmatch_changes', return_value=(None, None, None)):
+            counts, status = clean_db()
+            self.assertEqual(counts, {'count_deleted_tmp': -1, 'count_updated_canonical': -1, 'count_deleted_multi_matches': -1})
+            self.assertEqual(status, 'unable to read the list of changes')
+
+    def test_clean_db_change_during_cleanup(self):
+        """
+        Test clean_db examines for tmp matches the changes committed while replace_tmp_with_canonical was running,
+        and does not remove the changes it has not read
+        """
+        self.add_docmatch_data()
+        clean_db()
+
+        def replace_tmp_with_canonical():
+            # a write made meanwhile, tmp and canonical matched against the same eprint
+            add_a_record({'source_bibcode': '2023arXiv230410160K', 'matched_bibcode': '2023MNRAS.tmp.1147K', 'confidence': 0.9957017})
+            add_a_record({'source_bibcode': '2023arXiv230410160K', 'matched_bibcode': '2023MNRAS.522.3648K', 'confidence': 0.9957017})
+            return True, 0, ''
+
+        with mock.patch('oraclesrv.utils.replace_tmp_with_canonical', side_effect=replace_tmp_with_canonical):
+            counts, status = clean_db()
+        self.assertEqual(counts, {'count_deleted_tmp': 1, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 0})
+        self.assertEqual(status, '')
+        with self.current_app.session_scope() as session:
+            self.assertEqual(session.query(DocMatch).filter(DocMatch.pub_bibcode == '2023MNRAS.tmp.1147K').count(), 0)
+            self.assertEqual(session.query(DocMatch).filter(DocMatch.pub_bibcode == '2023MNRAS.522.3648K').count(), 1)
+
+        # the change logged by removing the tmp match was read after the second read, so it is kept for the next run
+        change_ids, eprint_bibcodes, pub_bibcodes = get_docmatch_changes()
+        self.assertEqual(eprint_bibcodes, {'2023arXiv230410160K'})
+        self.assertEqual(pub_bibcodes, {'2023MNRAS.tmp.1147K'})
+
+        # changes already read are skipped
+        self.assertEqual(get_docmatch_changes(exclude_ids=change_ids), ([], set(), set()))
+
+    def test_clean_db_chunks(self):
+        """
+        Test delete_tmp_matches and delete_multi_matches send the bibcodes to db in chunks
+        """
+        self.add_docmatch_data()
+        self.current_app.config['ORACLE_SERVICE_CLEANUP_CHUNK_SIZE'] = 2
+
+        matches = [
+            {'source_bibcode': '2023arXiv230410160K', 'matched_bibcode': '2023MNRAS.tmp.1147K', 'confidence': 0.9957017},
+            {'source_bibcode': '2023arXiv230410160K', 'matched_bibcode': '2023MNRAS.522.3648K', 'confidence': 0.9957017},
+            {'source_bibcode': '2023arXiv230410161K', 'matched_bibcode': '2023MNRAS.tmp.1148K', 'confidence': 0.9957017},
+            {'source_bibcode': '2023arXiv230410161K', 'matched_bibcode': '2023MNRAS.522.3649K', 'confidence': 0.9957017},
+            {'source_bibcode': '2023arXiv230410162K', 'matched_bibcode': '2023MNRAS.tmp.1149K', 'confidence': 0.9957017},
+            {'source_bibcode': '2023arXiv230410162K', 'matched_bibcode': '2023MNRAS.522.3650K', 'confidence': 0.9957017},
+        ]
+        for match in matches:
+            add_a_record(match)
+        eprint_bibcodes = {'2023arXiv230410160K', '2023arXiv230410161K', '2023arXiv230410162K'}
+        status, count, message = delete_tmp_matches(eprint_bibcodes)
+        self.assertEqual(status, True)
+        self.assertEqual(count, 3)
+
+        # lower confidence matches of the eprints and of the pubs
+        add_a_record({'source_bibcode': '2021arXiv210312031S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.5})
+        add_a_record({'source_bibcode': '2017arXiv171111083H', 'matched_bibcode': '2018ConPh..59...16H', 'confidence': 0.5})
+        add_a_record({'source_bibcode': '2018arXiv181105527S', 'matched_bibcode': '2022NuPhB.98015830S', 'confidence': 0.5})
+        pub_bibcodes = {'2021CSF...15311505S', '2018ConPh..59...16H', '2022NuPhB.98015830S'}
+        status, count, message = delete_multi_matches(set(), pub_bibcodes)
+        self.assertEqual(status, True)
+        self.assertEqual(count, 3)
+
+    def test_run_cleanup_job(self):
+        """
+        Test run_cleanup_job records the phases and counts of clean_db in the job
+        """
+        self.add_docmatch_data()
+        add_a_record({'source_bibcode': '2017arXiv171111083H', 'matched_bibcode': '2018ConPh..59...16H', 'confidence': 0.5})
+
+        job_id = add_cleanup_job()
+        job, status_code = get_cleanup_job(job_id)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(job['status'], 'queued')
+
+        phases = []
+        def progress(phase, counts):
+            phases.append(phase)
+            update_cleanup_job(job_id, status='running', phase=phase, **counts)
+            self.assertEqual(get_cleanup_job(job_id)[0]['phase'], phase)
+
+        counts, status = clean_db(progress=progress)
+        self.assertEqual(phases, ['delete_tmp_matches', 'replace_tmp_with_canonical', 'delete_multi_matches'])
+        self.assertEqual(counts, {'count_deleted_tmp': 0, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 1})
+
+        # now the same through the job runner
+        add_a_record({'source_bibcode': '2017arXiv171111084H', 'matched_bibcode': '2018ConPh..59...16H', 'confidence': 0.5})
+        job_id = add_cleanup_job()
+        self.assertEqual(run_cleanup_job(self.current_app, job_id), True)
+        job, status_code = get_cleanup_job(job_id)
+        self.assertEqual(job['status'], 'succeeded')
+        self.assertEqual(job['phase'], 'done')
+        self.assertEqual(job['counts'], {'count_deleted_tmp': 0, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 1})
+        self.assertIsNotNone(job['date_finished'])
+
+        # when clean_db raises
+        job_id = add_cleanup_job()
+        with mock.patch('oraclesrv.utils.clean_db', side_effect=Exception('Mock error')):
+            self.assertEqual(run_cleanup_job(self.current_app, job_id), False)
+        job, status_code = get_cleanup_job(job_id)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['message'], 'Mock error')
+
+        # errors
+        with mock.patch.object(self.current_app, 'session_scope') as exception_mock:
+            exception_mock.side_effect = SQLAlchemyError('DB not initialized properly, check: SQLALCHEMY_URL')
+            self.assertEqual(add_cleanup_job(), None)
+            self.assertEqual(update_cleanup_job(job_id, status='running'), False)
+            self.assertEqual(get_cleanup_job(job_id), ({}, 404))
+
     def test_get_tmp_bibcodes(self):
         """
 
@@ -839,6 +1380,20 @@ class TestDatabase(TestCaseDatabase):
                                    ('2023arXiv230603140V', '2023MNRAS.tmp.1672V', 0.9942136)])
         self.assertEqual(status, 200)
 
+        # a page at a time
+        all_results = results
+        results, status = get_tmp_bibcodes(start=1, rows=1)
+        self.assertEqual(results, all_results[1:2])
+        self.assertEqual(status, 200)
+
+        # count only
+        count, status = count_tmp_bibcodes()
+        self.assertEqual(count, 3)
+        self.assertEqual(status, 200)
+
+        # streamed
+        self.assertEqual(list(stream_tmp_bibcodes()), all_results)
+
     def test_get_muti_matches(self):
         """
 
@@ -913,6 +1468,77 @@ class TestDatabase(TestCaseDatabase):
                                    ('2022arXiv220500682A', '2023PhRvC.107e4908A', 0.9833502)])
         self.assertEqual(status, 200)
 
+        # a page at a time
+        all_results = results
+        results, status = get_muti_matches(start=2, rows=3)
+        self.assertEqual(results, all_results[2:5])
+        results, status = get_muti_matches(start=10, rows=3)
+        self.assertEqual(results, all_results[10:])
+
+    @benchmark
+    def test_multi_matches_window_benchmark(self):
+        """
+        Test listing and deleting multi matches with window functions returns the same as the grouped subqueries
+        they replaced, on a synthetic table, and print the timing of both
+        """
+        self.add_eprint_bibstem_lookup_data()
+
+        # every eprint is matched to its pub, and every fifth one also to the next pub with a lower confidence,
+        # making both the eprint and the next pub multi matched
+        num_eprints = 20000
+        rows = []
+        for i in range(num_eprints):
+            rows.append({'eprint_bibcode': '2020arXiv%09dA' % i, 'pub_bibcode': '2021PhRvD%09dA' % i, 'confidence': 0.9})
+            if i % 5 == 0:
+                rows.append({'eprint_bibcode': '2020arXiv%09dA' % i, 'pub_bibcode': '2021PhRvD%09dA' % (i + 1), 'confidence': 0.5})
+        status, _, _ = bulk_add_records(rows)
+        self.assertEqual(status, True)
+
+        with self.current_app.session_scope() as session:
+            # grouped subqueries that get_muti_matches used
+            start_time = time.time()
+            multi_eprints = session.query(DocMatch.eprint_bibcode) \
+                .group_by(DocMatch.eprint_bibcode).having(func.count('*') > 1).subquery()
+            multi_pubs = session.query(DocMatch.pub_bibcode) \
+                .group_by(DocMatch.pub_bibcode).having(func.count('*') > 1).subquery()
+            expected = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence) \
+                .filter(or_(DocMatch.eprint_bibcode == multi_eprints.c.eprint_bibcode, DocMatch.pub_bibcode == multi_pubs.c.pub_bibcode)) \
+                .group_by(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence) \
+                .order_by(DocMatch.eprint_bibcode.asc(), DocMatch.pub_bibcode.asc()).all()
+            grouped_list_duration = time.time() - start_time
+
+            # grouped subqueries that delete_multi_matches used, rolled back
+            start_time = time.time()
+            multiples = session.query(DocMatch.eprint_bibcode, func.max(DocMatch.confidence).label('confidence')) \
+                .group_by(DocMatch.eprint_bibcode).having(func.count(distinct(DocMatch.confidence)) > 1).subquery()
+            expected_count = session.query(DocMatch).filter(
+                and_(DocMatch.eprint_bibcode == multiples.c.eprint_bibcode, DocMatch.confidence < multiples.c.confidence)) \
+                .delete(synchronize_session=False)
+            multiples = session.query(DocMatch.pub_bibcode, func.max(DocMatch.confidence).label('confidence')) \
+                .group_by(DocMatch.pub_bibcode).having(func.count(distinct(DocMatch.confidence)) > 1).subquery()
+            expected_count += session.query(DocMatch).filter(
+                and_(DocMatch.pub_bibcode == multiples.c.pub_bibcode, DocMatch.confidence < multiples.c.confidence)) \
+                .delete(synchronize_session=False)
+            grouped_delete_duration = time.time() - start_time
+            session.rollback()
+
+        start_time = time.time()
+        results, status = get_muti_matches()
+        window_list_duration = time.time() - start_time
+        self.assertEqual(status, 200)
+        self.assertEqual([tuple(r) for r in results], [tuple(r) for r in expected])
+        self.assertEqual(len(results), 3 * (num_eprints // 5))
+
+        start_time = time.time()
+        status, count, _ = delete_multi_matches()
+        window_delete_duration = time.time() - start_time
+        self.assertEqual(status, True)
+        self.assertEqual(count, expected_count)
+        self.assertEqual(count, num_eprints // 5)
+
+        print('multi matches of %d rows, list: grouped %.2f s, window %.2f s, delete: grouped %.2f s, window %.2f s' %
+              (len(rows), grouped_list_duration, window_list_duration, grouped_delete_duration, window_delete_duration))
+
     def test_adding_earth_science_records(self):
         """
 
@@ -1011,6 +1637,106 @@ class TestDatabase(TestCaseDatabase):
         self.assertEqual(status, False)
         self.assertEqual(message, 'unable to add records to the database')
 
+    def test_add_records_duplicates(self):
+        """
+        Test add_records when the same match appears more than once, the highest confidence is kept
+        """
+        self.add_eprint_bibstem_lookup_data()
+
+        docmatch_records = {
+            'status': 2,    #name='new', index=2, number=2,
+            'docmatch_records':[
+                {
+                    'source_bibcode': '2021arXiv210312030S',
+                    'matched_bibcode': '2021CSF...15311505S',
+                    'confidence': 0.9
+                }, {
+                    'source_bibcode': '2021CSF...15311505S',
+                    'matched_bibcode': '2021arXiv210312030S',
+                    'confidence': 0.9829099
+                },
+            ]
+        }
+        status, message = add_records(DocMatchRecordList(**docmatch_records))
+        self.assertEqual(status, True)
+        self.assertEqual(message, 'updated db with new data successfully')
+        self.assertEqual(get_a_record('2021arXiv210312030S', '2021CSF...15311505S')['confidence'], 0.9829099)
+
+    def test_bulk_add_records(self):
+        """
+        Test bulk_add_records inserting, updating, and dedupping records in chunks
+        """
+        self.add_docmatch_data()
+        self.current_app.config['ORACLE_BULK_ADD_CHUNK_SIZE'] = 2
+
+        rows = [
+            {'eprint_bibcode': '2021arXiv210312030S', 'pub_bibcode': '2021CSF...15311505S', 'confidence': 0.99},
+            {'eprint_bibcode': '2023arXiv230410160K', 'pub_bibcode': '2023MNRAS.522.3648K', 'confidence': 0.9957017},
+            {'eprint_bibcode': '2023arXiv230602536C', 'pub_bibcode': '2023MNRAS.524L..61C', 'confidence': 0.5},
+            {'eprint_bibcode': '2023arXiv230602536C', 'pub_bibcode': '2023MNRAS.524L..61C', 'confidence': 0.9961402},
+            # lower confidence does not downgrade the match
+            {'eprint_bibcode': '2018arXiv181105526S', 'pub_bibcode': '2022NuPhB.98015830S', 'confidence': 0.5},
+        ]
+        status, counts, message = bulk_add_records(rows)
+        self.assertEqual(status, True)
+        self.assertEqual(counts, {'inserted': 2, 'updated': 1, 'skipped': 1})
+        self.assertEqual(message, 'inserted 2, updated 1, and skipped 1 records')
+
+        result, status_code = query_docmatch({'start': 0, 'rows': 10, 'date_cutoff': get_date('1972/01/01 00:00:00')})
+        self.assertEqual(result, [('2017arXiv171111082H', '2018ConPh..59...16H', 0.9877064),
+                                  ('2021arXiv210312030S', '2021CSF...15311505S', 0.99),
+                                  ('2018arXiv181105526S', '2022NuPhB.98015830S', 0.97300124),
+                                  ('2023arXiv230410160K', '2023MNRAS.522.3648K', 0.9957017),
+                                  ('2023arXiv230602536C', '2023MNRAS.524L..61C', 0.9961402)])
+
+        # match that has been marked incorrect is never revived
+        status, counts, message = bulk_add_records([{'eprint_bibcode': '2020arXiv200100001A', 'pub_bibcode': '2020ApJ...900....1A', 'confidence': -1}])
+        self.assertEqual(counts, {'inserted': 1, 'updated': 0, 'skipped': 0})
+        status, counts, message = bulk_add_records([{'eprint_bibcode': '2020arXiv200100001A', 'pub_bibcode': '2020ApJ...900....1A', 'confidence': 0.99}])
+        self.assertEqual(status, True)
+        self.assertEqual(counts, {'inserted': 0, 'updated': 0, 'skipped': 1})
+        self.assertEqual(get_a_record('2020arXiv200100001A', '2020ApJ...900....1A')['confidence'], -1)
+
+        # nothing to add
+        status, counts, message = bulk_add_records([])
+        self.assertEqual(status, False)
+        self.assertEqual(counts, {'inserted': 0, 'updated': 0, 'skipped': 0})
+        self.assertEqual(message, 'no records to add to the database')
+
+        # when there is an error
+        with mock.patch.object(self.current_app, 'session_scope') as exception_mock:
+            exception_mock.side_effect = SQLAlchemyError('DB not initialized properly, check: SQLALCHEMY_URL')
+            status, counts, message = bulk_add_records(rows)
+            self.assertEqual(status, False)
+            self.assertEqual(message, 'SQLAlchemy: DB not initialized properly, check: SQLALCHEMY_URL')
+
+    def test_ingest(self):
+        """
+        Test reading a tab delimited file of matches and bulk loading it
+        """
+        self.add_eprint_bibstem_lookup_data()
+        self.add_confidence_lookup_data()
+
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.tsv', delete=False) as f:
+            f.write('2021arXiv210312030S\t2021CSF...15311505S\t0.9829099\n')
+            f.write('2018ConPh..59...16H\t2017arXiv171111082H\n')
+            f.write('2017EaarX....2FDCTH\t2018Litho.314..360H\t1.3\n')
+            filename = f.name
+        try:
+            # the line with no confidence is skipped, as is the line with unrecognizable eprint
+            self.assertEqual(read_matches(filename),
+                             [{'eprint_bibcode': '2021arXiv210312030S', 'pub_bibcode': '2021CSF...15311505S', 'confidence': 0.9829099}])
+            # unless the confidence is provided
+            self.assertEqual(read_matches(filename, 1.3),
+                             [{'eprint_bibcode': '2021arXiv210312030S', 'pub_bibcode': '2021CSF...15311505S', 'confidence': 0.9829099},
+                              {'eprint_bibcode': '2017arXiv171111082H', 'pub_bibcode': '2018ConPh..59...16H', 'confidence': 1.3}])
+
+            self.assertFalse(ingest(filename, 'unknown source'))
+            self.assertTrue(ingest(filename, 'ADS'))
+            self.assertEqual(get_a_record('2017arXiv171111082H', '2018ConPh..59...16H')['confidence'], 1.3)
+        finally:
+            os.remove(filename)
+
     @mock.patch('oraclesrv.utils.query_eprint_bibstem')
     def test_del_records(self, mock_query_eprint_bibstem):
         """
@@ -1043,6 +1769,54 @@ class TestDatabase(TestCaseDatabase):
         self.assertEqual(status, True)
         self.assertEqual(message, 'removed 1 records of 1 requested')
 
+    def test_del_records_one_statement(self):
+        """
+        Test del_records removes all the requested records with one statement, even when the request has duplicates
+        """
+        self.add_docmatch_data()
+
+        docmatch_records = {
+            'status': 2,    #name='new', index=2, number=2,
+            'docmatch_records':[
+                {
+                    'source_bibcode': '2021arXiv210312030S',
+                    'matched_bibcode': '2021CSF...15311505S',
+                    'confidence': 0.9829099
+                }, {
+                    'source_bibcode': '2021CSF...15311505S',
+                    'matched_bibcode': '2021arXiv210312030S',
+                    'confidence': 0.9829099
+                }, {
+                    'source_bibcode': '2017arXiv171111082H',
+                    'matched_bibcode': '2018ConPh..59...16H',
+                    'confidence': 0.9877064
+                }, {
+                    'source_bibcode': '2018arXiv181105526S',
+                    'matched_bibcode': '2022NuPhB.98015830S',
+                    'confidence': 0.1
+                },
+            ]
+        }
+        docmatch_records = DocMatchRecordList(**docmatch_records)
+
+        # keep track of delete statements sent to db
+        statements = []
+        def track_deletes(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('DELETE'):
+                statements.append(statement)
+        event.listen(self.current_app.db.engine, 'before_cursor_execute', track_deletes)
+        try:
+            status, message = del_records(docmatch_records)
+        finally:
+            event.remove(self.current_app.db.engine, 'before_cursor_execute', track_deletes)
+        self.assertEqual(status, True)
+        self.assertEqual(message, 'removed 2 records of 4 requested')
+        self.assertEqual(len(statements), 1)
+
+        # the record with different confidence was not deleted
+        result, status_code = query_docmatch({'start': 0, 'rows': 10, 'date_cutoff': get_date('1972/01/01 00:00:00')})
+        self.assertEqual(result, [('2018arXiv181105526S', '2022NuPhB.98015830S', 0.97300124)])
+
     @mock.patch('oraclesrv.utils.query_eprint_bibstem')
     def test_del_records_error(self, mock_query_eprint_bibstem):
         """
@@ -1116,8 +1890,11 @@ class TestDatabase(TestCaseDatabase):
         """
         Test get_solr_data_chunk function
         """
+        self.current_app.config['ORACLE_SERVICE_SOLRQUERY_RETRY_DELAY_MS'] = 0
+        self.current_app.solr_client = SolrClient(self.current_app)
+        retries = self.current_app.config['ORACLE_SERVICE_SOLRQUERY_RETRIES']
 
-        with mock.patch('oraclesrv.utils.requests.get') as mock_requests_get:
+        with mock.patch.object(self.current_app.client, 'get') as mock_requests_get:
 
             # mock the response object to simulate a non-200 status code
             mock_response = mock.Mock()
@@ -1130,14 +1907,38 @@ class TestDatabase(TestCaseDatabase):
 
             self.assertIsNone(result)
             self.assertEqual(status_code, 400)
+            # client errors are not retried, there are two chunks
+            self.assertEqual(mock_requests_get.call_count, 2)
 
+            # server errors are retried
+            mock_requests_get.reset_mock()
+            mock_response.status_code = 503
+            result, status_code = get_solr_data_chunk(bibcodes)
+            self.assertIsNone(result)
+            self.assertEqual(status_code, 503)
+            self.assertEqual(mock_requests_get.call_count, 2 * (retries + 1))
 
             # test when RequestException happens
+            mock_requests_get.reset_mock()
             mock_requests_get.side_effect = requests.exceptions.RequestException("Mock request exception")
 
             result, status_code = get_solr_data_chunk(bibcodes)
             self.assertIsNone(result)
             self.assertIsInstance(status_code, requests.exceptions.RequestException)
+            self.assertEqual(mock_requests_get.call_count, 2 * (retries + 1))
+
+            # succeeds on retry
+            mock_requests_get.reset_mock()
+            mock_success = mock.Mock()
+            mock_success.status_code = 200
+            mock_success.json.return_value = {'response': {'docs': [{'bibcode': '2021CSF...15311505S'}]}}
+            mock_requests_get.side_effect = [requests.exceptions.RequestException("Mock request exception"), mock_success]
+            result, status_code = get_solr_data_chunk(bibcodes[:2])
+            self.assertEqual(result, [{'bibcode': '2021CSF...15311505S'}])
+            self.assertEqual(status_code, 200)
+
+        # no bibcodes, nothing is sent
+        self.assertEqual(get_solr_data_chunk([]), ([], 200))
 
     def test_is_eprint_bibcode(self):
         """
@@ -1148,6 +1949,82 @@ class TestDatabase(TestCaseDatabase):
         self.assertTrue(is_eprint_bibcode('2021arXiv210312030S'))
         self.assertFalse(is_eprint_bibcode('2021CSF...15311505S'))
 
+    def test_doi_index(self):
+        """
+        Test adding to and looking up the doi index
+        """
+        self.current_app.config['ORACLE_SERVICE_DOI_INDEX_MAX_AGE_DAYS'] = 30
+        pub_doc = {'bibcode': '2021CSF...15311505S', 'doctype': 'article', 'doi': ['10.1016/J.CHAOS.2021.111505'],
+                   'title': ['Nonlinear corrections in the quantization of a weakly nonideal Bose gas at zero temperature'],
+                   'author_norm': ['Smolyakov, M'], 'year': '2021'}
+        eprint_doc = {'bibcode': '2021arXiv210312030S', 'doctype': 'eprint', 'pubnote': ['doi: 10.1016/j.chaos.2021.111505'],
+                      'doi_pubnote': '10.1016/j.chaos.2021.111505', 'author_norm': ['Smolyakov, M'], 'year': '2021'}
+
+        status, text = add_doi_index([pub_doc, eprint_doc, {'doctype': 'article'}, 'bibcode'])
+        self.assertTrue(status)
+        self.assertEqual(text, 'added 2 dois to the index')
+        self.assertEqual(add_doi_index([{'bibcode': '2021CSF...15311505S'}]), (True, 'no dois to add to the index'))
+
+        # dois are case insensitive
+        docs, num_stale, status_code = lookup_doi_index(['10.1016/j.chaos.2021.111505'], 'doi', 'article OR inproceedings')
+        self.assertEqual(status_code, 200)
+        self.assertEqual(num_stale, 0)
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(docs[0]['bibcode'], '2021CSF...15311505S')
+        self.assertEqual(docs[0]['doi'], ['10.1016/J.CHAOS.2021.111505'])
+        self.assertIn('doi_index_date', docs[0])
+
+        # pubnote of the eprint
+        docs, num_stale, status_code = lookup_doi_index(['10.1016/j.chaos.2021.111505'], 'pubnote', '"eprint"')
+        self.assertEqual([doc['bibcode'] for doc in docs], ['2021arXiv210312030S'])
+
+        # not the doctype to match against
+        self.assertEqual(lookup_doi_index(['10.1016/j.chaos.2021.111505'], 'doi', 'eprint'), ([], 0, 200))
+        self.assertEqual(lookup_doi_index(['10.1000/not.there'], 'doi', 'article'), ([], 0, 200))
+
+        # the docs read from the index are not written back to it
+        self.assertEqual(add_doi_index(docs), (True, 'no dois to add to the index'))
+
+        # stale entries are not returned
+        with self.current_app.session_scope() as session:
+            session.query(DOIIndex).update({DOIIndex.date: func.now() - timedelta(days=31)}, synchronize_session=False)
+            session.commit()
+        self.assertEqual(lookup_doi_index(['10.1016/j.chaos.2021.111505'], 'doi', 'article'), ([], 1, 200))
+
+        # until solr returns them again
+        add_doi_index([pub_doc])
+        docs, num_stale, status_code = lookup_doi_index(['10.1016/j.chaos.2021.111505'], 'doi', 'article')
+        self.assertEqual((len(docs), num_stale), (1, 0))
+
+        # an entry is not replaced with a doc that has fewer fields
+        add_doi_index([{'bibcode': '2021CSF...15311505S', 'doctype': 'article', 'doi': ['10.1016/J.CHAOS.2021.111505']}])
+        docs, num_stale, status_code = lookup_doi_index(['10.1016/j.chaos.2021.111505'], 'doi', 'article')
+        self.assertEqual(docs[0]['title'], pub_doc['title'])
+        # but is with one that has all of them
+        add_doi_index([dict(pub_doc, abstract='Mock abstract.')])
+        docs, num_stale, status_code = lookup_doi_index(['10.1016/j.chaos.2021.111505'], 'doi', 'article')
+        self.assertEqual(docs[0]['abstract'], 'Mock abstract.')
+
+        # bulk load from solr
+        with mock.patch('oraclesrv.utils.get_solr_data_chunk') as mock_get_solr_data_chunk:
+            mock_get_solr_data_chunk.return_value = ([{'bibcode': '2022Test......1A', 'doctype': 'article', 'doi': ['10.1000/test.1']},
+                                                      {'bibcode': '2022arXiv220100001T', 'doctype': 'eprint', 'pubnote': ['doi:10.1000/test.1']}], 200)
+            status, num_dois, text = load_doi_index(['2022Test......1A', '2022arXiv220100001T'])
+            self.assertTrue(status)
+            self.assertEqual(num_dois, 2)
+            self.assertEqual(text, 'added 2 dois of 2 bibcodes to the index')
+            docs, num_stale, status_code = lookup_doi_index(['10.1000/test.1'], 'pubnote', 'eprint')
+            self.assertEqual([doc['bibcode'] for doc in docs], ['2022arXiv220100001T'])
+
+            mock_get_solr_data_chunk.return_value = (None, 503)
+            self.assertEqual(load_doi_index(['2022Test......1A']), (False, 0, 'unable to query solr: 503'))
+
+        # db error
+        with mock.patch.object(self.current_app, 'session_scope', side_effect=SQLAlchemyError('DB error')):
+            self.assertEqual(add_doi_index([pub_doc]), (False, 'SQLAlchemy: DB error'))
+        with mock.patch('oraclesrv.utils.read_session_scope', side_effect=SQLAlchemyError('DB error')):
+            self.assertEqual(lookup_doi_index(['10.1000/test.1'], 'doi', 'article'), ([], 0, 404))
+
 
 if __name__ == "__main__":
     unittest.main()
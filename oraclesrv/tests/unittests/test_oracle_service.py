@@ -6,18 +6,29 @@ sys.path.append(PROJECT_HOME)
 
 import unittest
 import json
+import tempfile
+import time
+import threading
+import asyncio
 import mock
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from requests.exceptions import HTTPError
 from requests.models import Response
 
 import oraclesrv.app as app
-from oraclesrv.tests.unittests.base import TestCaseDatabase
+from oraclesrv.tests.unittests.base import TestCaseDatabase, benchmark
 from oraclesrv.score import get_matches, to_unicode, get_db_match, count_matching_authors, get_year_score, \
-    encode_author, get_doi_match, get_author_score
-from oraclesrv.doc_matching import DocMatching
+    encode_author, get_doi_match, get_author_score, prune_candidates
+from oraclesrv.doc_matching import DocMatching, speculative_metrics, doi_index_metrics, candidate_pruning_metrics
 from oraclesrv.utils import get_solr_data_recommend, get_solr_data_match, get_solr_data_match_doi, get_solr_data_match_pubnote, \
     get_solr_data_match_doctype_case, get_solr_data_chunk, get_solr_data
+from oraclesrv.solr_cache import SolrCache, MemoryBackend
+from oraclesrv.solr_client import SolrClient
+from oraclesrv.keras_model import KerasModel, PredictionBatcher
+from oraclesrv.async_matching import AsyncMatchingEngine, AsyncDocMatchingApp, AsyncDocMatching
+from oraclesrv.fake_solr import FakeSolr
+from oraclesrv.benchmark import make_payloads, run_benchmark, get_percentile
 
 
 class test_oracle(TestCaseDatabase):
@@ -597,9 +608,10 @@ class test_oracle(TestCaseDatabase):
 
         ]
 
-        return_values = []
+        # chunks are sent concurrently, so return the response that goes with the query of each chunk
+        return_values = {}
         for result in results:
-            return_values.append(create_response(result))
+            return_values[result['responseHeader']['params']['q']] = create_response(result)
 
         expected = [
             {'bibcode': '2023MNRAS.523.4739S', 'identifier': ['2023arXiv230601119S', '10.1093/mnras/stad1711', 'arXiv:2306.01119', '2023MNRAS.523.4739S', '10.48550/arXiv.2306.01119', '2023MNRAS.tmp.1679S']},
@@ -611,12 +623,21 @@ class test_oracle(TestCaseDatabase):
             {'bibcode': '2023MNRAS.523.4520T', 'identifier': ['2023MNRAS.tmp.1673T', '10.1093/mnras/stad1729', '10.48550/arXiv.2306.04691', '2023arXiv230604691T', 'arXiv:2306.04691', '2023MNRAS.523.4520T']}
         ]
 
-        with mock.patch('requests.get', side_effect=return_values):
+        with mock.patch.object(self.current_app.client, 'get', side_effect=lambda **kwargs: return_values[kwargs['params']['q']]) as mock_get:
             docs, status = get_solr_data_chunk(bibcodes)
 
-            # all info in returned in one chunk
+            # all info in returned in one chunk, in the order of the chunks
             self.assertEqual(len(bibcodes), len(expected))
             self.assertEqual(docs, expected)
+            self.assertEqual(mock_get.call_count, 4)
+
+        # when the connection pool is disabled, the chunks share the session of the solr client
+        self.current_app.config['REQUESTS_CONNECTION_POOL_ENABLED'] = False
+        self.current_app.solr_client = SolrClient(self.current_app)
+        with mock.patch.object(self.current_app.solr_client.session, 'get', side_effect=lambda **kwargs: return_values[kwargs['params']['q']]):
+            docs, status = get_solr_data_chunk(bibcodes)
+            self.assertEqual(docs, expected)
+        self.current_app.config['REQUESTS_CONNECTION_POOL_ENABLED'] = True
 
     def test_query_doi(self):
         """
@@ -688,6 +709,82 @@ class test_oracle(TestCaseDatabase):
                     self.assertIn('No matches with DOI', updated_comment)
                     mock_debug.assert_any_call('No matches with DOI %s in pubnote, trying Abstract.' % payload['doi'])
 
+    def test_query_doi_index(self):
+        """
+        Test query_doi and query_pubnote of DocMatching looking up the local doi index before solr
+        """
+        self.current_app.config['ORACLE_SERVICE_DOI_INDEX_ENABLED'] = True
+        pub_doc = {'bibcode': '2021CSF...15311505S', 'doctype': 'article', 'doi': ['10.1016/j.chaos.2021.111505']}
+        payload = {
+            'abstract': 'Mock abstract text.',
+            'title': 'Mock title text.',
+            'author': 'Smolyakov, Mikhail N.',
+            'year': 2021,
+            'doctype': 'eprint',
+            'doi': ['10.1016/j.chaos.2021.111505'],
+        }
+        match = [{'source_bibcode': '2021arXiv210312030S', 'matched_bibcode': '2021CSF...15311505S', 'confidence': 0.99, 'matched': 1}]
+        hits = doi_index_metrics.get_metrics()['hits']
+        misses = doi_index_metrics.get_metrics()['misses']
+
+        with mock.patch('oraclesrv.doc_matching.get_solr_data_match_doi') as mock_get_solr_data_match_doi, \
+             mock.patch('oraclesrv.doc_matching.get_doi_match', return_value=match) as mock_get_doi_match:
+            mock_get_solr_data_match_doi.return_value = ([pub_doc], 'mock_query_with_doi', 200)
+
+            # not in the index, solr is queried, and what it returns is added to the index
+            doc_match = DocMatching(payload)
+            doc_match.match_doctype = 'article OR inproceedings'
+            result, comment = doc_match.query_doi('')
+            self.assertEqual(result[0]['match'], match)
+            self.assertEqual(mock_get_solr_data_match_doi.call_count, 1)
+            self.assertEqual(doi_index_metrics.get_metrics()['misses'], misses + 1)
+
+            # once it is in the index, solr is skipped
+            result, comment = doc_match.query_doi('')
+            self.assertEqual(result[0]['match'], match)
+            self.assertEqual(result[0]['query'], 'identifier:("10.1016/j.chaos.2021.111505") doctype:(article OR inproceedings)')
+            self.assertEqual(mock_get_solr_data_match_doi.call_count, 1)
+            self.assertEqual(mock_get_doi_match.call_args[0][7][0]['bibcode'], '2021CSF...15311505S')
+            self.assertEqual(doi_index_metrics.get_metrics()['hits'], hits + 1)
+
+            # the pubnote entries are separate
+            with mock.patch('oraclesrv.doc_matching.get_solr_data_match_pubnote') as mock_get_solr_data_match_pubnote:
+                mock_get_solr_data_match_pubnote.return_value = ([], 'mock_query_with_pubnote', 200)
+                doc_match.query_pubnote('')
+                self.assertEqual(mock_get_solr_data_match_pubnote.call_count, 1)
+
+            # disabled
+            self.current_app.config['ORACLE_SERVICE_DOI_INDEX_ENABLED'] = False
+            doc_match.query_doi('')
+            self.assertEqual(mock_get_solr_data_match_doi.call_count, 2)
+
+        # only the records returned for the doi and pubnote queries are added to the index, the ones returned
+        # for the other queries do not have all the fields
+        self.current_app.config['ORACLE_SERVICE_DOI_INDEX_ENABLED'] = True
+        with mock.patch('oraclesrv.doc_matching.add_doi_index') as mock_add_doi_index, \
+             mock.patch('oraclesrv.doc_matching.get_solr_data_match_pubnote') as mock_get_solr_data_match_pubnote, \
+             mock.patch('oraclesrv.doc_matching.get_solr_data_match') as mock_get_solr_data_match, \
+             mock.patch('oraclesrv.doc_matching.get_matches', return_value=[]):
+            eprint_doc = {'bibcode': '2021arXiv210312030S', 'doctype': 'eprint', 'doi_pubnote': '10.1016/j.chaos.2021.111505'}
+            mock_get_solr_data_match_pubnote.return_value = ([eprint_doc], 'mock_query_with_pubnote', 200)
+            doc_match = DocMatching(dict(payload, doctype='article', doi=['10.1016/j.chaos.2021.111506']))
+            doc_match.match_doctype = 'eprint'
+            doc_match.query_pubnote('')
+            mock_add_doi_index.assert_called_once_with([eprint_doc])
+
+            # not when solr returns an error
+            mock_add_doi_index.reset_mock()
+            mock_get_solr_data_match_pubnote.return_value = ({'error from solr': '503: error'}, 'mock_query_with_pubnote', 503)
+            doc_match.query_pubnote('')
+            mock_add_doi_index.assert_not_called()
+
+            mock_get_solr_data_match.return_value = ([pub_doc], 'mock_query', 200)
+            doc_match.query_abstract_or_title('')
+            mock_add_doi_index.assert_not_called()
+
+        r = self.client.get(path='/metrics')
+        self.assertEqual(r.json['doi_index']['hits'], hits + 1)
+
     def test_query_abstract_or_title(self):
         """
         Test query_abstract_or_title of DocMatching when no matches are found with abstract, and it retries with title.
@@ -716,6 +813,114 @@ class test_oracle(TestCaseDatabase):
             result = doc_match.query_abstract_or_title(comment)
             mock_debug.assert_any_call('No matches with Abstract, trying Title.')
 
+    def test_process_speculative(self):
+        """
+        Test process of DocMatching sending the query on abstract at the same time as the query on doi
+        """
+        self.current_app.config['ORACLE_SERVICE_SPECULATIVE_QUERIES_ENABLED'] = True
+        payload = {
+            'abstract': 'Mock abstract text.',
+            'title': 'Mock title text.',
+            'author': 'Smith, J',
+            'year': 2021,
+            'doctype': 'eprint',
+            'doi': ['10.1234/mock.doi'],
+        }
+        doi_match = [{'source_bibcode': '2021arXiv210100001S', 'matched_bibcode': '2021ApJ...900....1S', 'confidence': 0.99, 'matched': 1}]
+        abstract_match = [{'source_bibcode': '2021arXiv210100001S', 'matched_bibcode': '2021ApJ...900....2S', 'confidence': 0.98, 'matched': 1}]
+
+        def solr_data_match_doi(*args):
+            time.sleep(0.3)
+            return [{'bibcode': '2021ApJ...900....1S'}], 'mock_query_with_doi', 200
+
+        def solr_data_match(*args):
+            time.sleep(0.3)
+            return [{'bibcode': '2021ApJ...900....2S'}], 'mock_query_with_abstract', 200
+
+        with mock.patch('oraclesrv.doc_matching.get_solr_data_match_doi', side_effect=solr_data_match_doi), \
+                mock.patch('oraclesrv.doc_matching.get_solr_data_match', side_effect=solr_data_match) as mock_get_solr_data_match, \
+                mock.patch('oraclesrv.doc_matching.get_matches', return_value=abstract_match), \
+                mock.patch('oraclesrv.doc_matching.get_doi_match') as mock_get_doi_match:
+
+            # doi finds a match, result of abstract is ignored
+            before = speculative_metrics.get_metrics()
+            mock_get_doi_match.return_value = doi_match
+            results, status_code = DocMatching(payload, save=False).process()
+            self.assertEqual(status_code, 200)
+            self.assertEqual(results['match'], doi_match)
+            self.assertEqual(results['query'], 'mock_query_with_doi')
+            after = speculative_metrics.get_metrics()
+            self.assertEqual(after['num_sent'] - before['num_sent'], 1)
+            self.assertEqual(after['num_discarded'] - before['num_discarded'], 1)
+            self.assertEqual(after['num_used'] - before['num_used'], 0)
+
+            # doi does not find a match, result of abstract is used, and it was not waited for after doi
+            before = after
+            mock_get_solr_data_match.reset_mock()
+            mock_get_doi_match.return_value = None
+            start_time = time.time()
+            results, status_code = DocMatching(payload, save=False).process()
+            self.assertLess(time.time() - start_time, 0.55)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(results['match'], abstract_match)
+            self.assertEqual(results['query'], 'mock_query_with_abstract')
+            self.assertIn('No matches with DOI', results['comment'])
+            self.assertEqual(mock_get_solr_data_match.call_count, 1)
+            after = speculative_metrics.get_metrics()
+            self.assertEqual(after['num_used'] - before['num_used'], 1)
+            self.assertGreater(after['total_saved_ms'] - before['total_saved_ms'], 0)
+
+        r = self.client.get(path='/metrics')
+        self.assertIn('extra_solr_queries', r.json['speculative_queries'])
+
+    def test_query_abstract_or_title_parallel(self):
+        """
+        Test query_abstract_or_title of DocMatching sending the query on title at the same time as the query on abstract
+        """
+        self.current_app.config['ORACLE_SERVICE_PARALLEL_TITLE_QUERY_ENABLED'] = True
+        payload = {
+            'abstract': 'Mock abstract text.',
+            'title': 'Mock title text.',
+            'doctype': 'article',
+            'match_doctype': ['eprint'],
+            'extra_filter': ''
+        }
+        comment = 'some query'
+        abstract_match = [{'matched_bibcode': '2000Bibcode.......A'}]
+        title_match = [{'matched_bibcode': '2001Bibcode.......A'}]
+
+        def solr_data_match(abstract, title, doctype, match_doctype, extra_filter):
+            time.sleep(0.3)
+            if abstract:
+                return [{'bibcode': '2000Bibcode.......A'}], 'mock_query_with_abstract', 200
+            return [{'bibcode': '2001Bibcode.......A'}], 'mock_query_with_title', 200
+
+        with mock.patch('oraclesrv.doc_matching.get_solr_data_match', side_effect=solr_data_match) as mock_get_solr_data_match, \
+                mock.patch('oraclesrv.doc_matching.get_matches') as mock_get_matches:
+
+            # no match with abstract, title was fetched at the same time
+            mock_get_matches.side_effect = [[], title_match]
+            start_time = time.time()
+            result, status_code = DocMatching(payload).query_abstract_or_title(comment)
+            self.assertLess(time.time() - start_time, 0.55)
+            self.assertEqual(result, {'query': 'mock_query_with_title', 'comment': 'some query No matches with Abstract, trying Title.', 'match': title_match})
+            self.assertEqual(mock_get_solr_data_match.call_count, 2)
+            mock_get_solr_data_match.assert_any_call('', payload['title'], payload['doctype'], payload['match_doctype'], payload['extra_filter'])
+
+            # match with abstract, result of title is ignored
+            before = speculative_metrics.get_metrics()
+            mock_get_matches.side_effect = [abstract_match]
+            result, status_code = DocMatching(payload).query_abstract_or_title(comment)
+            self.assertEqual(result, {'query': 'mock_query_with_abstract', 'comment': 'some query', 'match': abstract_match})
+            after = speculative_metrics.get_metrics()
+            self.assertEqual(after['num_discarded'] - before['num_discarded'], 1)
+
+            # no abstract, so query is on title to begin with, nothing is sent in the background
+            mock_get_solr_data_match.reset_mock()
+            mock_get_matches.side_effect = [title_match]
+            result, status_code = DocMatching(dict(payload, abstract='')).query_abstract_or_title(comment)
+            self.assertEqual(mock_get_solr_data_match.call_count, 1)
+
     def test_query_doctype(self):
         """
         Test query_doctype function of DocMatching when no matches are found from Solr results
@@ -919,6 +1124,55 @@ class test_oracle(TestCaseDatabase):
         self.assertEqual(get_author_score(ref_authors='Smith, J', ads_authors=''), 0)
         self.assertEqual(get_author_score(ref_authors='Smith, J', ads_authors=''), 0)
 
+    def test_predict_batch(self):
+        """
+        Test predicting the scores of several candidates at once, with one call to each model
+        """
+        keras_model = KerasModel()
+        keras_model.model_loaded = True
+        keras_model.model_4dim = mock.Mock()
+        keras_model.model_4dim.predict.side_effect = lambda inputs: [[0.9 + i / 100.0] for i in range(len(inputs))]
+        keras_model.model_3dim = mock.Mock()
+        keras_model.model_3dim.predict.side_effect = lambda inputs: [[0.5] for i in range(len(inputs))]
+        keras_model.model_4dim_w_doi = mock.Mock()
+        keras_model.model_3dim_w_doi = mock.Mock()
+
+        predictions = keras_model.predict_batch([[0.5, 0.75, 1, 1], [None, 0.75, 1, 1], [0.25, 0.75, 1, 1], [0.25, 0.75]])
+        # last one has wrong dimension
+        self.assertEqual(predictions, [0.9, 0.5, 0.91, 0])
+        self.assertEqual(keras_model.model_4dim.predict.call_count, 1)
+        self.assertEqual(keras_model.model_4dim.predict.call_args[0][0].tolist(), [[0.5, 0.75, 1, 1], [0.25, 0.75, 1, 1]])
+        # no abstract, so the 3 dim model is given the rest of the scores
+        self.assertEqual(keras_model.model_3dim.predict.call_args[0][0].shape, (1, 3))
+        keras_model.model_4dim_w_doi.predict.assert_not_called()
+
+    def test_prediction_batcher(self):
+        """
+        Test the predictions requested at the same time are predicted together
+        """
+        keras_model = mock.Mock()
+        keras_model.predict_batch.side_effect = lambda scores_list: [sum(scores) for scores in scores_list]
+        predictor = PredictionBatcher(keras_model, max_batch_size=4, max_wait=0.2)
+
+        predictions = {}
+        def predict(i):
+            predictions[i] = predictor.predict([i, 1])
+        threads = [threading.Thread(target=predict, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # each caller gets its own prediction
+        self.assertEqual(predictions, {i: i + 1 for i in range(8)})
+        self.assertEqual(predictor.num_predictions, 8)
+        self.assertLess(predictor.num_batches, 8)
+        self.assertEqual(keras_model.predict_batch.call_count, predictor.num_batches)
+
+        # a lone prediction waits for max_wait at most
+        predictor.max_wait = 0.01
+        self.assertEqual(predictor.predict([1, 2]), 3)
+
     def test_get_solr_data(self):
         """
         Test get_solr_data function of the utils module
@@ -927,6 +1181,7 @@ class test_oracle(TestCaseDatabase):
         with mock.patch('oraclesrv.utils.current_app.client.get') as mock_requests_get:
             # mock response from requests.get
             mock_response = mock.Mock()
+            mock_response.status_code = 200
             mock_response.raise_for_status = mock.Mock()
             mock_response.json.return_value = {'response': {'numFound': 1,'docs': [{'bibcode': '2022TEST..........S'}]}}
             mock_requests_get.return_value = mock_response
@@ -934,21 +1189,24 @@ class test_oracle(TestCaseDatabase):
             result, status_code = get_solr_data(rows=1, query='2022TEST..........S', fl='bibcode')
 
             self.assertEqual(result, ['2022TEST..........S'])
-            self.assertEqual(status_code, mock_response.status_code)
+            self.assertEqual(status_code, 200)
 
-        # test when connection pool is disabled
+        # test when connection pool is disabled, solr client has a session of its own
         self.current_app.config['REQUESTS_CONNECTION_POOL_ENABLED'] = False
+        self.current_app.solr_client = SolrClient(self.current_app)
+        self.assertIsNot(self.current_app.solr_client.session, self.current_app.client)
 
         # mock has_request_context and request.headers.get
-        with mock.patch('oraclesrv.utils.flask.has_request_context', return_value=True), \
-             mock.patch('oraclesrv.utils.flask.request') as mock_request, \
-             mock.patch('oraclesrv.utils.requests.get') as mock_requests_get:
+        with mock.patch('oraclesrv.solr_client.flask.has_request_context', return_value=True), \
+             mock.patch('oraclesrv.solr_client.flask.request') as mock_request, \
+             mock.patch.object(self.current_app.solr_client.session, 'get') as mock_requests_get:
 
             # mock request headers
             mock_request.headers.get.side_effect = lambda key, default=None: f"mock-{key}"
 
             # mock response from requests.get
             mock_response = mock.Mock()
+            mock_response.status_code = 200
             mock_response.raise_for_status = mock.Mock()
             mock_response.json.return_value = {'response': {'numFound': 1, 'docs': [{'bibcode': '2022TEST..........S'}]}}
             mock_requests_get.return_value = mock_response
@@ -956,7 +1214,682 @@ class test_oracle(TestCaseDatabase):
             result, status_code = get_solr_data(rows=1, query='bibcode:2024TEST..........S', fl='bibcode')
 
             self.assertEqual(result, ['2022TEST..........S'])
-            self.assertEqual(status_code, mock_response.status_code)
+            self.assertEqual(status_code, 200)
+            # key information of the original request is propagated
+            self.assertEqual(mock_requests_get.call_args[1]['headers']['X-Amzn-Trace-Id'], 'mock-X-Amzn-Trace-Id')
+
+    def test_solr_client(self):
+        """
+        Test retries and circuit breaker of the solr client
+        """
+        self.current_app.config['ORACLE_SERVICE_SOLRQUERY_RETRY_DELAY_MS'] = 0
+        self.current_app.config['ORACLE_SERVICE_SOLRQUERY_CIRCUIT_FAILURES'] = 2
+        self.current_app.config['ORACLE_SERVICE_SOLRQUERY_CIRCUIT_RESET_SECONDS'] = 60
+        solr_client = SolrClient(self.current_app)
+        self.current_app.solr_client = solr_client
+        retries = self.current_app.config['ORACLE_SERVICE_SOLRQUERY_RETRIES']
+
+        mock_success = mock.Mock()
+        mock_success.status_code = 200
+        mock_success.json.return_value = {'response': {'numFound': 1, 'docs': [{'bibcode': '2022TEST..........S'}]}}
+        mock_server_error = mock.Mock()
+        mock_server_error.status_code = 503
+
+        with mock.patch.object(solr_client.session, 'get') as mock_requests_get:
+            # timeouts are retried, and the connect and read timeouts are passed separately
+            mock_requests_get.side_effect = [requests.exceptions.Timeout('timeout'), mock_success]
+            response = solr_client.query({'q': 'bibcode:2022TEST..........S'}, query_type='similar')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(mock_requests_get.call_count, 2)
+            self.assertEqual(mock_requests_get.call_args[1]['timeout'], (self.current_app.config['ORACLE_SERVICE_SOLRQUERY_CONNECT_TIMEOUT'],
+                                                                         self.current_app.config['ORACLE_SERVICE_SOLRQUERY_READ_TIMEOUT']))
+
+            # server errors are retried, and returned after the last retry
+            mock_requests_get.reset_mock()
+            mock_requests_get.side_effect = None
+            mock_requests_get.return_value = mock_server_error
+            response = solr_client.query({'q': 'bibcode:2022TEST..........S'}, query_type='similar')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(mock_requests_get.call_count, retries + 1)
+            self.assertEqual(solr_client.breaker.state, 'closed')
+
+            # second consecutive failure opens the circuit
+            mock_requests_get.side_effect = requests.exceptions.ConnectionError('connection refused')
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                solr_client.query({'q': 'bibcode:2022TEST..........S'}, query_type='similar')
+            self.assertEqual(solr_client.breaker.state, 'open')
+
+            # while open, fail fast without sending the query, the callers see it as 503 from solr
+            mock_requests_get.reset_mock()
+            result, query, status_code = get_solr_data_match('', 'Mock title', 'article', 'eprint', '')
+            self.assertEqual(status_code, 503)
+            self.assertIn('error from solr', result)
+            self.assertEqual(mock_requests_get.call_count, 0)
+
+            # after the reset timeout, one query is let through, and if it succeeds the circuit is closed
+            solr_client.breaker.opened_at -= 60
+            mock_requests_get.side_effect = None
+            mock_requests_get.return_value = mock_success
+            self.assertTrue(solr_client.breaker.allow())
+            self.assertFalse(solr_client.breaker.allow())
+            solr_client.breaker.record_success()
+            self.assertEqual(solr_client.breaker.state, 'closed')
+            result, status_code = get_solr_data(rows=1, query='bibcode:2022TEST..........S', fl='bibcode', query_type='recommend')
+            self.assertEqual(result, ['2022TEST..........S'])
+
+        metrics = solr_client.get_metrics()
+        self.assertEqual(metrics['circuit'], {'state': 'closed', 'num_consecutive_failures': 0, 'num_opened': 1})
+        self.assertEqual(metrics['query_types']['similar']['num_queries'], 3)
+        self.assertEqual(metrics['query_types']['similar']['num_retries'], 1 + 2 * retries)
+        self.assertEqual(metrics['query_types']['similar']['num_errors'], 2)
+        self.assertEqual(metrics['query_types']['similar']['num_rejected'], 1)
+        self.assertEqual(metrics['query_types']['similar']['latency']['count'], 3)
+        self.assertEqual(metrics['query_types']['recommend']['num_queries'], 1)
+
+        r = self.client.get(path='/metrics')
+        self.assertEqual(r.json['solr']['circuit']['num_opened'], 1)
+
+    def test_solr_client_coalesce(self):
+        """
+        Test identical queries in flight at the same time sharing one request to solr
+        """
+        solr_client = self.current_app.solr_client
+        started = threading.Event()
+        release = threading.Event()
+        mock_response = mock.Mock()
+        mock_response.status_code = 200
+
+        def get(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            if kwargs['params']['q'] == 'fail':
+                raise requests.exceptions.ConnectionError('unreachable')
+            return mock_response
+
+        def query(q, responses):
+            try:
+                responses.append(solr_client.query({'q': q, 'fl': 'bibcode', 'rows': 10}, query_type='similar'))
+            except requests.exceptions.ConnectionError as e:
+                responses.append(e)
+
+        def query_concurrently(q, num_threads):
+            responses = []
+            started.clear()
+            release.clear()
+            leader = threading.Thread(target=query, args=(q, responses))
+            leader.start()
+            started.wait(5)
+            waiters = [threading.Thread(target=query, args=(q, responses)) for _ in range(num_threads - 1)]
+            for waiter in waiters:
+                waiter.start()
+            # let the leader finish once the others are waiting on it
+            while solr_client.get_metrics()['query_types'].get('similar', {}).get('num_coalesced', 0) < num_coalesced + num_threads - 1:
+                time.sleep(0.01)
+            release.set()
+            for thread in [leader] + waiters:
+                thread.join()
+            return responses
+
+        with mock.patch.object(solr_client, 'get_backoff', return_value=0), \
+             mock.patch.object(solr_client.session, 'get', side_effect=get) as mock_requests_get:
+            num_coalesced = 0
+            responses = query_concurrently('similar("test")', 5)
+            self.assertEqual(mock_requests_get.call_count, 1)
+            self.assertEqual(responses, [mock_response] * 5)
+            self.assertEqual(solr_client.in_flight, {})
+
+            # the waiters get the error of the query they waited on
+            num_coalesced = 4
+            mock_requests_get.reset_mock()
+            responses = query_concurrently('fail', 3)
+            self.assertEqual(mock_requests_get.call_count, 1 + solr_client.retries)
+            self.assertTrue(all(isinstance(response, requests.exceptions.ConnectionError) for response in responses))
+            self.assertEqual(len(responses), 3)
+
+            # queries that are not in flight at the same time are each sent
+            release.set()
+            mock_requests_get.reset_mock()
+            solr_client.query({'q': 'similar("test")', 'fl': 'bibcode', 'rows': 10}, query_type='similar')
+            solr_client.query({'q': 'similar("test")', 'fl': 'bibcode', 'rows': 10}, query_type='similar')
+            self.assertEqual(mock_requests_get.call_count, 2)
+
+        metrics = solr_client.get_metrics()
+        self.assertEqual(metrics['query_types']['similar']['num_coalesced'], 6)
+        # the ones that waited are not counted as queries sent to solr
+        self.assertEqual(metrics['query_types']['similar']['num_queries'], 4)
+
+        # with asyncio engine
+        engine = AsyncMatchingEngine(self.current_app)
+        from_solr = {'response': {'numFound': 1, 'docs': [{'bibcode': '2021Mock.......A'}]}}
+
+        async def fetch(params, headers):
+            await asyncio.sleep(0.05)
+            return 200, 'OK', from_solr
+
+        async def queries():
+            return await asyncio.gather(*[engine.solr_client.query({'q': 'similar("async")', 'fl': 'bibcode', 'rows': 10}, 'similar')
+                                          for _ in range(3)])
+
+        with mock.patch.object(engine.solr_client, 'fetch', side_effect=fetch) as mock_fetch:
+            results = asyncio.run(queries())
+        self.assertEqual(mock_fetch.call_count, 1)
+        self.assertEqual(results, [(200, 'OK', from_solr)] * 3)
+        # the waiters get their own copy
+        self.assertIs(results[0][2], from_solr)
+        self.assertIsNot(results[1][2], from_solr)
+        self.assertEqual(engine.solr_client.in_flight, {})
+        self.assertEqual(solr_client.get_metrics()['query_types']['similar']['num_coalesced'], 8)
+
+        # the match that sent the query is cancelled, the others waiting on it still get the result
+        async def cancel_leader():
+            params = {'q': 'similar("cancel")', 'fl': 'bibcode', 'rows': 10}
+            leader = asyncio.ensure_future(engine.solr_client.query(params, 'similar'))
+            await asyncio.sleep(0.01)
+            waiters = [asyncio.ensure_future(engine.solr_client.query(params, 'similar')) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            results = await asyncio.gather(*waiters)
+            return leader.cancelled(), results
+
+        with mock.patch.object(engine.solr_client, 'fetch', side_effect=fetch) as mock_fetch:
+            leader_cancelled, results = asyncio.run(cancel_leader())
+        self.assertTrue(leader_cancelled)
+        self.assertEqual(mock_fetch.call_count, 1)
+        self.assertEqual(results, [(200, 'OK', from_solr)] * 2)
+        self.assertEqual(engine.solr_client.in_flight, {})
+
+        # the shared query is cancelled, the ones waiting on it fail as if solr could not be reached
+        async def cancel_query():
+            params = {'q': 'similar("cancel query")', 'fl': 'bibcode', 'rows': 10}
+            waiters = [asyncio.ensure_future(engine.solr_client.query(params, 'similar')) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            engine.solr_client.in_flight[engine.solr_client.solr_client.make_key(params)].cancel()
+            return await asyncio.gather(*waiters, return_exceptions=True)
+
+        with mock.patch.object(engine.solr_client, 'fetch', side_effect=fetch):
+            results = asyncio.run(cancel_query())
+        self.assertTrue(all(isinstance(result, requests.exceptions.ConnectionError) for result in results))
+
+    def test_get_solr_data_cache(self):
+        """
+        Test get_solr_data returning the cached result for a repeated query
+        """
+        self.current_app.config['ORACLE_SERVICE_SOLR_CACHE_ENABLED'] = True
+        self.current_app.config['ORACLE_SERVICE_SOLR_CACHE_BACKEND'] = 'memory'
+        self.current_app.solr_cache = SolrCache(self.current_app)
+
+        with mock.patch.object(self.current_app.client, 'get') as mock_requests_get:
+            mock_response = mock.Mock()
+            mock_response.status_code = 200
+            mock_response.json.return_value = {'response': {'numFound': 1, 'docs': [{'bibcode': '2022TEST..........S', 'title': ['test']}]}}
+            mock_requests_get.return_value = mock_response
+
+            # second time is from cache
+            for i in range(2):
+                result, status_code = get_solr_data(rows=1, query='title:"test"', fl='bibcode,title', query_type='similar')
+                self.assertEqual(result, [{'bibcode': '2022TEST..........S', 'title': ['test']}])
+                self.assertEqual(status_code, 200)
+            self.assertEqual(mock_requests_get.call_count, 1)
+
+            # modifying the returned result does not modify the cached one
+            result[0]['title'] = ['modified']
+            result, status_code = get_solr_data(rows=1, query='title:"test"', fl='bibcode,title', query_type='similar')
+            self.assertEqual(result, [{'bibcode': '2022TEST..........S', 'title': ['test']}])
+
+            # different rows is a different query
+            get_solr_data(rows=2, query='title:"test"', fl='bibcode,title', query_type='similar')
+            self.assertEqual(mock_requests_get.call_count, 2)
+
+            # bypass the cache
+            with self.current_app.test_request_context(headers={'X-Oracle-Solr-Cache-Bypass': 'true'}):
+                get_solr_data(rows=1, query='title:"test"', fl='bibcode,title', query_type='similar')
+            self.assertEqual(mock_requests_get.call_count, 3)
+
+            # errors are not cached
+            mock_response.status_code = 500
+            for i in range(2):
+                get_solr_data(rows=1, query='doi:"10.1000/test"', fl='bibcode', query_type='doi')
+            self.assertEqual(mock_requests_get.call_count, 5)
+
+        self.assertFalse(self.current_app.solr_cache.is_blocking)
+        metrics = self.current_app.solr_cache.get_metrics()
+        self.assertEqual(metrics['query_types']['similar'], {'hits': 2, 'misses': 2, 'bypassed': 1, 'hit_ratio': 0.5})
+        self.assertEqual(metrics['query_types']['doi'], {'hits': 0, 'misses': 2, 'bypassed': 0, 'hit_ratio': 0})
+        self.assertEqual(metrics['size'], 2)
+
+        r = self.client.get(path='/metrics')
+        self.assertEqual(r.json['solr_cache']['query_types']['similar']['hits'], 2)
+
+    def test_solr_cache_backends(self):
+        """
+        Test expiration and eviction of the solr cache, and sharing it between workers with the local backend
+        """
+        # least recently used is evicted, expired is not returned
+        backend = MemoryBackend(max_size=2)
+        backend.set('a', '1', time.time() + 60)
+        backend.set('b', '2', time.time() + 60)
+        backend.get('a')
+        backend.set('c', '3', time.time() + 60)
+        self.assertEqual(backend.get('b'), None)
+        self.assertEqual(backend.get('a')[0], '1')
+        backend.set('d', '4', time.time() - 1)
+        self.assertEqual(backend.get('d'), None)
+
+        with tempfile.NamedTemporaryFile(suffix='.sqlite') as f:
+            self.current_app.config['ORACLE_SERVICE_SOLR_CACHE_BACKEND'] = 'local'
+            self.current_app.config['ORACLE_SERVICE_SOLR_CACHE_LOCAL_PATH'] = f.name
+            worker1 = SolrCache(self.current_app)
+            worker2 = SolrCache(self.current_app)
+            # the asyncio engine reads and writes it on its thread pool
+            self.assertTrue(worker1.is_blocking)
+
+            key = SolrCache.make_key('title:"test"', 'bibcode', 1)
+            worker1.set(key, [['2022TEST..........S'], 200])
+            # found in the shared store, and kept in process after
+            self.assertEqual(worker2.backends[0].get(key), None)
+            self.assertEqual(worker2.get('similar', key), [['2022TEST..........S'], 200])
+            self.assertEqual(worker2.backends[0].get(key)[0], '[["2022TEST..........S"], 200]')
+
+            # prune the expired and the ones over max size
+            shared = worker1.backends[1]
+            shared.max_size = 1
+            shared.set('expired', '[]', time.time() - 1)
+            shared.set('other', '[]', time.time() + 60)
+            shared.prune()
+            self.assertEqual(shared.size(), 1)
+            self.assertEqual(shared.get('other')[0], '[]')
+
+    def test_async_docmatching(self):
+        """
+        Test matching with the asyncio engine, directly and through the asgi application
+        """
+        payload = {
+            'abstract': 'Mock abstract text.',
+            'title': 'Mock title text.',
+            'author': 'Mock, Author',
+            'year': 2021,
+            'doctype': 'eprint',
+        }
+        match = [{'source_bibcode': '2021arXiv........A', 'matched_bibcode': '2021Mock.......A', 'confidence': 0.99, 'matched': 1}]
+        engine = AsyncMatchingEngine(self.current_app)
+        # a batch of predictions is no larger than the number of threads that can wait on it
+        self.assertEqual(engine.predictor.max_batch_size, min(self.current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_PREDICT_SIZE'],
+                                                              self.current_app.config['ORACLE_SERVICE_ASYNC_WORKERS']))
+        solr_responses = []
+
+        async def fetch(params, headers):
+            return solr_responses.pop(0)
+
+        with mock.patch.object(engine.solr_client, 'fetch', side_effect=fetch) as mock_fetch, \
+             mock.patch('oraclesrv.doc_matching.get_matches', return_value=match) as mock_get_matches:
+            # matched with abstract
+            solr_responses.append((200, 'OK', {'response': {'numFound': 1, 'docs': [{'bibcode': '2021Mock.......A'}]}}))
+            results, status_code = asyncio.run(engine.match(payload, save=False))
+            self.assertEqual(status_code, 200)
+            self.assertEqual(results['match'], match)
+            self.assertTrue(results['query'].startswith('topn(10, similar("Mock abstract text.", input abstract'))
+            self.assertEqual(mock_fetch.call_args[0][0]['rows'], '10')
+            self.assertEqual(mock_get_matches.call_args[0][7], [{'bibcode': '2021Mock.......A'}])
+
+            # solr error is returned in the comment, same as the sync flow
+            solr_responses.append((400, 'Bad Request', None))
+            results, status_code = asyncio.run(engine.match(payload, save=False))
+            self.assertEqual(results['comment'], 'status code: 400')
+            self.assertEqual(results['no match'], 'no document was found in solr matching the request.')
+
+            # missing params
+            results, status_code = asyncio.run(engine.match(dict(payload, author=''), save=False))
+            self.assertEqual(status_code, 400)
+
+            # through the asgi application
+            asgi_app = AsyncDocMatchingApp(self.current_app)
+            asgi_app.engine = engine
+            def call_asgi(method, path, body=b'', headers=[]):
+                messages = []
+                async def receive():
+                    return {'type': 'http.request', 'body': body, 'more_body': False}
+                async def send(message):
+                    messages.append(message)
+                scope = {'type': 'http', 'method': method, 'path': path, 'root_path': '', 'headers': [(b'x-amzn-trace-id', b'trace')] + headers}
+                asyncio.run(asgi_app(scope, receive, send))
+                return messages[0]['status'], json.loads(messages[1]['body'])
+
+            solr_responses.append((200, 'OK', {'response': {'numFound': 1, 'docs': [{'bibcode': '2021Mock.......A'}]}}))
+            status_code, results = call_asgi('POST', '/docmatch', json.dumps(payload).encode('utf-8'))
+            self.assertEqual(status_code, 200)
+            self.assertEqual(results['match'], match)
+            self.assertEqual(call_asgi('POST', '/docmatch', b''), (400, {'error': 'no information received'}))
+            self.assertEqual(call_asgi('POST', '/unknown', b'{}')[0], 404)
+            self.assertEqual(call_asgi('GET', '/docmatch')[0], 405)
+
+            # docmatch_add is not served without the token, and requires it when it is set
+            self.assertEqual(call_asgi('POST', '/docmatch_add', json.dumps(payload).encode('utf-8'))[0], 404)
+            self.current_app.config['ORACLE_SERVICE_ASYNC_DOCMATCH_ADD_TOKEN'] = 'secret'
+            self.assertEqual(call_asgi('POST', '/docmatch_add', json.dumps(payload).encode('utf-8')),
+                             (401, {'error': 'not authorized to add matches'}))
+            with mock.patch('oraclesrv.async_matching.AsyncDocMatching.save_match') as mock_save_match:
+                solr_responses.append((200, 'OK', {'response': {'numFound': 1, 'docs': [{'bibcode': '2021Mock.......A'}]}}))
+                status_code, results = call_asgi('POST', '/docmatch_add', json.dumps(payload).encode('utf-8'),
+                                                 headers=[(b'authorization', b'Bearer secret')])
+                self.assertEqual(status_code, 200)
+                self.assertEqual(results['match'], match)
+                self.assertEqual(mock_save_match.call_count, 1)
+            status_code, results = call_asgi('GET', '/metrics')
+            self.assertEqual(results['num_in_flight'], 0)
+            self.assertEqual(results['solr']['query_types']['similar']['num_queries'], 4)
+        self.assertEqual(engine.solr_client.get_headers({'x-amzn-trace-id': 'trace'})['X-Amzn-Trace-Id'], 'trace')
+
+    def test_async_docmatching_flow(self):
+        """
+        Test the asyncio engine deciding the doctype off the event loop, and running the same flow as DocMatching,
+        with the queries sent ahead
+        """
+        payload = {
+            'abstract': 'Mock abstract text.',
+            'title': 'Mock title text.',
+            'author': 'Mock, Author',
+            'year': 2021,
+            'bibcode': '2021arXiv210100001M',
+            'doi': ['10.1234/mock.doi'],
+        }
+        title_match = [{'source_bibcode': '2021arXiv210100001M', 'matched_bibcode': '2021Mock.......T', 'confidence': 0.99, 'matched': 1}]
+        abstract_docs = {'response': {'numFound': 1, 'docs': [{'bibcode': '2021Mock.......A'}]}}
+        title_docs = {'response': {'numFound': 1, 'docs': [{'bibcode': '2021Mock.......T'}]}}
+        doi_docs = {'response': {'numFound': 1, 'docs': [{'bibcode': '2021Mock.......D'}]}}
+        engine = AsyncMatchingEngine(self.current_app)
+        queries = []
+
+        async def fetch(params, headers):
+            queries.append(params['q'])
+            await asyncio.sleep(0.1)
+            if 'input abstract' in params['q']:
+                return 200, 'OK', json.loads(json.dumps(abstract_docs))
+            if 'input title' in params['q']:
+                return 200, 'OK', json.loads(json.dumps(title_docs))
+            return 200, 'OK', json.loads(json.dumps(doi_docs))
+
+        async def match():
+            try:
+                return await engine.match(payload, save=False)
+            finally:
+                await engine.close()
+
+        threads = []
+        def is_eprint_bibcode(bibcode):
+            threads.append(threading.current_thread().name)
+            return True
+
+        self.current_app.config['ORACLE_SERVICE_SPECULATIVE_QUERIES_ENABLED'] = True
+        self.current_app.config['ORACLE_SERVICE_PARALLEL_TITLE_QUERY_ENABLED'] = True
+        try:
+            with mock.patch.object(engine.solr_client, 'fetch', side_effect=fetch), \
+                 mock.patch('oraclesrv.doc_matching.is_eprint_bibcode', side_effect=is_eprint_bibcode), \
+                 mock.patch('oraclesrv.doc_matching.get_doi_match', return_value=None), \
+                 mock.patch('oraclesrv.doc_matching.get_matches', side_effect=[[], title_match]) as mock_get_matches:
+                before = speculative_metrics.get_metrics()
+                start_time = time.time()
+                results, status_code = asyncio.run(match())
+                duration = time.time() - start_time
+            # doctype was decided from the bibcode on the thread pool, not on the event loop
+            self.assertEqual(len(threads), 1)
+            self.assertTrue(threads[0].startswith('async_matching'))
+            # doi did not match, abstract did not match, and title did, all three queries were sent at the same time
+            self.assertEqual(status_code, 200)
+            self.assertEqual(results['match'], title_match)
+            self.assertIn('No matches with DOI', results['comment'])
+            self.assertIn('No matches with Abstract, trying Title.', results['comment'])
+            self.assertEqual(len(queries), 3)
+            self.assertEqual(mock_get_matches.call_count, 2)
+            self.assertLess(duration, 0.25)
+            after = speculative_metrics.get_metrics()
+            self.assertEqual(after['num_sent'] - before['num_sent'], 2)
+            self.assertEqual(after['num_used'] - before['num_used'], 2)
+        finally:
+            self.current_app.config['ORACLE_SERVICE_SPECULATIVE_QUERIES_ENABLED'] = False
+            self.current_app.config['ORACLE_SERVICE_PARALLEL_TITLE_QUERY_ENABLED'] = False
+
+    @benchmark
+    def test_async_docmatching_load(self):
+        """
+        Load test comparing the asyncio engine to matching on a fixed number of threads, as the wsgi workers do,
+        when each match waits on solr
+        """
+        num_matches = 200
+        num_threads = 8
+        latency = 0.05
+        payload = {
+            'abstract': 'Mock abstract text.',
+            'title': 'Mock title text.',
+            'author': 'Mock, Author',
+            'year': 2021,
+            'doctype': 'eprint',
+        }
+        match = [{'source_bibcode': '2021arXiv........A', 'matched_bibcode': '2021Mock.......A', 'confidence': 0.99, 'matched': 1}]
+        from_solr = {'response': {'numFound': 1, 'docs': [{'bibcode': '2021Mock.......A'}]}}
+
+        # wsgi path, each thread blocks while waiting on solr
+        def get(*args, **kwargs):
+            time.sleep(latency)
+            response = mock.Mock()
+            response.status_code = 200
+            response.json.return_value = json.loads(json.dumps(from_solr))
+            return response
+
+        def sync_match(i):
+            with self.current_app.app_context():
+                return DocMatching(dict(payload, abstract='Mock abstract text %d.' % i), save=False).process()
+
+        with mock.patch.object(self.current_app.solr_client.session, 'get', side_effect=get), \
+             mock.patch('oraclesrv.doc_matching.get_matches', return_value=match):
+            start_time = time.time()
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                sync_results = list(executor.map(sync_match, range(num_matches)))
+            sync_duration = time.time() - start_time
+
+        # asyncio engine, the matches wait on solr concurrently
+        engine = AsyncMatchingEngine(self.current_app)
+        async def fetch(params, headers):
+            await asyncio.sleep(latency)
+            return 200, 'OK', json.loads(json.dumps(from_solr))
+
+        async def async_matches():
+            return await asyncio.gather(*[engine.match(dict(payload, abstract='Mock abstract text %d.' % i), save=False)
+                                          for i in range(num_matches)])
+
+        with mock.patch.object(engine.solr_client, 'fetch', side_effect=fetch), \
+             mock.patch('oraclesrv.doc_matching.get_matches', return_value=match):
+            start_time = time.time()
+            async_results = asyncio.run(async_matches())
+            async_duration = time.time() - start_time
+
+        self.assertEqual([r[0]['match'] for r in async_results], [r[0]['match'] for r in sync_results])
+        self.assertGreater(engine.max_in_flight, num_threads)
+        print('%d matches with %d ms solr latency: %d threads %.2f matches/s, asyncio %.2f matches/s, %d in flight' %
+              (num_matches, latency * 1000, num_threads, num_matches / sync_duration, num_matches / async_duration, engine.max_in_flight))
+        self.assertLess(async_duration, sync_duration)
+
+    def test_fake_solr(self):
+        """
+        Test the solr queries sent for matching end to end, over http to the fake solr
+        """
+        solr = FakeSolr(latency_ms=20, shape_latency_ms={'identifier': 5},
+                        recorded={'pubnote:("10.1000/recorded") doctype:(article)': {'response': {'numFound': 0, 'docs': []}}}).start()
+        try:
+            self.current_app.config['ORACLE_SERVICE_SOLRQUERY_URL'] = solr.url
+            self.current_app.solr_client = SolrClient(self.current_app)
+
+            start_time = time.time()
+            result, query, status_code = get_solr_data_match('dark matter halo mass function', 'Halo', 'eprint', 'article OR inproceedings', '')
+            self.assertGreaterEqual(time.time() - start_time, 0.02)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(len(result), 10)
+            self.assertEqual(result[0]['abstract'], 'dark matter halo mass function')
+            self.assertEqual(result[0]['doctype'], 'article')
+
+            result, query, status_code = get_solr_data_match_doi('"10.1000/fake.1"', 'eprint', 'article')
+            self.assertEqual(result[0]['doi'], ['10.1000/fake.1'])
+
+            result, query, status_code = get_solr_data_match_pubnote('"10.1000/fake.2"', 'article', 'eprint')
+            self.assertEqual(result[0]['doi_pubnote'], '10.1000/fake.2')
+
+            result, query, status_code = get_solr_data_match_doctype_case('Smith, John', 2020, 'article', '"phdthesis"')
+            self.assertEqual([doc['author_norm'] for doc in result], [['Smith, J']] * 3)
+
+            # recorded response
+            result, query, status_code = get_solr_data_match_pubnote('"10.1000/recorded"', 'article', 'article')
+            self.assertEqual(result, [])
+
+            self.assertEqual(solr.get_metrics(), {'similar': 1, 'identifier': 1, 'pubnote': 2, 'author_norm': 1})
+        finally:
+            solr.stop()
+
+    def test_prune_title_candidates(self):
+        """
+        Test querying solr for the candidates without their abstracts when there is no abstract to compare,
+        and pruning only the ones get_matches would discard
+        """
+        matched_docs = [
+            {'bibcode': '1990Mock.......A', 'author_norm': ['Other, C'], 'year': '1990', 'doi': ['10.1000/mock.1']},
+            {'bibcode': '1990Mock.......B', 'author_norm': ['Other, C'], 'year': '1990', 'doi': [], 'doi_pubnote': '10.1000/mock.1'},
+            {'bibcode': '1990Mock.......C', 'author_norm': ['Other, C'], 'year': '1990'},
+            {'bibcode': '2021Mock.......D', 'author_norm': ['Other, C'], 'year': '2021'},
+            {'bibcode': '1990Mock.......E', 'author_norm': ['Fake, A'], 'year': '1990'},
+        ]
+        # with no abstract to compare, kept if doi matches or any of the authors match, regardless of the year
+        for abstract in ['', 'Not Available <P />']:
+            kept, num_pruned = prune_candidates(abstract, 'Fake, A.', ['10.1000/mock.1'], matched_docs)
+            self.assertEqual([doc['bibcode'] for doc in kept], ['1990Mock.......A', '1990Mock.......B', '1990Mock.......E'])
+            self.assertEqual(num_pruned, 2)
+        # with an abstract to compare, none are pruned
+        kept, num_pruned = prune_candidates('Mock abstract text.', 'Fake, A.', ['10.1000/mock.1'], matched_docs)
+        self.assertEqual(kept, matched_docs)
+        self.assertEqual(num_pruned, 0)
+
+        solr = FakeSolr(related_ratio=0.3).start()
+        try:
+            self.current_app.config['ORACLE_SERVICE_SOLRQUERY_URL'] = solr.url
+            self.current_app.solr_client = SolrClient(self.current_app)
+            payload = {'abstract': ' '.join(['Dark matter halo mass function of galaxy clusters.'] * 20), 'title': 'Halo mass function',
+                       'author': 'Fake, A.; Standin, B.', 'year': '2021', 'doctype': 'eprint', 'match_doctype': ['article']}
+            doc_matching = DocMatching(payload, save=False)
+            doc_matching.prepare_queries()
+
+            # enabled, but with an abstract to compare all the candidates are returned with their abstracts
+            self.current_app.config['ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED'] = True
+            metrics = candidate_pruning_metrics.get_metrics()
+            results, query, status_code = doc_matching.query_solr_data_match(doc_matching.abstract, doc_matching.title)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(len(results), 10)
+            self.assertTrue(all(doc['abstract'] for doc in results))
+            self.assertEqual(solr.get_metrics(), {'similar': 1})
+            self.assertEqual(candidate_pruning_metrics.get_metrics()['num_queries'], metrics['num_queries'])
+
+            # disabled, with no abstract the candidates are still returned with their abstracts
+            self.current_app.config['ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED'] = False
+            doc_matching.abstract = 'Not Available <P />'
+            results, query, status_code = doc_matching.query_solr_data_match('', doc_matching.title)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(len(results), 10)
+            self.assertEqual(solr.get_metrics(), {'similar': 2})
+            with_abstract_bytes = solr.get_bytes()['similar']
+
+            # enabled, with no abstract the candidates by other authors are pruned, and none have their abstracts
+            self.current_app.config['ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED'] = True
+            results, query, status_code = doc_matching.query_solr_data_match('', doc_matching.title)
+            self.assertEqual(status_code, 200)
+            self.assertEqual(len(results), 3)
+            self.assertTrue(all(doc['author_norm'] == ['Fake, A', 'Standin, B'] and 'abstract' not in doc for doc in results))
+            self.assertEqual(solr.get_metrics(), {'similar': 3})
+            self.assertEqual(candidate_pruning_metrics.get_metrics()['num_pruned'] - metrics['num_pruned'], 7)
+            self.assertLess(solr.get_bytes()['similar'] - with_abstract_bytes, with_abstract_bytes)
+
+            # the same with asyncio engine
+            engine = AsyncMatchingEngine(self.current_app)
+            async_doc_matching = AsyncDocMatching(engine, dict(payload, abstract='Not Available <P />'), save=False)
+            async_doc_matching.prepare_queries()
+
+            async def query():
+                try:
+                    return await async_doc_matching.query_solr_data_match('', async_doc_matching.title)
+                finally:
+                    await engine.close()
+
+            results, query, status_code = asyncio.run(query())
+            self.assertEqual(status_code, 200)
+            self.assertEqual(len(results), 3)
+            self.assertEqual(solr.get_metrics(), {'similar': 4})
+        finally:
+            self.current_app.config['ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED'] = False
+            solr.stop()
+
+    @mock.patch('oraclesrv.doc_matching.get_db_match', return_value=[])
+    @mock.patch('oraclesrv.score.get_a_record', return_value=None)
+    def test_prune_title_candidates_same_matches(self, mock_get_a_record, mock_get_db_match):
+        """
+        Test that the matches are the same with pruning the candidates of the query on title on and off
+        """
+        solr = FakeSolr(related_ratio=0.3).start()
+        try:
+            self.current_app.config['ORACLE_SERVICE_SOLRQUERY_URL'] = solr.url
+            self.current_app.solr_client = SolrClient(self.current_app)
+            payloads = [
+                {'abstract': ' '.join(['Dark matter halo mass function of galaxy clusters.'] * 20), 'title': 'Halo mass function',
+                 'author': 'Fake, A.; Standin, B.', 'year': '2021', 'doctype': 'eprint', 'match_doctype': ['article']},
+                {'abstract': 'Not Available <P />', 'title': 'Halo mass function of galaxy clusters',
+                 'author': 'Fake, A.; Standin, B.', 'year': '2021', 'doctype': 'eprint', 'match_doctype': ['article']},
+                {'abstract': '', 'title': 'Halo mass function of galaxy clusters',
+                 'author': 'Other, C.', 'year': '1995', 'doctype': 'eprint', 'match_doctype': ['article']},
+                {'abstract': '', 'title': 'Halo mass function of galaxy clusters',
+                 'author': 'Nobody, X.', 'year': '2021', 'doctype': 'eprint', 'match_doctype': ['article']},
+            ]
+            for payload in payloads:
+                results = []
+                for prune in [False, True]:
+                    self.current_app.config['ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED'] = prune
+                    doc_matching = DocMatching(payload, save=False)
+                    doc_matching.prepare_queries()
+                    results.append(doc_matching.query_abstract_or_title(comment=''))
+                self.assertEqual(results[0], results[1])
+        finally:
+            self.current_app.config['ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED'] = False
+            solr.stop()
+
+    def test_benchmark(self):
+        """
+        Test the benchmark driver against the service, with the fake solr
+        """
+        from werkzeug.serving import make_server
+
+        self.assertEqual(get_percentile([], 50), 0)
+        self.assertEqual(get_percentile(list(range(1, 101)), 50), 50)
+        self.assertEqual(get_percentile(list(range(1, 101)), 99), 99)
+        self.assertEqual(get_percentile([5], 95), 5)
+
+        payloads = make_payloads(6, doi_ratio=0.5)
+        self.assertEqual(payloads, make_payloads(6, doi_ratio=0.5))
+        self.assertEqual(len(payloads[0]['bibcode']), 19)
+
+        solr = FakeSolr(latency_ms=10).start()
+        self.current_app.config['ORACLE_SERVICE_SOLRQUERY_URL'] = solr.url
+        self.current_app.solr_client = SolrClient(self.current_app)
+        server = make_server('127.0.0.1', 0, self.current_app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/docmatch' % server.server_port
+            for concurrency in [1, 3]:
+                result = run_benchmark(url, payloads, concurrency, num_requests=6)
+                self.assertEqual(result['num_requests'], 6)
+                self.assertEqual(result['num_errors'], 0)
+                self.assertGreater(result['requests_per_second'], 0)
+                self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+                self.assertLessEqual(result['p95_ms'], result['p99_ms'])
+                self.assertGreaterEqual(result['p50_ms'], 10)
+            self.assertGreaterEqual(sum(solr.get_metrics().values()), 12)
+        finally:
+            server.shutdown()
+            thread.join()
+            solr.stop()
 
 if __name__ == "__main__":
     unittest.main()
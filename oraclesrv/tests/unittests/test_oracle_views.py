@@ -6,8 +6,10 @@ sys.path.append(PROJECT_HOME)
 
 import unittest
 import json
+import threading
 import mock
 import requests
+from sqlalchemy.exc import SQLAlchemyError
 from flask import jsonify
 from datetime import datetime
 
@@ -17,6 +19,8 @@ from oraclesrv.tests.unittests.base import TestCaseDatabase
 from oraclesrv.views import get_user_info_from_adsws, cleanup, list_tmps, list_multis, get_the_reader, read_history, \
     docmatch, verify_the_function
 from oraclesrv.score import clean_metadata
+from oraclesrv.jobs import start_cleanup_job, mark_stale_cleanup_jobs
+from oraclesrv.utils import add_cleanup_job, update_cleanup_job
 
 
 class test_views(TestCaseDatabase):
@@ -154,6 +158,59 @@ class test_views(TestCaseDatabase):
             account = get_user_info_from_adsws('???')
             self.assertEqual(account, None)
 
+    def test_docmatch_batch_endpoint(self):
+        """
+        Test docmatch_batch and docmatch_add_batch endpoints
+        """
+        payload = [{'bibcode': '2021arXiv21010000%dS' % i, 'abstract': 'abstract %d' % i, 'title': 'title %d' % i,
+                    'author': 'Smith, J', 'year': '2021', 'doctype': 'eprint'} for i in range(5)]
+
+        def create_doc_matching(record, save, predictor):
+            """ match of each record has its bibcode, the third one fails """
+            doc_matching = mock.Mock()
+            if record['bibcode'].endswith('2S'):
+                doc_matching.process.side_effect = Exception('mock exception')
+            else:
+                doc_matching.process.return_value = ({'query': 'mock query', 'match': [{'source_bibcode': record['bibcode']}]}, 200)
+            return doc_matching
+
+        for path, save in [('/docmatch_batch', False), ('/docmatch_add_batch', True)]:
+            with mock.patch('oraclesrv.views.DocMatching', side_effect=create_doc_matching) as mock_doc_matching:
+                r = self.client.post(path=path, data=json.dumps(payload))
+                self.assertEqual(r.status_code, 200)
+                self.assertEqual(r.headers['content-type'], 'application/x-ndjson')
+                lines = [json.loads(line) for line in r.data.decode('utf-8').strip().split('\n')]
+
+                # one line per record, in any order
+                self.assertEqual(sorted(line['index'] for line in lines), list(range(len(payload))))
+                for line in lines:
+                    if line['index'] == 2:
+                        self.assertEqual(line['status_code'], 500)
+                        self.assertEqual(line['results'], {'error': 'unable to match the document: mock exception'})
+                    else:
+                        self.assertEqual(line['status_code'], 200)
+                        self.assertEqual(line['results']['match'][0]['source_bibcode'], payload[line['index']]['bibcode'])
+
+                # all records share one predictor, and are saved only when adding
+                self.assertEqual(mock_doc_matching.call_count, len(payload))
+                predictors = set(call[1]['predictor'] for call in mock_doc_matching.call_args_list)
+                self.assertEqual(len(predictors), 1)
+                # a batch is no larger than the number of workers that can wait on it
+                self.assertEqual(predictors.pop().max_batch_size, min(self.current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_PREDICT_SIZE'],
+                                                                      self.current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_WORKERS'], len(payload)))
+                self.assertTrue(all(call[1]['save'] == save for call in mock_doc_matching.call_args_list))
+
+        # not a list
+        r = self.client.post(path='/docmatch_batch', data=json.dumps(payload[0]))
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.json, {'error': 'no list of documents received'})
+
+        # too many
+        self.current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_MAX_RECORDS'] = 2
+        r = self.client.post(path='/docmatch_batch', data=json.dumps(payload))
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(r.json, {'error': 'too many documents to match at one time, received 5 documents while the limit is 2'})
+
     @mock.patch('oraclesrv.utils.query_eprint_bibstem')
     def test_docmatch_endpoint_metadata(self, mock_query_eprint_bibstem):
         """
@@ -673,6 +730,89 @@ class test_views(TestCaseDatabase):
             result = json.loads(r.data)
             self.assertDictEqual(result, {'params': {'rows': 2000, 'start': 0, 'days': 30, 'date_cutoff': '2024-11-09 00:00:00'}, 'results': in_db})
 
+    @mock.patch("oraclesrv.views.export_docmatch")
+    def test_export_endpoint(self, mock_export_docmatch):
+        """
+        Test export endpoint streaming newline delimited json, with and without days param
+        """
+        in_db = [
+                    ('2018arXiv180310259Z', '2017PhDT........67Z', 0.8730186),
+                    ('2017arXiv171011147R', '2018Natur.556..473R', 0.8745491),
+                    ('2019arXiv190500882A', '2019JHEP...06..121A', 0.8960806),
+                ]
+        mock_export_docmatch.return_value = iter(in_db)
+
+        r = self.client.get(path='/export')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['content-type'], 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in r.data.decode('utf-8').splitlines()], [list(row) for row in in_db])
+        self.assertEqual(str(mock_export_docmatch.call_args[0][0]), '1972-01-01 00:00:00+00:00')
+
+        # test when days param is included
+        with mock.patch("oraclesrv.views.get_date") as mock_get_date:
+            mock_get_date.return_value = datetime(2024, 12, 9, 0, 0, 0)
+            mock_export_docmatch.return_value = iter(in_db[:1])
+
+            r = self.client.get(path='/export?days=30')
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual([json.loads(line) for line in r.data.decode('utf-8').splitlines()], [list(in_db[0])])
+            self.assertEqual(mock_export_docmatch.call_args[0][0], datetime(2024, 11, 9, 0, 0, 0))
+
+        # test when reading from db fails midway, the last line has the error
+        def export_with_error(date_cutoff):
+            yield in_db[0]
+            raise SQLAlchemyError('connection lost')
+        mock_export_docmatch.side_effect = export_with_error
+        r = self.client.get(path='/export')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual([json.loads(line) for line in r.data.decode('utf-8').splitlines()],
+                         [list(in_db[0]), {'error': 'SQLAlchemy: connection lost', 'count': 1}])
+        mock_export_docmatch.side_effect = None
+
+        # test when days param is invalid
+        r = self.client.get(path='/export?days=thirty')
+        self.assertEqual(r.status_code, 400)
+        self.assertEqual(json.loads(r.data), {'error': 'invalid value for parameter `days`: thirty'})
+
+    def test_metrics_endpoint(self):
+        """
+        Test metrics endpoint with and without write behind enabled
+        """
+        self.current_app.write_behind = None
+        r = self.client.get(path='/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn('write_behind', json.loads(r.data))
+
+        self.current_app.write_behind = mock.Mock()
+        self.current_app.write_behind.get_metrics.return_value = {'queue_depth': 3, 'num_flushes': 1}
+        try:
+            r = self.client.get(path='/metrics')
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(json.loads(r.data)['write_behind'], {'queue_depth': 3, 'num_flushes': 1})
+        finally:
+            self.current_app.write_behind = None
+
+    def test_metrics_endpoint_db(self):
+        """
+        Test metrics endpoint reports the connection pool and the timing of db helper functions
+        """
+        r = self.client.get(path='/source_score')
+        self.assertEqual(r.status_code, 200)
+
+        r = self.client.get(path='/metrics')
+        self.assertEqual(r.status_code, 200)
+        results = json.loads(r.data)
+
+        pool = results['db_pool']['primary']
+        self.assertEqual(pool['pool_class'], 'QueuePool')
+        self.assertEqual(pool['size'], self.current_app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_size'])
+        for name in ['checkedin', 'checkedout', 'overflow', 'max_overflow', 'num_checkout_errors']:
+            self.assertIn(name, pool)
+        self.assertGreater(pool['checkout_wait']['count'], 0)
+        self.assertEqual(sum(pool['checkout_wait']['buckets_ms'].values()), pool['checkout_wait']['count'])
+
+        self.assertGreater(results['db_queries']['get_confidence_lookup']['count'], 0)
+
     @mock.patch('oraclesrv.utils.query_eprint_bibstem')
     def test_get_match_for_doi_in_pubnote(self, mock_query_eprint_bibstem):
         """
@@ -733,34 +873,121 @@ class test_views(TestCaseDatabase):
                                'confidence': 0.9859276, 'matched': 1,
                                'scores': {'abstract': 0.98, 'title': 0.65, 'author': 1, 'year': 1, 'doi': 1}}])
 
+    def run_cleanup_job(self, return_value, path='/cleanup'):
+        """
+        start a cleanup job with clean_db mocked, and wait for it to finish
+        """
+        threads = []
+        def start(full):
+            job_id, thread, status_code = start_cleanup_job(full)
+            threads.append(thread)
+            return job_id, thread, status_code
+
+        with mock.patch('oraclesrv.utils.clean_db', return_value=return_value) as mock_clean_db, \
+             mock.patch('oraclesrv.views.start_cleanup_job', side_effect=start):
+            r = self.client.get(path=path)
+            self.assertEqual(r.status_code, 202)
+            threads[0].join(10)
+            self.assertFalse(threads[0].is_alive())
+        return r.json['job_id'], mock_clean_db
+
     def test_cleanup_endpoint_get(self):
         """
         Test cleanup endpoint
         """
         # test when there is an error
         return_value = {'count_deleted_tmp': -1, 'count_updated_canonical': -1, 'count_deleted_multi_matches': -1}, 'some sqlalchemy error'
-        with mock.patch('oraclesrv.utils.clean_db', return_value=return_value):
-            response = cleanup()
-            self.assertEqual(response.status_code, 400)
-            self.assertEqual(json.loads(response.data), {"details": "unable to perform the cleanup, ERROR: some sqlalchemy error"})
+        job_id, _ = self.run_cleanup_job(return_value)
+        r = self.client.get(path='/cleanup/%s' % job_id)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json['status'], 'failed')
+        self.assertEqual(r.json['details'], 'unable to perform the cleanup, ERROR: some sqlalchemy error')
 
         # test when success
         return_value = {'count_deleted_tmp': 12, 'count_updated_canonical': 3, 'count_deleted_multi_matches': 5}, ''
-        with mock.patch('oraclesrv.utils.clean_db', return_value=return_value):
-            response = cleanup()
-            self.assertEqual(response.status_code, 200)
-            self.assertEqual(json.loads(response.data),  {'details': 'Successfully removed 12 matches having tmp bibcode while matches with canonical bibcode exists. '
-                                                                     'Successfully replaced 3 tmp matches with its canonical bibcode. '
-                                                                     'Successfully removed 5 matches having multiple matches, kept the match with highest confidence.'})
+        job_id, _ = self.run_cleanup_job(return_value)
+        r = self.client.get(path='/cleanup/%s' % job_id)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json['status'], 'succeeded')
+        self.assertEqual(r.json['phase'], 'done')
+        self.assertEqual(r.json['counts'], return_value[0])
+        self.assertEqual(r.json['details'], 'Successfully removed 12 matches having tmp bibcode while matches with canonical bibcode exists. '
+                                            'Successfully replaced 3 tmp matches with its canonical bibcode. '
+                                            'Successfully removed 5 matches having multiple matches, kept the match with highest confidence.')
 
         # test when database is clean
         return_value = {'count_deleted_tmp': 0, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 0}, ''
-        with mock.patch('oraclesrv.utils.clean_db', return_value=return_value):
+        job_id, _ = self.run_cleanup_job(return_value)
+        r = self.client.get(path='/cleanup/%s' % job_id)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json['details'], 'No duplicate (tmp and canoncial) records found. '
+                                            'No tmp bibcode was updated with the canonical bibcode. '
+                                            'No multiple match records found.')
+
+        # test when unable to start the job
+        with mock.patch('oraclesrv.utils.add_cleanup_job', return_value=None):
             response = cleanup()
-            self.assertEqual(response.status_code, 200)
-            self.assertEqual(json.loads(response.data),  {'details': 'No duplicate (tmp and canoncial) records found. '
-                                                                     'No tmp bibcode was updated with the canonical bibcode. '
-                                                                     'No multiple match records found.'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.data), {'details': 'unable to start the cleanup job'})
+
+        # test unknown job
+        r = self.client.get(path='/cleanup/unknown')
+        self.assertEqual(r.status_code, 404)
+        self.assertEqual(r.json, {'error': 'no cleanup job with id unknown'})
+
+    def test_cleanup_endpoint_one_job_at_a_time(self):
+        """
+        Test cleanup endpoint rejects a new job while another is queued or running, and that a job left running
+        by a worker that has gone away is marked as failed
+        """
+        return_value = {'count_deleted_tmp': 0, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 0}, ''
+        started = threading.Event()
+        release = threading.Event()
+        def clean_db(full, progress=None):
+            started.set()
+            release.wait(10)
+            return return_value
+
+        with mock.patch('oraclesrv.utils.clean_db', side_effect=clean_db):
+            job_id, thread, status_code = start_cleanup_job()
+            self.assertEqual(status_code, 200)
+            self.assertTrue(started.wait(10))
+            r = self.client.get(path='/cleanup')
+            self.assertEqual(r.status_code, 409)
+            self.assertEqual(r.json, {'error': 'a cleanup job is queued or running already', 'job_id': job_id})
+            release.set()
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        r = self.client.get(path='/cleanup/%s' % job_id)
+        self.assertEqual(r.json['status'], 'succeeded')
+
+        # a job that is left running, without holding the lock, is stale
+        job_id = add_cleanup_job()
+        update_cleanup_job(job_id, status='running', phase='delete_tmp_matches')
+        self.assertEqual(mark_stale_cleanup_jobs(self.current_app), 1)
+        r = self.client.get(path='/cleanup/%s' % job_id)
+        self.assertEqual(r.json['status'], 'failed')
+        self.assertEqual(r.json['message'], 'the job was stopped before it finished')
+
+        # and does not keep a new job from starting
+        stale_job_id = add_cleanup_job()
+        job_id, _ = self.run_cleanup_job(return_value)
+        r = self.client.get(path='/cleanup/%s' % job_id)
+        self.assertEqual(r.json['status'], 'succeeded')
+        r = self.client.get(path='/cleanup/%s' % stale_job_id)
+        self.assertEqual(r.json['status'], 'failed')
+
+    def test_cleanup_endpoint_full(self):
+        """
+        Test cleanup endpoint passes parameter full to clean_db
+        """
+        return_value = {'count_deleted_tmp': 0, 'count_updated_canonical': 0, 'count_deleted_multi_matches': 0}, ''
+        job_id, mock_clean_db = self.run_cleanup_job(return_value)
+        self.assertEqual(mock_clean_db.call_args[0][0], False)
+        job_id, mock_clean_db = self.run_cleanup_job(return_value, path='/cleanup?full=true')
+        self.assertEqual(mock_clean_db.call_args[0][0], True)
+        r = self.client.get(path='/cleanup/%s' % job_id)
+        self.assertEqual(r.json['full'], True)
 
     def test_list_tmps_get(self):
         """
@@ -777,6 +1004,51 @@ class test_views(TestCaseDatabase):
                              {'count': 2, 'results': [['2016arXiv160107986H', '2016LMaPh.tmp...85H', 1.1],
                                                       ['2019arXiv190306398S', '2019WatWa.tmp...13S', 0.9790447]]})
 
+        # a page at a time
+        with mock.patch('oraclesrv.utils.get_tmp_bibcodes', return_value=return_value) as mock_get_tmp_bibcodes:
+            r = self.client.get(path='/list_tmps?start=10&rows=2')
+            self.assertEqual(r.status_code, 200)
+            mock_get_tmp_bibcodes.assert_called_with(10, 2)
+            r = self.client.get(path='/list_tmps')
+            mock_get_tmp_bibcodes.assert_called_with(0, None)
+            r = self.client.get(path='/list_tmps?start=ten')
+            self.assertEqual(r.status_code, 400)
+            self.assertEqual(r.json, {'error': 'invalid value for parameter `start` or `rows`'})
+            r = self.client.get(path='/list_tmps?start=-1')
+            self.assertEqual(r.status_code, 400)
+            self.assertEqual(r.json, {'error': 'invalid value for parameter `start` or `rows`'})
+
+        # error from db
+        with mock.patch('oraclesrv.utils.get_tmp_bibcodes', return_value=(None, 'SQLAlchemy: error')):
+            r = self.client.get(path='/list_tmps')
+            self.assertEqual(r.status_code, 400)
+            self.assertEqual(r.json, {'error': 'SQLAlchemy: error'})
+
+        # count only, records are not fetched
+        with mock.patch('oraclesrv.utils.count_tmp_bibcodes', return_value=(2, 200)), \
+             mock.patch('oraclesrv.utils.get_tmp_bibcodes') as mock_get_tmp_bibcodes:
+            r = self.client.get(path='/list_tmps?count_only=true')
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.json, {'count': 2})
+            mock_get_tmp_bibcodes.assert_not_called()
+
+        # streamed
+        with mock.patch('oraclesrv.utils.stream_tmp_bibcodes', return_value=iter(return_value[0])):
+            r = self.client.get(path='/list_tmps?stream=true')
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.headers['content-type'], 'application/x-ndjson')
+            self.assertEqual([json.loads(line) for line in r.data.decode('utf-8').strip().split('\n')], return_value[0])
+
+        # streamed, and reading from db fails midway
+        def stream_tmp_bibcodes():
+            yield return_value[0][0]
+            raise SQLAlchemyError('error')
+        with mock.patch('oraclesrv.utils.stream_tmp_bibcodes', side_effect=stream_tmp_bibcodes):
+            r = self.client.get(path='/list_tmps?stream=true')
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual([json.loads(line) for line in r.data.decode('utf-8').strip().split('\n')],
+                             [return_value[0][0], {'error': 'SQLAlchemy: error', 'count': 1}])
+
     def test_list_multis_get(self):
         """
         Test list_multis endpoint
@@ -792,6 +1064,28 @@ class test_views(TestCaseDatabase):
                              {'count': 2, 'results': [['1995hep.ph....2279S', '1995PThPS.120...57S', 1.1],
                                                       ['1995hep.ph....2279S', '2013PThPS.120...57S', -1]]})
 
+        # a page at a time
+        with mock.patch('oraclesrv.utils.get_muti_matches', return_value=return_value) as mock_get_muti_matches:
+            r = self.client.get(path='/list_multis?start=10&rows=2')
+            self.assertEqual(r.status_code, 200)
+            mock_get_muti_matches.assert_called_with(10, 2)
+            r = self.client.get(path='/list_multis')
+            mock_get_muti_matches.assert_called_with(0, None)
+            r = self.client.get(path='/list_multis?rows=two')
+            self.assertEqual(r.status_code, 400)
+            self.assertEqual(r.json, {'error': 'invalid value for parameter `start` or `rows`'})
+            for path in ['/list_multis?start=-1', '/list_multis?rows=-2']:
+                r = self.client.get(path=path)
+                self.assertEqual(r.status_code, 400)
+                self.assertEqual(r.json, {'error': 'invalid value for parameter `start` or `rows`'})
+            mock_get_muti_matches.assert_called_with(0, None)
+
+        # error from db
+        with mock.patch('oraclesrv.utils.get_muti_matches', return_value=(None, 'SQLAlchemy: error')):
+            r = self.client.get(path='/list_multis')
+            self.assertEqual(r.status_code, 400)
+            self.assertEqual(r.json, {'error': 'SQLAlchemy: error'})
+
     @mock.patch("oraclesrv.views.current_app.client.get")
     def test_get_user_info_from_adsws(self, mock_get):
         """
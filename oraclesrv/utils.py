@@ -1,52 +1,84 @@
 
 import re
+import io
+import csv
+import json
+import time
+import uuid
+import threading
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import current_app
 import requests
 import flask
+import psycopg2
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import or_, and_, desc, func, distinct
-from sqlalchemy.sql import exists
+from sqlalchemy import or_, and_, desc, func, tuple_, case
+from sqlalchemy.sql import literal_column, select, text
 from sqlalchemy.dialects.postgresql import insert
 
-from oraclesrv.models import DocMatch, ConfidenceLookup, EPrintBibstemLookup
+from oraclesrv.db_metrics import timed_query
+from oraclesrv.models import DocMatch, ConfidenceLookup, EPrintBibstemLookup, BestMatch, DocMatchChange, CleanupJob, DOIIndex
 
 re_doi = re.compile(r'\bdoi:\s*(10\.[\d\.]{2,9}/\S+\w)', re.IGNORECASE)
-def get_solr_data(rows, query, fl):
+def read_session_scope():
+    """
+    session for the read only queries, from the read replica if one is configured, otherwise from the primary
+
+    :return:
+    """
+    if getattr(current_app, 'read_session_scope', None):
+        return current_app.read_session_scope()
+    return current_app.session_scope()
+
+def is_solr_cache_bypassed():
+    """
+    for debugging, the solr cache is bypassed when the request has header X-Oracle-Solr-Cache-Bypass set to true
+
+    :return:
+    """
+    return flask.has_request_context() and \
+           flask.request.headers.get('X-Oracle-Solr-Cache-Bypass', 'false').lower() == 'true'
+
+def get_solr_data(rows, query, fl, query_type='other'):
     """
 
     :param rows:
     :param query:
+    :param fl:
+    :param query_type: kind of query, metrics of the solr client and hit ratios of the solr cache are kept per query type
     :return:
     """
-    result = []
-
-    if current_app.config['REQUESTS_CONNECTION_POOL_ENABLED']:
-        response = current_app.client.get(
-            url=current_app.config['ORACLE_SERVICE_SOLRQUERY_URL'],
-            headers={'Authorization': 'Bearer ' + current_app.config['ORACLE_SERVICE_ADSWS_API_TOKEN']},
-            params={'fl': fl, 'rows': rows, 'q': query},
-            timeout=current_app.config.get('API_TIMEOUT', 60)
-        )
-    else:
-        new_headers = {}
-        if flask.has_request_context():
-            # Propagate key information from the original request
-            new_headers[u'X-Original-Uri'] = flask.request.headers.get(u'X-Original-Uri', u'-')
-            new_headers[u'X-Original-Forwarded-For'] = flask.request.headers.get(u'X-Original-Forwarded-For', u'-')
-            new_headers[u'X-Forwarded-For'] = flask.request.headers.get(u'X-Forwarded-For', u'-')
-            new_headers[u'X-Amzn-Trace-Id'] = flask.request.headers.get(u'X-Amzn-Trace-Id', '-')
-        new_headers[u'Authorization'] = 'Bearer ' + current_app.config['ORACLE_SERVICE_ADSWS_API_TOKEN']
-        response = requests.get(
-            url=current_app.config['ORACLE_SERVICE_SOLRQUERY_URL'],
-            headers=new_headers,
-            params={'fl': fl, 'rows': rows, 'q': query},
-            timeout=current_app.config.get('API_TIMEOUT', 60)
-        )
+    # if the same query was sent recently, return the cached result
+    solr_cache = getattr(current_app, 'solr_cache', None)
+    if solr_cache:
+        cache_key = solr_cache.make_key(query, fl, rows)
+        if is_solr_cache_bypassed():
+            solr_cache.record(query_type, 'bypassed')
+        else:
+            cached = solr_cache.get(query_type, cache_key)
+            if cached is not None:
+                return cached[0], cached[1]
 
+    response = current_app.solr_client.query({'fl': fl, 'rows': rows, 'q': query}, query_type)
     response.raise_for_status()
 
-    from_solr = response.json()
+    result = get_solr_docs(response.json(), fl)
+
+    if solr_cache and response.status_code == 200:
+        solr_cache.set(cache_key, [result, response.status_code])
+    return result, response.status_code
+
+def get_solr_docs(from_solr, fl):
+    """
+    extract the docs from solr response
+
+    :param from_solr: decoded json response
+    :param fl:
+    :return: list of bibcodes if only bibcode was requested, otherwise list of docs
+    """
+    result = []
     num_docs = from_solr['response'].get('numFound', 0)
     if num_docs > 0:
         current_app.logger.debug('Got {num_docs} records from solr.'.format(num_docs=num_docs))
@@ -60,56 +92,98 @@ def get_solr_data(rows, query, fl):
                 result.append(doc['bibcode'])
             else:
                 result.append(doc)
-        return result, response.status_code
-    return result, response.status_code
+    return result
+
+def fetch_solr_chunk(solr_client, params):
+    """
+    query solr for one chunk, the client retries when the request fails or solr returns a server error
+
+    :param solr_client:
+    :param params:
+    :return: list of docs and status code, or None and the status code/exception on failure
+    """
+    try:
+        response = solr_client.query(params, query_type='chunk')
+    except requests.exceptions.RequestException as e:
+        return None, e
+    if response.status_code != 200:
+        return None, response.status_code
+
+    # make sure solr found the documents
+    from_solr = response.json()
+    if from_solr.get('response'):
+        return from_solr['response']['docs'], 200
+    return [], 200
 
 def get_solr_data_chunk(bibcodes, fl='bibcode, identifier'):
     """
-    need to grab bibcodes from solr in chunk because of query length to send to solr
+    need to grab bibcodes from solr in chunk because of query length to send to solr,
+    the chunks are sent concurrently over the keep-alive pool of the solr client
 
     :param bibcodes:
     :param fl:
     :return:
     """
-    url = current_app.config['ORACLE_SERVICE_SOLRQUERY_URL']
-    headers = {'Authorization': 'Bearer ' + current_app.config['ORACLE_SERVICE_ADSWS_API_TOKEN']}
-    params = {
-        'wt': 'json',
-        'start': 0,
-        'sort': 'date desc, bibcode desc',
-        'fl': fl,
-    }
-
-    docs = []
     max_bibcodes = current_app.config['ORACLE_SERVICE_MAX_RECORDS_SOLRQUERY']
+    chunks_params = []
     for i in range(0, len(bibcodes), max_bibcodes):
         slice_bibcodes = slice(i, i + max_bibcodes, 1)
+        chunks_params.append({
+            'wt': 'json',
+            'start': 0,
+            'sort': 'date desc, bibcode desc',
+            'fl': fl,
+            'q': 'identifier:("' + '" OR "'.join(bibcodes[slice_bibcodes]) + '")',
+            'rows': len(bibcodes[slice_bibcodes]),
+        })
+    if not chunks_params:
+        return [], 200
+
+    solr_client = current_app.solr_client
+    max_workers = max(1, min(current_app.config.get('ORACLE_SERVICE_SOLRQUERY_CHUNK_CONCURRENCY', 1), len(chunks_params)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda params: fetch_solr_chunk(solr_client, params), chunks_params))
 
-        params['q'] = 'identifier:("' + '" OR "'.join(bibcodes[slice_bibcodes]) + '")'
-        params['rows'] = len(bibcodes[slice_bibcodes])
+    docs = []
+    for chunk_docs, status in results:
+        if chunk_docs is None:
+            return None, status
+        docs += chunk_docs
+    return docs, 200
 
-        try:
-            response = requests.get(
-                url=url,
-                params=params,
-                headers=headers,
-                timeout=60
-            )
-
-            if (response.status_code != 200):
-                return None, response.status_code
-
-            # make sure solr found the documents
-            from_solr = response.json()
-            if (from_solr.get('response')):
-                num_rows = len(from_solr['response']['docs'])
-                if num_rows > 0:
-                    docs += from_solr['response']['docs']
-
-        except requests.exceptions.RequestException as e:
-            return None, e
+solr_executor_lock = threading.Lock()
+def get_solr_executor():
+    """
+    pool of ORACLE_SERVICE_SOLRQUERY_WORKERS threads shared by all the requests of the app,
+    to send solr queries in the background
 
-    return docs, 200
+    :return:
+    """
+    with solr_executor_lock:
+        executor = current_app.extensions.get('solr_executor', None)
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=current_app.config['ORACLE_SERVICE_SOLRQUERY_WORKERS'],
+                                          thread_name_prefix='solr_query')
+            current_app.extensions['solr_executor'] = executor
+        return executor
+
+def submit_solr_query(func, *args):
+    """
+    call func in the background, within the current request if there is one, otherwise within the current app,
+    so that it has access to the config, client, and request headers
+
+    :param func:
+    :param args:
+    :return: future
+    """
+    if flask.has_request_context():
+        target = flask.copy_current_request_context(func)
+    else:
+        app = current_app._get_current_object()
+        def target(*target_args):
+            with app.app_context():
+                return func(*target_args)
+    return get_solr_executor().submit(target, *args)
 
 def get_solr_data_recommend(function, reader, rows=5, sort='entry_date', cutoff_days=5, top_n_reads=10):
     """
@@ -125,7 +199,7 @@ def get_solr_data_recommend(function, reader, rows=5, sort='entry_date', cutoff_
                function=function, topn=top_n_reads, reader=reader, sort=sort, cutoff_days=cutoff_days)
 
     try:
-        result, status_code = get_solr_data(rows, query, fl='bibcode')
+        result, status_code = get_solr_data(rows, query, fl='bibcode', query_type='recommend')
     except requests.exceptions.HTTPError as e:
         current_app.logger.error(e)
         result = {'error from solr':'%d: %s'%(e.response.status_code, e.response.reason)}
@@ -135,15 +209,16 @@ def get_solr_data_recommend(function, reader, rows=5, sort='entry_date', cutoff_
 
 re_hyphenated_word = re.compile(r'\w+\-\w+\s*')
 re_punctuation = re.compile(r'[^\w\s]')
-def get_solr_data_match(abstract, title, doctype, match_doctype, extra_filter):
+def get_solr_params_match(abstract, title, match_doctype, extra_filter, with_abstract=True):
     """
 
     :param abstract:
     :param title:
-    :param doctype:
     :param match_doctype:
     :param extra_filter:
-    :return:
+    :param with_abstract: if False the abstracts of the candidates are not returned, for when there is no abstract
+                          to compare them with
+    :return: rows, query, fl, and query type to send to get_solr_data, None if there is neither abstract nor title
     """
     rows = 10
     # if there is an abstract, query solr on abstract, otherwise query on title
@@ -157,11 +232,75 @@ def get_solr_data_match(abstract, title, doctype, match_doctype, extra_filter):
         query = 'topn({rows}, similar("{title}", input title, {number_matched_terms_title}, 1, 1)) doctype:({match_doctype}) {extra_filter}'.format(rows=rows,
                           title=title, number_matched_terms_title=max(1, int(title.count(' ') * 0.9)), match_doctype=match_doctype, extra_filter=extra_filter)
     else:
-        return [], '', 200
+        return None
+    if not with_abstract:
+        return rows, query.strip(), 'bibcode,title,author_norm,year,doctype,doi,identifier,property,pubnote', 'similar'
+    return rows, query.strip(), 'bibcode,abstract,title,author_norm,year,doctype,doi,identifier,property,pubnote', 'similar'
+
+def get_solr_params_match_doi(doi, match_doctype):
+    """
+
+    :param doi:
+    :param match_doctype:
+    :return: rows, query, fl, and query type to send to get_solr_data
+    """
+    # remove REFEREED for now, but return the property in the results to used it in scoring
+    # also remove the doctype, if there is a doi, just query doi for now
+    # query = 'doi:"{doi}" doctype:({doctype}) property:REFEREED'.format(doi=doi, doctype=doctype)
+    query = 'identifier:({doi}) doctype:({match_doctype})'.format(doi=doi, match_doctype=match_doctype)
+    return 1, query, 'bibcode,doi,abstract,title,author_norm,year,doctype,doi,identifier,property,pubnote', 'doi'
 
+def get_solr_params_match_pubnote(doi, match_doctype):
+    """
+
+    :param doi:
+    :param match_doctype:
+    :return: rows, query, fl, and query type to send to get_solr_data
+    """
+    query = 'pubnote:({doi}) doctype:({match_doctype})'.format(doi=doi, match_doctype=match_doctype)
+    return 1, query, 'bibcode,doi,abstract,title,author_norm,year,doctype,doi,identifier,property,pubnote', 'pubnote'
+
+def get_solr_params_match_doctype_case(author, year, match_doctype):
+    """
+
+    :param author:
+    :param year:
+    :param match_doctype:
+    :return: rows, query, fl, and query type to send to get_solr_data
+    """
+    if 'thesis' in match_doctype:
+        year_delta = current_app.config['ORACLE_SERVICE_THESIS_YEAR_DELTA']
+    else:
+        year_delta = current_app.config['ORACLE_SERVICE_GENERAL_YEAR_DELTA']
+    year = int(year)
+    year_filter = '[{year_start} TO {year_end}]'.format(year_start=year-year_delta, year_end=year+year_delta)
+
+    # note that this could be thesis with one author, or erratum or bookreview with many authors
+    # query only on the first author
+    # if multiple authors, need only the first author
+    if ';' in author:
+        author = author.split(';')[0]
+    author = author.split(',')
+    # if only last name
+    if len(author) == 1:
+        author_norm = '{}'.format(author[0].strip()).lower()
+    else:
+        author_norm = '{}, {}'.format(author[0].strip(), author[1].strip()[0]).lower()
+    query = 'author_norm:"{author}" year:{year_filter} doctype:({match_doctype})'.format(author=author_norm, year_filter=year_filter, match_doctype=match_doctype)
+    return 3, query, 'bibcode,doi,abstract,title,author_norm,year,doctype,doi,identifier,pubnote', 'doctype'
+
+def query_solr_data(rows, query, fl, query_type):
+    """
+    get_solr_data, returning the error from solr as the result
+
+    :param rows:
+    :param query:
+    :param fl:
+    :param query_type:
+    :return:
+    """
     try:
-        query = query.strip()
-        result, status_code = get_solr_data(rows, query, fl='bibcode,abstract,title,author_norm,year,doctype,doi,identifier,property,pubnote')
+        result, status_code = get_solr_data(rows=rows, query=query, fl=fl, query_type=query_type)
     except requests.exceptions.HTTPError as e:
         current_app.logger.error(e)
         result = {'error from solr':'%d: %s'%(e.response.status_code, e.response.reason)}
@@ -169,6 +308,21 @@ def get_solr_data_match(abstract, title, doctype, match_doctype, extra_filter):
 
     return result, query, status_code
 
+def get_solr_data_match(abstract, title, doctype, match_doctype, extra_filter):
+    """
+
+    :param abstract:
+    :param title:
+    :param doctype:
+    :param match_doctype:
+    :param extra_filter:
+    :return:
+    """
+    solr_params = get_solr_params_match(abstract, title, match_doctype, extra_filter)
+    if not solr_params:
+        return [], '', 200
+    return query_solr_data(*solr_params)
+
 def get_solr_data_match_doi(doi, doctype, match_doctype):
     """
 
@@ -177,18 +331,7 @@ def get_solr_data_match_doi(doi, doctype, match_doctype):
     :param matched_doctype:
     :return:
     """
-    try:
-        # remove REFEREED for now, but return the property in the results to used it in scoring
-        # also remove the doctype, if there is a doi, just query doi for now
-        # query = 'doi:"{doi}" doctype:({doctype}) property:REFEREED'.format(doi=doi, doctype=doctype)
-        query = 'identifier:({doi}) doctype:({match_doctype})'.format(doi=doi, match_doctype=match_doctype)
-        result, status_code = get_solr_data(rows=1, query=query, fl='bibcode,doi,abstract,title,author_norm,year,doctype,doi,identifier,property,pubnote')
-    except requests.exceptions.HTTPError as e:
-        current_app.logger.error(e)
-        result = {'error from solr':'%d: %s'%(e.response.status_code, e.response.reason)}
-        status_code = e.response.status_code
-
-    return result, query, status_code
+    return query_solr_data(*get_solr_params_match_doi(doi, match_doctype))
 
 def get_solr_data_match_pubnote(doi, doctype, match_doctype):
     """
@@ -199,15 +342,7 @@ def get_solr_data_match_pubnote(doi, doctype, match_doctype):
     :param matched_doctype:
     :return:
     """
-    try:
-        query = 'pubnote:({doi}) doctype:({match_doctype})'.format(doi=doi, match_doctype=match_doctype)
-        result, status_code = get_solr_data(rows=1, query=query, fl='bibcode,doi,abstract,title,author_norm,year,doctype,doi,identifier,property,pubnote')
-    except requests.exceptions.HTTPError as e:
-        current_app.logger.error(e)
-        result = {'error from solr':'%d: %s'%(e.response.status_code, e.response.reason)}
-        status_code = e.response.status_code
-
-    return result, query, status_code
+    return query_solr_data(*get_solr_params_match_pubnote(doi, match_doctype))
 
 def get_solr_data_match_doctype_case(author, year, doctype, match_doctype):
     """
@@ -218,42 +353,30 @@ def get_solr_data_match_doctype_case(author, year, doctype, match_doctype):
     :param matched_doctype: 
     :return: 
     """
-    if 'thesis' in match_doctype:
-        year_delta = current_app.config['ORACLE_SERVICE_THESIS_YEAR_DELTA']
-        year = int(year)
-        year_filter = '[{year_start} TO {year_end}]'.format(year_start=year-year_delta, year_end=year+year_delta)
-    else:
-        year_delta = current_app.config['ORACLE_SERVICE_GENERAL_YEAR_DELTA']
-        year = int(year)
-        year_filter = '[{year_start} TO {year_end}]'.format(year_start=year-year_delta, year_end=year+year_delta)
+    return query_solr_data(*get_solr_params_match_doctype_case(author, year, match_doctype))
 
-    # note that this could be thesis with one author, or erratum or bookreview with many authors
-    # query only on the first author
-    try:
-        # if multiple authors, need only the first author
-        if ';' in author:
-            author = author.split(';')[0]
-        author = author.split(',')
-        # if only last name
-        if len(author) == 1:
-            author_norm = '{}'.format(author[0].strip()).lower()
-        else:
-            author_norm = '{}, {}'.format(author[0].strip(), author[1].strip()[0]).lower()
-        query = 'author_norm:"{author}" year:{year_filter} doctype:({match_doctype})'.format(author=author_norm, year_filter=year_filter, match_doctype=match_doctype)
-        result, status_code = get_solr_data(rows=3, query=query, fl='bibcode,doi,abstract,title,author_norm,year,doctype,doi,identifier,pubnote')
-    except requests.exceptions.HTTPError as e:
-        current_app.logger.error(e)
-        result = {'error from solr': '%d: %s' % (e.response.status_code, e.response.reason)}
-        status_code = e.response.status_code
+def get_upsert_statement(rows):
+    """
+    upsert statement for adding matches, if a match is already in db the confidence is updated
+    only when the new confidence is higher, and never when the existing match has been marked incorrect
 
-    return result, query, status_code
+    :param rows: list of dicts with eprint_bibcode, pub_bibcode, and confidence
+    :return:
+    """
+    table = DocMatch.__table__
+    stmt = insert(table).values(rows)
+    return stmt.on_conflict_do_update(index_elements=[c.name for c in list(table.primary_key.columns)],
+                                      set_={'confidence': stmt.excluded.confidence, 'date': stmt.excluded.date},
+                                      where=and_(table.c.confidence >= 0, table.c.confidence < stmt.excluded.confidence))
 
+@timed_query
 def add_a_record(protobuf_docmatch, source_bibcode_doctype=None):
     """
+    upserts one record with a single statement, see get_upsert_statement for the conflict rules
 
     :param protobuf_docmatch:
     :param source_bibcode_doctype:
-    :return:
+    :return: success boolean, plus a status text stating if the record was inserted, updated, or already in db
     """
     eprint_bibstems, _ = query_eprint_bibstem()
     try:
@@ -261,15 +384,19 @@ def add_a_record(protobuf_docmatch, source_bibcode_doctype=None):
             try:
                 docmatch = DocMatch(protobuf_docmatch['source_bibcode'], protobuf_docmatch['matched_bibcode'],
                                     protobuf_docmatch['confidence'], eprint_bibstems, None, source_bibcode_doctype)
-                found = session.query(exists().where(and_(DocMatch.eprint_bibcode == docmatch.eprint_bibcode,
-                                                          DocMatch.pub_bibcode == docmatch.pub_bibcode,
-                                                          DocMatch.confidence == docmatch.confidence))).scalar()
-                if found:
-                    return True, 'record already in db'
-                session.add(docmatch)
+                stmt = get_upsert_statement([{'eprint_bibcode': docmatch.eprint_bibcode,
+                                              'pub_bibcode': docmatch.pub_bibcode,
+                                              'confidence': docmatch.confidence}])
+                # xmax is zero only for the rows that were inserted, and no row is returned if nothing was changed
+                row = session.execute(stmt.returning(literal_column('(xmax = 0)').label('inserted'))).first()
                 session.commit()
-                current_app.logger.debug('updated db with a new record successfully')
-                return True, 'updated db with a new record successfully'
+                if row is None:
+                    return True, 'record already in db'
+                if row.inserted:
+                    current_app.logger.debug('updated db with a new record successfully')
+                    return True, 'updated db with a new record successfully'
+                current_app.logger.debug('updated confidence of the record in db successfully')
+                return True, 'updated confidence of the record in db successfully'
             except SQLAlchemyError as e:
                 session.rollback()
                 current_app.logger.error('SQLAlchemy: ' + str(e))
@@ -278,6 +405,47 @@ def add_a_record(protobuf_docmatch, source_bibcode_doctype=None):
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return False, 'SQLAlchemy: ' + str(e)
 
+@timed_query
+def add_matches(matches):
+    """
+    upserts a batch of matches coming from docmatching with one statement, same conflict rules as add_a_record
+
+    :param matches: list of (match, source_bibcode_doctype) where match is dict of source_bibcode, matched_bibcode, and confidence
+    :return: success boolean, number of records inserted or updated, plus a status text
+    """
+    eprint_bibstems, _ = query_eprint_bibstem()
+    rows = []
+    for match, source_bibcode_doctype in matches:
+        try:
+            docmatch = DocMatch(match['source_bibcode'], match['matched_bibcode'], match['confidence'],
+                                eprint_bibstems, None, source_bibcode_doctype)
+        except ValueError as e:
+            current_app.logger.error('Error: %s for match %s' % (str(e), match))
+            continue
+        rows.append({"eprint_bibcode": docmatch.eprint_bibcode,
+                     "pub_bibcode": docmatch.pub_bibcode,
+                     "confidence": docmatch.confidence})
+
+    # upsert cannot affect the same row twice in one statement
+    rows = dedup_docmatch_rows(rows)
+    if len(rows) == 0:
+        return True, 0, 'no records to add to the database'
+
+    try:
+        with current_app.session_scope() as session:
+            try:
+                count = session.execute(get_upsert_statement(rows)).rowcount
+                session.commit()
+                return True, count, 'added or updated %d records of %d requested'%(count, len(matches))
+            except SQLAlchemyError as e:
+                session.rollback()
+                current_app.logger.error('SQLAlchemy: ' + str(e))
+                return False, -1, 'SQLAlchemy: ' + str(e)
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return False, -1, 'SQLAlchemy: ' + str(e)
+
+@timed_query
 def get_a_record(source_bibcode, matched_bibcode):
     """
 
@@ -287,7 +455,7 @@ def get_a_record(source_bibcode, matched_bibcode):
     """
     eprint_bibstems, _ = query_eprint_bibstem()
     try:
-        with current_app.session_scope() as session:
+        with read_session_scope() as session:
             docmatch = DocMatch(source_bibcode, matched_bibcode, confidence=-1, eprint_bibstems=eprint_bibstems)
             row = session.query(DocMatch).filter(or_(DocMatch.eprint_bibcode == docmatch.eprint_bibcode,
                                                      DocMatch.pub_bibcode == docmatch.pub_bibcode)).order_by(desc(DocMatch.confidence)).first()
@@ -301,6 +469,7 @@ def get_a_record(source_bibcode, matched_bibcode):
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return {}
 
+@timed_query
 def get_a_matched_record(source_bibcode):
     """
 
@@ -309,7 +478,7 @@ def get_a_matched_record(source_bibcode):
     """
     eprint_bibstems, _ = query_eprint_bibstem()
     try:
-        with current_app.session_scope() as session:
+        with read_session_scope() as session:
             docmatch = DocMatch(source_bibcode='0000arXiv.........Z', matched_bibcode=source_bibcode, confidence=-1, eprint_bibstems=eprint_bibstems)
             row = session.query(DocMatch).filter(DocMatch.pub_bibcode == docmatch.pub_bibcode).order_by(desc(DocMatch.confidence)).first()
             if row:
@@ -322,6 +491,7 @@ def get_a_matched_record(source_bibcode):
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return {}
 
+@timed_query
 def add_records(protobuf_docmatches):
     """
     upserts records into db
@@ -342,6 +512,9 @@ def add_records(protobuf_docmatches):
         current_app.logger.error('Error: ' + str(e))
         return False, 'Error: ' + str(e)
 
+    # upsert cannot affect the same row twice in one statement
+    rows = dedup_docmatch_rows(rows)
+
     if len(rows) > 0:
         table = DocMatch.__table__
         stmt = insert(table).values(rows)
@@ -369,9 +542,89 @@ def add_records(protobuf_docmatches):
 
     return False, 'unable to add records to the database'
 
+def dedup_docmatch_rows(rows):
+    """
+    if the same eprint/pub pair appears more than once keep the one with the highest confidence
+
+    :param rows: list of dicts with eprint_bibcode, pub_bibcode, and confidence
+    :return:
+    """
+    unique = {}
+    for row in rows:
+        key = (row['eprint_bibcode'], row['pub_bibcode'])
+        if key not in unique or row['confidence'] > unique[key]['confidence']:
+            unique[key] = row
+    return list(unique.values())
+
+@timed_query
+def bulk_add_records(rows):
+    """
+    upserts large number of records into db, the records are copied into a staging table and
+    merged into docmatch in chunks, each chunk is committed separately, the conflict rules are the same
+    as get_upsert_statement, an existing match is updated only when the new confidence is higher, and
+    never when it has been marked incorrect, otherwise the record is skipped
+
+    :param rows: list of dicts with eprint_bibcode, pub_bibcode, and confidence
+    :return: success boolean, dict of count of rows inserted, updated, and skipped, plus a status text
+    """
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    rows = dedup_docmatch_rows(rows)
+    if len(rows) == 0:
+        return False, counts, 'no records to add to the database'
+
+    chunk_size = current_app.config['ORACLE_BULK_ADD_CHUNK_SIZE']
+    try:
+        with current_app.session_scope() as session:
+            try:
+                for i in range(0, len(rows), chunk_size):
+                    start_time = time.time()
+                    chunk = rows[i:i + chunk_size]
+                    # each chunk is a new transaction, which might be on a different connection from the pool,
+                    # staging table is temporary and per connection, and emptied on commit
+                    with session.connection().connection.cursor() as cursor:
+                        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS docmatch_staging "
+                                       "(eprint_bibcode VARCHAR, pub_bibcode VARCHAR, confidence FLOAT) ON COMMIT DELETE ROWS")
+                        buffer = io.StringIO()
+                        writer = csv.writer(buffer)
+                        for row in chunk:
+                            writer.writerow([row['eprint_bibcode'], row['pub_bibcode'], row['confidence']])
+                        buffer.seek(0)
+                        cursor.copy_expert("COPY docmatch_staging (eprint_bibcode, pub_bibcode, confidence) FROM STDIN WITH CSV", buffer)
+                        # xmax is zero only for the rows that were inserted, the rows the where clause
+                        # leaves alone are not returned at all
+                        cursor.execute("WITH merged AS ("
+                                       "INSERT INTO docmatch (eprint_bibcode, pub_bibcode, confidence, date) "
+                                       "SELECT eprint_bibcode, pub_bibcode, confidence, now() FROM docmatch_staging "
+                                       "ON CONFLICT (eprint_bibcode, pub_bibcode) DO UPDATE "
+                                       "SET confidence = EXCLUDED.confidence, date = EXCLUDED.date "
+                                       "WHERE docmatch.confidence >= 0 AND docmatch.confidence < EXCLUDED.confidence "
+                                       "RETURNING (xmax = 0) AS inserted) "
+                                       "SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) FROM merged")
+                        inserted, updated = cursor.fetchone()
+                    session.commit()
+                    skipped = len(chunk) - inserted - updated
+                    counts['inserted'] += inserted
+                    counts['updated'] += updated
+                    counts['skipped'] += skipped
+                    current_app.logger.info("Merged chunk of {num_rows} records, {inserted} inserted, {updated} updated, and {skipped} skipped in {duration} ms".format(
+                        num_rows=len(chunk), inserted=inserted, updated=updated, skipped=skipped, duration=(time.time() - start_time) * 1000))
+                return True, counts, 'inserted %d, updated %d, and skipped %d records'%(counts['inserted'], counts['updated'], counts['skipped'])
+            except SQLAlchemyError as e:
+                session.rollback()
+                current_app.logger.error('SQLAlchemy: ' + str(e))
+                return False, counts, 'SQLAlchemy: ' + str(e)
+            except psycopg2.Error as e:
+                session.rollback()
+                current_app.logger.error('psycopg2: ' + str(e))
+                return False, counts, 'psycopg2: ' + str(e)
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return False, counts, 'SQLAlchemy: ' + str(e)
+
+@timed_query
 def del_records(docmatches):
     """
-    delete records from db
+    delete records from db, all the records are removed with one set based statement
 
     :param docmatches:
     :return:
@@ -380,13 +633,18 @@ def del_records(docmatches):
     try:
         with current_app.session_scope() as session:
             try:
-                count = 0
+                keys = set()
                 for doc in docmatches.docmatch_records:
                     # convert to DocMatch so that eprint and pub bibcodes can be identified
                     docmatch = DocMatch(doc.source_bibcode, doc.matched_bibcode, doc.confidence, eprint_bibstems)
-                    count += session.query(DocMatch).filter(and_(DocMatch.eprint_bibcode == docmatch.eprint_bibcode,
-                                                                 DocMatch.pub_bibcode == docmatch.pub_bibcode,
-                                                                 DocMatch.confidence == docmatch.confidence)).delete(synchronize_session=False)
+                    keys.add((docmatch.eprint_bibcode, docmatch.pub_bibcode, docmatch.confidence))
+                count = 0
+                if keys:
+                    start_time = time.time()
+                    count = session.query(DocMatch).filter(tuple_(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence).in_(list(keys))) \
+                        .delete(synchronize_session=False)
+                    current_app.logger.info("Deleted {count} records of {requested} requested with one statement in {duration} ms".format(
+                        count=count, requested=len(keys), duration=(time.time() - start_time) * 1000))
                 if count:
                     session.commit()
                     return True, 'removed ' + str(count) + ' records of ' + str(len(docmatches.docmatch_records)) + ' requested'
@@ -399,6 +657,7 @@ def del_records(docmatches):
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return False, 'SQLAlchemy: ' + str(e)
 
+@timed_query
 def query_docmatch(params):
     """
 
@@ -406,79 +665,175 @@ def query_docmatch(params):
     :return:
     """
     try:
-        with current_app.session_scope() as session:
-            # setup subquery to extract the published records with the highest confidence
-            highest_confidence = session.query(DocMatch.pub_bibcode, func.max(DocMatch.confidence).label('confidence')) \
-                .order_by(DocMatch.pub_bibcode.asc()).group_by(DocMatch.pub_bibcode).distinct().subquery()
-            # get full records with the highest confidence
-            result = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence, DocMatch.date) \
-                .filter(and_(DocMatch.pub_bibcode == highest_confidence.c.pub_bibcode,
-                             DocMatch.confidence == highest_confidence.c.confidence,
-                             DocMatch.date >= params['date_cutoff'].strftime("%Y-%m-%d %H:%M:%S"))) \
-                .order_by(DocMatch.pub_bibcode.asc()) \
+        with read_session_scope() as session:
+            # best_match holds the published records with the highest confidence, maintained by a trigger on docmatch
+            result = session.query(BestMatch.eprint_bibcode, BestMatch.pub_bibcode, BestMatch.confidence) \
+                .filter(BestMatch.date >= params['date_cutoff'].strftime("%Y-%m-%d %H:%M:%S")) \
+                .order_by(BestMatch.pub_bibcode.asc(), BestMatch.eprint_bibcode.asc()) \
                 .offset(params['start']).limit(params['rows']).all()
 
             if len(result) > 0:
-                # remove the last field, which is datetime, it is not needed to be returned
-                result = [r[0:3] for r in result]
+                result = [tuple(r) for r in result]
             return result, 200
     except SQLAlchemyError as e:
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return [], 404
 
-def query_source_score():
+@timed_query
+def export_docmatch(date_cutoff):
     """
+    generator returning the records with the highest confidence one at a time, reading them from a server side cursor,
+    so that the full set can be exported without materializing it in memory
 
-    :return:
+    :param date_cutoff:
+    :return: raises SQLAlchemyError if reading from db fails
     """
     try:
-        with current_app.session_scope() as session:
-            rows = session.query(ConfidenceLookup).all()
-            results = []
+        with read_session_scope() as session:
+            rows = session.query(BestMatch.eprint_bibcode, BestMatch.pub_bibcode, BestMatch.confidence) \
+                .filter(BestMatch.date >= date_cutoff.strftime("%Y-%m-%d %H:%M:%S")) \
+                .order_by(BestMatch.pub_bibcode.asc(), BestMatch.eprint_bibcode.asc()) \
+                .execution_options(stream_results=True) \
+                .yield_per(current_app.config['ORACLE_SERVICE_EXPORT_CHUNK_SIZE'])
             for row in rows:
-                results.append(row.toJSON())
-            return results, 200
+                yield tuple(row)
     except SQLAlchemyError as e:
+        # raise it so that the caller can tell the export was cut short, instead of ending as if it was complete
         current_app.logger.error('SQLAlchemy: ' + str(e))
-        return [], 404
+        raise
 
-def lookup_confidence(source):
+def get_best_match_select():
     """
+    select statement computing the published records with the highest confidence from docmatch,
+    this is what best_match is expected to contain
 
-    :param source:
     :return:
     """
+    highest_confidence = select([DocMatch.pub_bibcode, func.max(DocMatch.confidence).label('confidence')]) \
+        .group_by(DocMatch.pub_bibcode).alias('highest_confidence')
+    return select([DocMatch.pub_bibcode, DocMatch.eprint_bibcode, DocMatch.confidence, DocMatch.date]) \
+        .where(and_(DocMatch.pub_bibcode == highest_confidence.c.pub_bibcode,
+                    DocMatch.confidence == highest_confidence.c.confidence))
+
+@timed_query
+def check_best_match(rebuild=False):
+    """
+    compare best_match with the records with the highest confidence computed from docmatch,
+    and if asked, rebuild best_match from docmatch
+
+    :param rebuild:
+    :return: status, dict of number of records missing from and extra in best_match, status text
+    """
     try:
         with current_app.session_scope() as session:
-            row = session.query(ConfidenceLookup.confidence).filter(ConfidenceLookup.source == source).first()
-            if row:
-                return row[0], 200
-            return 0, 400
+            expected = get_best_match_select()
+            actual = select([BestMatch.pub_bibcode, BestMatch.eprint_bibcode, BestMatch.confidence, BestMatch.date])
+            missing = session.execute(select([func.count()]).select_from(expected.except_(actual).alias('missing'))).scalar()
+            extra = session.execute(select([func.count()]).select_from(actual.except_(expected).alias('extra'))).scalar()
+            differences = {'missing': missing, 'extra': extra}
+            if not rebuild:
+                if missing or extra:
+                    return False, differences, 'best_match is out of sync, %d records are missing and %d are extra' % (missing, extra)
+                return True, differences, 'best_match is in sync'
+            session.query(BestMatch).delete(synchronize_session=False)
+            session.execute(insert(BestMatch.__table__).from_select(
+                ['pub_bibcode', 'eprint_bibcode', 'confidence', 'date'], get_best_match_select()))
+            session.commit()
+            return True, differences, 'rebuilt best_match, %d records were missing and %d were extra' % (missing, extra)
     except SQLAlchemyError as e:
         current_app.logger.error('SQLAlchemy: ' + str(e))
-        return 0, 404
+        return False, {}, 'SQLAlchemy: ' + str(e)
+
+@timed_query
+def get_confidence_lookup():
+    """
+    rows of the confidence_lookup table, it is small and rarely changes, so it is kept in process
+    for ORACLE_SERVICE_CONFIDENCE_LOOKUP_CACHE_TTL seconds, the service does not write to the table, so a change
+    made to it in db is picked up once the cached rows expire
 
-def delete_tmp_matches():
+    :return:
+    """
+    cache = current_app.extensions.setdefault('confidence_lookup_cache', {'rows': None, 'expires': 0, 'lock': threading.Lock()})
+    with cache['lock']:
+        if cache['rows'] is not None and time.time() < cache['expires']:
+            return cache['rows'], 200
+    try:
+        with read_session_scope() as session:
+            rows = [row.toJSON() for row in session.query(ConfidenceLookup).all()]
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return [], 404
+    with cache['lock']:
+        cache['rows'] = rows
+        cache['expires'] = time.time() + current_app.config.get('ORACLE_SERVICE_CONFIDENCE_LOOKUP_CACHE_TTL', 0)
+    return rows, 200
+
+def query_source_score():
+    """
+
+    :return:
+    """
+    rows, status_code = get_confidence_lookup()
+    return list(rows), status_code
+
+def lookup_confidence(source):
+    """
+
+    :param source:
+    :return:
+    """
+    rows, status_code = get_confidence_lookup()
+    if status_code != 200:
+        return 0, status_code
+    for row in rows:
+        if row['source'] == source:
+            return row['confidence'], 200
+    return 0, 400
+
+def get_bibcode_chunks(bibcodes):
+    """
+    split the bibcodes to examine into chunks of ORACLE_SERVICE_CLEANUP_CHUNK_SIZE, so that the list sent to db is bounded
+
+    :param bibcodes: None to examine the entire table
+    :return: list of chunks, [None] if the entire table is to be examined
+    """
+    if bibcodes is None:
+        return [None]
+    bibcodes = sorted(bibcodes)
+    chunk_size = current_app.config['ORACLE_SERVICE_CLEANUP_CHUNK_SIZE']
+    return [bibcodes[i:i + chunk_size] for i in range(0, len(bibcodes), chunk_size)]
+
+@timed_query
+def delete_tmp_matches(eprint_bibcodes=None):
     """
     if both tmp bibcode and canonical bibcode has been matched against an eprint bibcode
     then remove tmp matches
 
+    :param eprint_bibcodes: if specified only these eprint bibcodes are examined, otherwise the entire table
     :return:
     """
+    if eprint_bibcodes is not None and len(eprint_bibcodes) == 0:
+        return True, 0, 'no record found for deletion'
     try:
         with current_app.session_scope() as session:
             try:
-                # get the list of multiples
-                multiples = session.query(DocMatch.eprint_bibcode, DocMatch.confidence, func.count('*').label('count')) \
-                    .group_by(DocMatch.eprint_bibcode, DocMatch.confidence).having(func.count('*') > 1).subquery()
-                # now remove multiple rows that is a tmp bibcode
-                count = session.query(DocMatch).filter(
-                    and_(DocMatch.eprint_bibcode == multiples.c.eprint_bibcode,
-                         DocMatch.confidence == multiples.c.confidence,
-                         or_(DocMatch.pub_bibcode.like('%.tmp.%'), DocMatch.pub_bibcode.like('%.tmpL.%')))) \
-                    .delete(synchronize_session=False)
+                count = 0
+                for chunk in get_bibcode_chunks(eprint_bibcodes):
+                    # get the list of multiples
+                    multiples = session.query(DocMatch.eprint_bibcode, DocMatch.confidence, func.count('*').label('count'))
+                    if chunk is not None:
+                        multiples = multiples.filter(DocMatch.eprint_bibcode.in_(chunk))
+                    multiples = multiples.group_by(DocMatch.eprint_bibcode, DocMatch.confidence).having(func.count('*') > 1).subquery()
+                    # now remove multiple rows that is a tmp bibcode
+                    count_chunk = session.query(DocMatch).filter(
+                        and_(DocMatch.eprint_bibcode == multiples.c.eprint_bibcode,
+                             DocMatch.confidence == multiples.c.confidence,
+                             or_(DocMatch.pub_bibcode.like('%.tmp.%'), DocMatch.pub_bibcode.like('%.tmpL.%')))) \
+                        .delete(synchronize_session=False)
+                    if count_chunk:
+                        session.commit()
+                        count += count_chunk
                 if count:
-                    session.commit()
                     return True, count, 'deleted ' + str(count) + ' records successfully'
                 return True, count, 'no record found for deletion'
             except SQLAlchemyError as e:
@@ -489,6 +844,7 @@ def delete_tmp_matches():
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return False, -1, 'SQLAlchemy: ' + str(e)
 
+@timed_query
 def replace_tmp_with_canonical():
     """
     if there are distinct tmp matches (no canonical matches), grab the bibcode and identifier from solr
@@ -501,42 +857,65 @@ def replace_tmp_with_canonical():
         with current_app.session_scope() as session:
             try:
                 # get the tmp bibcodes that are not marked as deleted
-                rows = session.query(DocMatch).distinct(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence) \
+                rows = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode).distinct() \
                     .filter(and_(or_(DocMatch.pub_bibcode.like('%.tmp.%'), DocMatch.pub_bibcode.like('%.tmpL.%')),
                                  DocMatch.confidence != -1)).all()
 
                 # get bibcode and identifier list for these tmp bibcodes
-                bibcodes = []
-                for row in rows:
-                    bibcodes.append(row.pub_bibcode)
+                bibcodes = list(set(row.pub_bibcode for row in rows))
 
                 count = 0
                 if bibcodes:
-                    # go through the lists, if pub_bibcode is different from bibcode, then update pub_bibcode only if
-                    # the update does not cause duplicate records, in that case do  not update the pub_bibcode, instead
-                    # set confidence to -1 signaling that this is a delete
                     docs, status = get_solr_data_chunk(bibcodes)
                     if docs:
-                        for row in rows:
-                            for doc in docs:
-                                if row.pub_bibcode in doc.get('identifier', []):
-                                    canonical = doc.get('bibcode')
-                                    if row.pub_bibcode != canonical:
-                                        # is the match with canonical in db already
-                                        with session.no_autoflush:
-                                            mark_as_delete = len(session.query(DocMatch) \
-                                                                 .filter(and_(DocMatch.eprint_bibcode == row.eprint_bibcode,
-                                                                              DocMatch.pub_bibcode == canonical)).all()) > 0
-                                        if mark_as_delete:
-                                            row.confidence = marked_delete
-                                        else:
-                                            row.pub_bibcode = doc.get('bibcode')
-                                        count += 1
-                                    docs.remove(doc)
-                                    break
+                        # map each tmp bibcode to its canonical bibcode, if it is different
+                        tmp_bibcodes = set(bibcodes)
+                        canonical_bibcodes = {}
+                        for doc in docs:
+                            for identifier in doc.get('identifier', []):
+                                if identifier in tmp_bibcodes and identifier != doc.get('bibcode'):
+                                    canonical_bibcodes[identifier] = doc.get('bibcode')
+
+                        candidates = [(row.eprint_bibcode, row.pub_bibcode) for row in rows if row.pub_bibcode in canonical_bibcodes]
+                        if candidates:
+                            # find the matches with the canonical bibcode that are in db already, one query per chunk
+                            existing = set()
+                            lookup_chunk_size = current_app.config['ORACLE_SERVICE_REPLACE_TMP_LOOKUP_CHUNK_SIZE']
+                            for i in range(0, len(candidates), lookup_chunk_size):
+                                keys = [(eprint_bibcode, canonical_bibcodes[pub_bibcode]) for eprint_bibcode, pub_bibcode in candidates[i:i + lookup_chunk_size]]
+                                existing.update((row.eprint_bibcode, row.pub_bibcode) for row in session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode) \
+                                                .filter(tuple_(DocMatch.eprint_bibcode, DocMatch.pub_bibcode).in_(keys)).all())
+
+                            # update pub_bibcode only if the update does not cause duplicate records, in that case
+                            # do not update the pub_bibcode, instead set confidence to -1 signaling that this is a delete
+                            to_replace = []
+                            to_mark_delete = []
+                            for eprint_bibcode, pub_bibcode in candidates:
+                                key = (eprint_bibcode, canonical_bibcodes[pub_bibcode])
+                                if key in existing:
+                                    to_mark_delete.append((eprint_bibcode, pub_bibcode))
+                                else:
+                                    to_replace.append((eprint_bibcode, pub_bibcode))
+                                    # two tmp bibcodes of the same eprint resolving to the same canonical bibcode
+                                    existing.add(key)
+
+                            # commit each chunk, so that a long run does not hold one large transaction
+                            chunk_size = current_app.config['ORACLE_SERVICE_CLEANUP_CHUNK_SIZE']
+                            for i in range(0, len(to_mark_delete), chunk_size):
+                                chunk = to_mark_delete[i:i + chunk_size]
+                                session.query(DocMatch).filter(tuple_(DocMatch.eprint_bibcode, DocMatch.pub_bibcode).in_(chunk)) \
+                                    .update({DocMatch.confidence: marked_delete}, synchronize_session=False)
+                                session.commit()
+                                count += len(chunk)
+                            for i in range(0, len(to_replace), chunk_size):
+                                chunk = to_replace[i:i + chunk_size]
+                                mapping = {pub_bibcode: canonical_bibcodes[pub_bibcode] for _, pub_bibcode in chunk}
+                                session.query(DocMatch).filter(tuple_(DocMatch.eprint_bibcode, DocMatch.pub_bibcode).in_(chunk)) \
+                                    .update({DocMatch.pub_bibcode: case(mapping, value=DocMatch.pub_bibcode, else_=DocMatch.pub_bibcode)}, synchronize_session=False)
+                                session.commit()
+                                count += len(chunk)
 
                     if count:
-                        session.commit()
                         return True, count, 'replaced ' + str(count) + ' tmp records with its canonical counterpart'
                 return True, count, 'no tmp reocrds found to replace'
             except SQLAlchemyError as e:
@@ -547,37 +926,56 @@ def replace_tmp_with_canonical():
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return False, -1, 'SQLAlchemy: ' + str(e)
 
-def delete_multi_matches():
+@timed_query
+def delete_multi_matches(eprint_bibcodes=None, pub_bibcodes=None):
     """
 
+    :param eprint_bibcodes: if specified only these eprint bibcodes are examined, otherwise the entire table
+    :param pub_bibcodes: if specified only these pub bibcodes are examined, otherwise the entire table
     :return:
     """
     try:
         with current_app.session_scope() as session:
             try:
-                # get the list of multiples of eprint_bibcode
-                multiples = session.query(DocMatch.eprint_bibcode, func.max(DocMatch.confidence).label('confidence')) \
-                    .group_by(DocMatch.eprint_bibcode) \
-                    .having(func.count(distinct(DocMatch.confidence)) > 1).subquery()
-                # get all the matches with confidence smaller then the multiples to remove them
-                count_eprint = session.query(DocMatch).filter(
-                    and_(DocMatch.eprint_bibcode == multiples.c.eprint_bibcode,
-                         DocMatch.confidence < multiples.c.confidence)) \
-                    .delete(synchronize_session=False)
-
-                # now get the list of multiples of pub_bibcode
-                multiples = session.query(DocMatch.pub_bibcode, func.max(DocMatch.confidence).label('confidence')) \
-                    .group_by(DocMatch.pub_bibcode) \
-                    .having(func.count(distinct(DocMatch.confidence)) > 1).subquery()
-                # get all the matches with confidence smaller then the multiples to remove them
-                count_pub = session.query(DocMatch).filter(
-                    and_(DocMatch.pub_bibcode == multiples.c.pub_bibcode,
-                         DocMatch.confidence < multiples.c.confidence)) \
-                    .delete(synchronize_session=False)
+                count_eprint = count_pub = 0
+                if eprint_bibcodes is None or len(eprint_bibcodes) > 0:
+                    for chunk in get_bibcode_chunks(eprint_bibcodes):
+                        # get the highest confidence of each eprint_bibcode along side each match
+                        ranked = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode,
+                                               func.max(DocMatch.confidence).over(partition_by=DocMatch.eprint_bibcode).label('confidence'))
+                        if chunk is not None:
+                            ranked = ranked.filter(DocMatch.eprint_bibcode.in_(chunk))
+                        ranked = ranked.subquery()
+                        # remove the matches with confidence smaller than the highest
+                        count_chunk = session.query(DocMatch).filter(
+                            and_(DocMatch.eprint_bibcode == ranked.c.eprint_bibcode,
+                                 DocMatch.pub_bibcode == ranked.c.pub_bibcode,
+                                 DocMatch.confidence < ranked.c.confidence)) \
+                            .delete(synchronize_session=False)
+                        if count_chunk:
+                            session.commit()
+                            count_eprint += count_chunk
+
+                if pub_bibcodes is None or len(pub_bibcodes) > 0:
+                    for chunk in get_bibcode_chunks(pub_bibcodes):
+                        # now the highest confidence of each pub_bibcode
+                        ranked = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode,
+                                               func.max(DocMatch.confidence).over(partition_by=DocMatch.pub_bibcode).label('confidence'))
+                        if chunk is not None:
+                            ranked = ranked.filter(DocMatch.pub_bibcode.in_(chunk))
+                        ranked = ranked.subquery()
+                        # remove the matches with confidence smaller than the highest
+                        count_chunk = session.query(DocMatch).filter(
+                            and_(DocMatch.eprint_bibcode == ranked.c.eprint_bibcode,
+                                 DocMatch.pub_bibcode == ranked.c.pub_bibcode,
+                                 DocMatch.confidence < ranked.c.confidence)) \
+                            .delete(synchronize_session=False)
+                        if count_chunk:
+                            session.commit()
+                            count_pub += count_chunk
 
                 count = count_eprint + count_pub
                 if count:
-                    session.commit()
                     return True, count, 'deleted ' + str(count) + ' multi-matches successfully'
                 return True, count, 'no multi-match records found for deletion '
             except SQLAlchemyError as e:
@@ -588,9 +986,58 @@ def delete_multi_matches():
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return False, -1, 'SQLAlchemy: ' + str(e)
 
-def clean_db():
+@timed_query
+def get_docmatch_changes(exclude_ids=None):
     """
+    get the bibcodes touched by the writes to docmatch since the last cleanup
 
+    :param exclude_ids: if specified, the changes with these ids, that have already been read, are skipped
+    :return: list of change ids, set of eprint bibcodes, set of pub bibcodes, all None if there was an error
+    """
+    try:
+        with current_app.session_scope() as session:
+            rows = session.query(DocMatchChange.id, DocMatchChange.eprint_bibcode, DocMatchChange.pub_bibcode).all()
+            if exclude_ids:
+                exclude_ids = set(exclude_ids)
+                rows = [row for row in rows if row[0] not in exclude_ids]
+            return [row[0] for row in rows], set(row[1] for row in rows), set(row[2] for row in rows)
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return None, None, None
+
+@timed_query
+def delete_docmatch_changes(change_ids):
+    """
+    remove the changes that cleanup has examined, only the ones that were read, so that the changes
+    committed while cleanup was running are kept for the next run
+
+    :param change_ids:
+    :return:
+    """
+    try:
+        with current_app.session_scope() as session:
+            try:
+                chunk_size = current_app.config['ORACLE_SERVICE_CLEANUP_CHUNK_SIZE']
+                for i in range(0, len(change_ids), chunk_size):
+                    session.query(DocMatchChange).filter(DocMatchChange.id.in_(change_ids[i:i + chunk_size])) \
+                        .delete(synchronize_session=False)
+                session.commit()
+                return True, ''
+            except SQLAlchemyError as e:
+                session.rollback()
+                current_app.logger.error('SQLAlchemy: ' + str(e))
+                return False, 'SQLAlchemy: ' + str(e)
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return False, 'SQLAlchemy: ' + str(e)
+
+def clean_db(full=False, progress=None):
+    """
+    by default only the eprint and pub bibcodes that have changed since the last cleanup are examined,
+    when full is set the entire table is examined
+
+    :param full:
+    :param progress: if specified, called with the name of the phase and the counts so far when each phase starts
     :return:
     """
     # init
@@ -601,69 +1048,278 @@ def clean_db():
     }
     status_updated_canonical = status_deleted_multi_matches = ''
 
+    # the changes are read in full mode too, so that they can be removed once the entire table is examined
+    change_ids, changed_eprint_bibcodes, changed_pub_bibcodes = get_docmatch_changes()
+    if change_ids is None:
+        return counts, 'unable to read the list of changes'
+    eprint_bibcodes = pub_bibcodes = None
+    if not full:
+        eprint_bibcodes, pub_bibcodes = changed_eprint_bibcodes, changed_pub_bibcodes
+
     # delete tmp matches
-    status_deleted_tmp, count_deleted_tmp, _ = delete_tmp_matches()
+    if progress:
+        progress('delete_tmp_matches', counts)
+    status_deleted_tmp, count_deleted_tmp, _ = delete_tmp_matches(eprint_bibcodes)
     if count_deleted_tmp >= 0:
         counts['count_deleted_tmp'] = count_deleted_tmp
         # now update any tmp bibcode matches with their canonical counterpart, if available in solr
+        # note that this always examines all the tmp bibcodes, since what changes here is solr and not the db
+        if progress:
+            progress('replace_tmp_with_canonical', counts)
         status_updated_canonical, count_updated_canonical, _ = replace_tmp_with_canonical()
         if count_updated_canonical >= 0:
             counts['count_updated_canonical'] = count_updated_canonical
+            # read the changes committed since the first read, by the previous steps or by the writes made meanwhile,
+            # these have not been examined for tmp matches yet, so do that now
+            new_change_ids, new_eprint_bibcodes, new_pub_bibcodes = get_docmatch_changes(exclude_ids=change_ids)
+            if new_change_ids is None:
+                return counts, 'unable to read the list of changes'
+            if new_change_ids:
+                status_deleted_tmp, count_deleted_tmp, _ = delete_tmp_matches(new_eprint_bibcodes)
+                if count_deleted_tmp < 0:
+                    return counts, status_deleted_tmp
+                counts['count_deleted_tmp'] += count_deleted_tmp
+                change_ids = change_ids + new_change_ids
+                if not full:
+                    eprint_bibcodes = eprint_bibcodes | new_eprint_bibcodes
+                    pub_bibcodes = pub_bibcodes | new_pub_bibcodes
             # finally remove the lower confidence matches of the multiple matches
-            status_deleted_multi_matches, count_deleted_multi_matches, _ = delete_multi_matches()
+            if progress:
+                progress('delete_multi_matches', counts)
+            status_deleted_multi_matches, count_deleted_multi_matches, _ = delete_multi_matches(eprint_bibcodes, pub_bibcodes)
             if count_deleted_multi_matches >= 0:
                 counts['count_deleted_multi_matches'] = count_deleted_multi_matches
+                # remove only the changes that were examined, the ones committed after the second read are kept
+                # for the next run
+                status, text = delete_docmatch_changes(change_ids)
+                if not status:
+                    return counts, text
                 return counts, ''
     return counts, '%s %s %s'%(status_deleted_tmp, status_updated_canonical, status_deleted_multi_matches)
 
-def get_tmp_bibcodes():
+def lock_cleanup_job():
+    """
+    take the lock that is held while a cleanup job is queued or running, on a connection of its own, so that
+    only one job runs at a time across the workers, and the lock is let go if the worker running the job is gone
+
+    :return: connection holding the lock and 200, None and 409 if the lock is held by another job, None and error text otherwise
+    """
+    try:
+        connection = current_app.db.engine.connect()
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return None, 'SQLAlchemy: ' + str(e)
+    try:
+        locked = connection.execute(select([func.pg_try_advisory_lock(func.hashtext('cleanup_job'))])
+                                    .execution_options(autocommit=True)).scalar()
+        if locked:
+            return connection, 200
+        connection.close()
+        return None, 409
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        connection.close()
+        return None, 'SQLAlchemy: ' + str(e)
+
+def unlock_cleanup_job(connection):
     """
+    let go of the lock taken by lock_cleanup_job
 
+    :param connection:
     :return:
     """
+    try:
+        connection.execute(select([func.pg_advisory_unlock(func.hashtext('cleanup_job'))]).execution_options(autocommit=True))
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        # the lock is held by the session, so do not return the connection to the pool with it
+        connection.invalidate()
+    finally:
+        connection.close()
+
+@timed_query
+def get_active_cleanup_job():
+    """
+    the cleanup job that is queued or running
+
+    :return: id of the job, None if there is no such job
+    """
     try:
         with current_app.session_scope() as session:
-            result = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence, DocMatch.date) \
-                .filter(or_(DocMatch.pub_bibcode.like('%.tmp.%'), DocMatch.pub_bibcode.like('%.tmpL.%'))) \
-                .order_by(DocMatch.date.asc()).all()
-            if len(result) > 0:
-                # remove the last field, which is datetime, it is not needed to be returned
-                result = [r[0:3] for r in result]
-            return result, 200
+            job = session.query(CleanupJob.id).filter(CleanupJob.status.in_(['queued', 'running'])) \
+                .order_by(CleanupJob.date_created.desc()).first()
+            return job[0] if job else None
     except SQLAlchemyError as e:
         current_app.logger.error('SQLAlchemy: ' + str(e))
-        return None, 'SQLAlchemy: ' + str(e)
+        return None
+
+@timed_query
+def fail_stale_cleanup_jobs():
+    """
+    mark the jobs that are left queued or running as failed, called only while holding the lock of lock_cleanup_job,
+    so that these are the jobs whose worker has gone away
+
+    :return: number of jobs marked as failed, -1 if there was an error
+    """
+    try:
+        with current_app.session_scope() as session:
+            count = session.query(CleanupJob).filter(CleanupJob.status.in_(['queued', 'running'])) \
+                .update({CleanupJob.status: 'failed', CleanupJob.phase: 'done', CleanupJob.date_finished: func.now(),
+                         CleanupJob.message: 'the job was stopped before it finished'}, synchronize_session=False)
+            session.commit()
+            return count
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return -1
 
-def get_muti_matches():
+@timed_query
+def add_cleanup_job(full=False):
     """
+    add a cleanup job to be run in the background
 
+    :param full:
+    :return: id of the job, or None if unable to add it
+    """
+    try:
+        with current_app.session_scope() as session:
+            job_id = str(uuid.uuid4())
+            session.add(CleanupJob(id=job_id, status='queued', full=full))
+            session.commit()
+            return job_id
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return None
+
+@timed_query
+def update_cleanup_job(job_id, **values):
+    """
+
+    :param job_id:
+    :param values: columns of the job to update
     :return:
     """
     try:
         with current_app.session_scope() as session:
-            # get the list of multi matched eprints
-            multi_eprints = session.query(DocMatch.eprint_bibcode) \
-                .group_by(DocMatch.eprint_bibcode).having(func.count('*') > 1).subquery()
-            # get the list of multi matched pubs
-            multi_pubs = session.query(DocMatch.pub_bibcode) \
-                .group_by(DocMatch.pub_bibcode).having(func.count('*') > 1).subquery()
-            # now get full records
+            session.query(CleanupJob).filter(CleanupJob.id == job_id).update(values, synchronize_session=False)
+            session.commit()
+            return True
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return False
+
+@timed_query
+def get_cleanup_job(job_id):
+    """
+
+    :param job_id:
+    :return:
+    """
+    try:
+        with current_app.session_scope() as session:
+            job = session.query(CleanupJob).filter(CleanupJob.id == job_id).first()
+            if job:
+                return job.toJSON(), 200
+            return {}, 404
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return {}, 404
+
+def get_tmp_bibcodes_filter():
+    """
+    filter for the records that are matched to a tmp bibcode
+
+    :return:
+    """
+    return or_(DocMatch.pub_bibcode.like('%.tmp.%'), DocMatch.pub_bibcode.like('%.tmpL.%'))
+
+@timed_query
+def get_tmp_bibcodes(start=0, rows=None):
+    """
+
+    :param start: offset of the first record to return
+    :param rows: number of records to return, all if not specified
+    :return:
+    """
+    try:
+        with read_session_scope() as session:
             result = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence) \
-                .filter(or_(DocMatch.eprint_bibcode == multi_eprints.c.eprint_bibcode, DocMatch.pub_bibcode == multi_pubs.c.pub_bibcode)) \
-                .group_by(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence) \
-                .order_by(DocMatch.eprint_bibcode.asc(), DocMatch.pub_bibcode.asc()).all()
+                .filter(get_tmp_bibcodes_filter()) \
+                .order_by(DocMatch.date.asc(), DocMatch.eprint_bibcode.asc(), DocMatch.pub_bibcode.asc()) \
+                .offset(start).limit(rows).all()
+            return [tuple(r) for r in result], 200
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return None, 'SQLAlchemy: ' + str(e)
+
+@timed_query
+def count_tmp_bibcodes():
+    """
+    number of records matched to a tmp bibcode, counted in db without fetching the records
+
+    :return:
+    """
+    try:
+        with read_session_scope() as session:
+            count = session.query(func.count('*')).filter(get_tmp_bibcodes_filter()).scalar()
+            return count, 200
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return None, 'SQLAlchemy: ' + str(e)
+
+@timed_query
+def stream_tmp_bibcodes():
+    """
+    generator returning the records matched to a tmp bibcode one at a time, reading them from a server side cursor,
+    so that the full list can be returned without materializing it in memory
+
+    :return: raises SQLAlchemyError if reading from db fails
+    """
+    try:
+        with read_session_scope() as session:
+            rows = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence) \
+                .filter(get_tmp_bibcodes_filter()) \
+                .order_by(DocMatch.date.asc(), DocMatch.eprint_bibcode.asc(), DocMatch.pub_bibcode.asc()) \
+                .execution_options(stream_results=True) \
+                .yield_per(current_app.config['ORACLE_SERVICE_EXPORT_CHUNK_SIZE'])
+            for row in rows:
+                yield tuple(row)
+    except SQLAlchemyError as e:
+        # same as export_docmatch, the caller ends the stream with the error
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        raise
+
+@timed_query
+def get_muti_matches(start=0, rows=None):
+    """
+
+    :param start: offset of the first record to return
+    :param rows: number of records to return, all if not specified
+    :return:
+    """
+    try:
+        with read_session_scope() as session:
+            # count the matches of each eprint and each pub in one pass
+            counts = session.query(DocMatch.eprint_bibcode, DocMatch.pub_bibcode, DocMatch.confidence,
+                                   func.count().over(partition_by=DocMatch.eprint_bibcode).label('eprint_count'),
+                                   func.count().over(partition_by=DocMatch.pub_bibcode).label('pub_count')).subquery()
+            # now get the records of the multi matched eprints or pubs
+            result = session.query(counts.c.eprint_bibcode, counts.c.pub_bibcode, counts.c.confidence) \
+                .filter(or_(counts.c.eprint_count > 1, counts.c.pub_count > 1)) \
+                .order_by(counts.c.eprint_bibcode.asc(), counts.c.pub_bibcode.asc()) \
+                .offset(start).limit(rows).all()
             return result, 200
     except SQLAlchemyError as e:
         current_app.logger.error('SQLAlchemy: ' + str(e))
         return None, 'SQLAlchemy: ' + str(e)
 
+@timed_query
 def query_eprint_bibstem():
     """
 
     :return:
     """
     try:
-        with current_app.session_scope() as session:
+        with read_session_scope() as session:
             rows = session.query(EPrintBibstemLookup).all()
             results = []
             for row in rows:
@@ -687,3 +1343,108 @@ def is_eprint_bibcode(source_bibcode):
             return True
 
     return False
+
+def get_doi_index_rows(docs):
+    """
+    rows for doi_index from the docs returned by solr, one for each doi of a doc with source `doi`,
+    and one for the doi in its pubnote with source `pubnote`, the docs read from the index are skipped,
+    so that an entry is refreshed only from solr
+
+    :param docs:
+    :return:
+    """
+    rows = {}
+    for doc in docs:
+        if not isinstance(doc, dict) or not doc.get('bibcode', None) or 'doi_index_date' in doc:
+            continue
+        dumped = json.dumps(doc)
+        doi_pubnote = [doc['doi_pubnote']] if doc.get('doi_pubnote', None) else []
+        for source, dois in [('doi', doc.get('doi', [])), ('pubnote', doi_pubnote)]:
+            for doi in dois:
+                key = (doi.lower(), source, doc['bibcode'])
+                rows[key] = {'doi': key[0], 'source': source, 'bibcode': doc['bibcode'], 'doctype': doc.get('doctype', ''), 'doc': dumped}
+    return list(rows.values())
+
+@timed_query
+def add_doi_index(docs):
+    """
+    upserts the dois of the docs returned by solr into doi_index, an entry is refreshed only by a doc that
+    has all the fields of the one it has, so that it is never replaced with a doc queried with fewer fields
+
+    :param docs:
+    :return: success boolean, plus a status text
+    """
+    rows = get_doi_index_rows(docs)
+    if len(rows) == 0:
+        return True, 'no dois to add to the index'
+    try:
+        with current_app.session_scope() as session:
+            try:
+                stmt = insert(DOIIndex.__table__).values(rows)
+                stmt = stmt.on_conflict_do_update(index_elements=['doi', 'source', 'bibcode'],
+                                                  set_={'doctype': stmt.excluded.doctype, 'doc': stmt.excluded.doc, 'date': func.now()},
+                                                  where=text("CAST(excluded.doc AS JSONB) ?& ARRAY(SELECT jsonb_object_keys(CAST(doi_index.doc AS JSONB)))"))
+                session.execute(stmt)
+                session.commit()
+                return True, 'added %d dois to the index' % len(rows)
+            except SQLAlchemyError as e:
+                session.rollback()
+                current_app.logger.error('SQLAlchemy: ' + str(e))
+                return False, 'SQLAlchemy: ' + str(e)
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return False, 'SQLAlchemy: ' + str(e)
+
+@timed_query
+def lookup_doi_index(dois, source, match_doctype):
+    """
+    docs of the entries for the dois, entries older than ORACLE_SERVICE_DOI_INDEX_MAX_AGE_DAYS are stale
+
+    :param dois:
+    :param source: `doi` or `pubnote`
+    :param match_doctype: doctypes to match against, joined with OR
+    :return: docs of the fresh entries, most recent first, number of stale entries, and status code
+    """
+    doctypes = [doctype.strip().strip('"') for doctype in match_doctype.split(' OR ')]
+    cutoff = func.now() - timedelta(days=current_app.config['ORACLE_SERVICE_DOI_INDEX_MAX_AGE_DAYS'])
+    try:
+        with read_session_scope() as session:
+            rows = session.query(DOIIndex.doc, DOIIndex.date, (DOIIndex.date >= cutoff).label('fresh')) \
+                .filter(and_(DOIIndex.doi.in_([doi.lower() for doi in dois]),
+                             DOIIndex.source == source,
+                             DOIIndex.doctype.in_(doctypes))) \
+                .order_by(desc(DOIIndex.date)).all()
+    except SQLAlchemyError as e:
+        current_app.logger.error('SQLAlchemy: ' + str(e))
+        return [], 0, 404
+    docs = []
+    num_stale = 0
+    for row in rows:
+        if not row.fresh:
+            num_stale += 1
+            continue
+        doc = json.loads(row.doc)
+        doc['doi_index_date'] = row.date.isoformat()
+        docs.append(doc)
+    return docs, num_stale, 200
+
+def load_doi_index(bibcodes):
+    """
+    bulk load doi_index with the records of the bibcodes, queried from solr in chunks
+
+    :param bibcodes:
+    :return: success boolean, number of dois added, plus a status text
+    """
+    chunk_size = current_app.config['ORACLE_BULK_ADD_CHUNK_SIZE']
+    num_dois = 0
+    for i in range(0, len(bibcodes), chunk_size):
+        docs, status = get_solr_data_chunk(bibcodes[i:i + chunk_size], fl='bibcode,doi,abstract,title,author_norm,year,doctype,identifier,property,pubnote')
+        if docs is None:
+            return False, num_dois, 'unable to query solr: %s' % str(status)
+        # extract the doi from pubnote, as it is done for the docs returned for matching
+        docs = get_solr_docs({'response': {'numFound': len(docs), 'docs': docs}}, fl=None)
+        status, text = add_doi_index(docs)
+        if not status:
+            return False, num_dois, text
+        num_dois += len(get_doi_index_rows(docs))
+    return True, num_dois, 'added %d dois of %d bibcodes to the index' % (num_dois, len(bibcodes))
@@ -2,20 +2,28 @@
 # encoding=utf8
 PYTHONIOENCODING="UTF-8"
 
-from flask import current_app, request, Blueprint, Response
+from flask import current_app, request, Blueprint, Response, stream_with_context, copy_current_request_context
 from flask_discoverer import advertise
 
 import json
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from adsmutils import get_date
 from datetime import timedelta
 
 from adsmsg import DocMatchRecordList
 from google.protobuf.json_format import Parse, ParseError
+from sqlalchemy.exc import SQLAlchemyError
 
-from oraclesrv.utils import get_solr_data_recommend, add_records, del_records, query_docmatch, query_source_score, lookup_confidence
-from oraclesrv.doc_matching import DocMatching, get_requests_params
+from oraclesrv.utils import get_solr_data_recommend, add_records, del_records, query_docmatch, query_source_score, lookup_confidence, \
+    export_docmatch
+from oraclesrv.doc_matching import DocMatching, get_requests_params, speculative_metrics, doi_index_metrics, candidate_pruning_metrics
+from oraclesrv.jobs import start_cleanup_job
+from oraclesrv.db_metrics import query_metrics
+from oraclesrv.keras_model import PredictionBatcher
+from oraclesrv.score import confidence_model
 
 import oraclesrv.utils as utils
 
@@ -32,6 +40,52 @@ def return_response(results, status_code):
     r.headers['content-type'] = 'application/json'
     return r
 
+def return_ndjson_response(records, description):
+    """
+    stream the records as newline delimited json, one record per line, if reading the records fails midway
+    the last line is an object with the error, so that the client can tell the response is incomplete
+
+    :param records: generator of records
+    :param description: of the records, for the log
+    :return:
+    """
+    def generate():
+        """
+        one json line per record
+
+        :return:
+        """
+        start_time = time.time()
+        count = 0
+        try:
+            for record in records:
+                count += 1
+                yield json.dumps(record) + '\n'
+        except SQLAlchemyError as e:
+            current_app.logger.error("Streaming {description} failed after {count} records".format(description=description, count=count))
+            yield json.dumps({'error': 'SQLAlchemy: ' + str(e), 'count': count}) + '\n'
+            return
+        current_app.logger.info("Streamed {count} {description} in {duration} ms".format(count=count, description=description, duration=(time.time() - start_time) * 1000))
+
+    r = Response(response=stream_with_context(generate()), status=200)
+    r.headers['content-type'] = 'application/x-ndjson'
+    return r
+
+def return_conditional_response(results, status_code):
+    """
+    response with ETag and Cache-Control headers, that is returned as 304 if the client already has it
+
+    :param results:
+    :param status_code:
+    :return:
+    """
+    r = return_response(results, status_code)
+    if status_code == 200:
+        r.set_etag(hashlib.md5(r.get_data()).hexdigest())
+        r.headers['Cache-Control'] = 'public, max-age=%d' % current_app.config.get('ORACLE_SERVICE_CONFIDENCE_LOOKUP_CACHE_TTL', 0)
+        r.make_conditional(request)
+    return r
+
 def get_user_info_from_adsws(parameter):
     """
 
@@ -139,6 +193,69 @@ def docmatch(save=True):
     current_app.logger.debug("Matched doc in {duration} ms".format(duration=(time.time() - start_time) * 1000))
     return return_response(results, status_code)
 
+def docmatch_batch(save=True):
+    """
+    find matches for a list of documents, the documents are matched concurrently, at most
+    ORACLE_SERVICE_DOCMATCH_BATCH_WORKERS at a time, sharing the solr client and cache, the db connections,
+    and the confidence model, with the predictions of all the documents batched together,
+    the result of each document is streamed back as a line of json as soon as it is matched
+
+    :param save:
+    :return:
+    """
+    current_app.logger.debug('received request to find matches for a batch of documents')
+
+    try:
+        payload = request.get_json(force=True)  # post data in json
+    except:
+        payload = None
+
+    if not payload or not isinstance(payload, list):
+        return return_response(results={'error': 'no list of documents received'}, status_code=400)
+    if len(payload) > current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_MAX_RECORDS']:
+        return return_response(results={'error': 'too many documents to match at one time, received %s documents while the limit is %s'%
+                                                  (len(payload), current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_MAX_RECORDS'])}, status_code=400)
+
+    # a worker waits on its prediction, so a batch never has more predictions than there are workers,
+    # and is predicted as soon as all the workers are waiting on it
+    max_workers = max(1, min(current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_WORKERS'], len(payload)))
+    predictor = PredictionBatcher(confidence_model,
+                                  max_batch_size=min(current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_PREDICT_SIZE'], max_workers),
+                                  max_wait=current_app.config['ORACLE_SERVICE_DOCMATCH_BATCH_PREDICT_WAIT_MS'] / 1000.0)
+
+    def match(index, record):
+        """
+        match one document
+
+        :param index: position of the document in the request
+        :param record:
+        :return:
+        """
+        try:
+            results, status_code = DocMatching(record, save=save, predictor=predictor).process()
+        except Exception as e:
+            current_app.logger.error('unable to match document %d of the batch: %s' % (index, str(e)))
+            results, status_code = {'error': 'unable to match the document: %s' % str(e)}, 500
+        return {'index': index, 'status_code': status_code, 'results': results}
+
+    def generate():
+        """
+        one json line per document, in the order they are matched
+
+        :return:
+        """
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(copy_current_request_context(match), index, record) for index, record in enumerate(payload)]
+            for future in as_completed(futures):
+                yield json.dumps(future.result()) + '\n'
+        current_app.logger.info("Matched {count} docs in {duration} ms, with {num_predictions} predictions in {num_batches} batches".format(
+            count=len(payload), duration=(time.time() - start_time) * 1000, num_predictions=predictor.num_predictions, num_batches=predictor.num_batches))
+
+    r = Response(response=stream_with_context(generate()), status=200)
+    r.headers['content-type'] = 'application/x-ndjson'
+    return r
+
 @advertise(scopes=[], rate_limit=[1000, 3600 * 24])
 @bp.route('/readhist/<function>/<reader>', methods=['GET'])
 def read_history_get(function, reader):
@@ -207,6 +324,24 @@ def docmatch_add_post():
     """
     return docmatch()
 
+@advertise(scopes=[], rate_limit=[1000, 3600 * 24])
+@bp.route('/docmatch_batch', methods=['POST'])
+def docmatch_batch_post():
+    """
+
+    :return:
+    """
+    return docmatch_batch(save=False)
+
+@advertise(scopes=['ads:oracle-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/docmatch_add_batch', methods=['POST'])
+def docmatch_add_batch_post():
+    """
+
+    :return:
+    """
+    return docmatch_batch()
+
 @advertise(scopes=['ads:oracle-service'], rate_limit=[1000, 3600 * 24])
 @bp.route('/add', methods=['PUT'])
 def add():
@@ -259,7 +394,7 @@ def delete():
         return return_response({'error': 'no records received to delete from db'}, 400)
 
     if len(payload) > current_app.config['ORACLE_MAX_RECORDS_DEL']:
-        return JsonResponse({'error': 'too many records to delete to db at one time, received %s records while the limit is %s'%(len(bibcodes), current_app.config['ORACLE_MAX_RECORDS_DEL'])}, 400)
+        return return_response({'error': 'too many records to delete from db at one time, received %s records while the limit is %s'%(len(payload), current_app.config['ORACLE_MAX_RECORDS_DEL'])}, 400)
 
     current_app.logger.info('received request to delete from db %d bibcodes' % (len(payload)))
 
@@ -318,6 +453,28 @@ def query():
     payload['date_cutoff'] = str(payload['date_cutoff'])
     return return_response({'params':payload, 'results':results}, status_code)
 
+@advertise(scopes=[], rate_limit=[1000, 3600 * 24])
+@bp.route('/export', methods=['GET'])
+def export():
+    """
+    streams all the records with the highest confidence as newline delimited json
+
+    :return:
+    """
+    current_app.logger.debug('received request to export database')
+
+    # number of days from today to return records
+    days = request.args.get('days', None)
+    if days is None:
+        date_cutoff = get_date('1972/01/01 00:00:00')
+    else:
+        try:
+            date_cutoff = get_date() - timedelta(days=int(days))
+        except ValueError:
+            return return_response({'error': 'invalid value for parameter `days`: %s'%days}, 400)
+
+    return return_ndjson_response(export_docmatch(date_cutoff), 'exported records')
+
 @advertise(scopes=[], rate_limit=[1000, 3600 * 24])
 @bp.route('/source_score', methods=['GET'])
 def source_score():
@@ -332,7 +489,7 @@ def source_score():
     current_app.logger.debug('source_score results = %s'%json.dumps(results))
     current_app.logger.debug('source_score status_code = %d'%status_code)
 
-    return return_response({'results':results}, status_code)
+    return return_conditional_response({'results':results}, status_code)
 
 @advertise(scopes=[], rate_limit=[1000, 3600 * 24])
 @bp.route('/confidence/<source>', methods=['GET'])
@@ -348,44 +505,105 @@ def confidence(source):
     current_app.logger.debug('confidence value = %s'%score)
     current_app.logger.debug('confidence status_code = %d'%status_code)
 
-    return return_response({'confidence':score}, status_code)
+    return return_conditional_response({'confidence':score}, status_code)
+
+def get_cleanup_details(counts):
+    """
+    summary of what the cleanup did
+
+    :param counts:
+    :return:
+    """
+    if counts.get('count_deleted_tmp', -1) > 0:
+        message = 'Successfully removed %d matches having tmp bibcode while matches with canonical bibcode exists. '%counts['count_deleted_tmp']
+    else:
+        message = 'No duplicate (tmp and canoncial) records found. '
+    if counts.get('count_updated_canonical', -1) > 0:
+        message += 'Successfully replaced %d tmp matches with its canonical bibcode. ' % counts['count_updated_canonical']
+    else:
+        message += 'No tmp bibcode was updated with the canonical bibcode. '
+    if counts.get('count_deleted_multi_matches') > 0:
+        message += 'Successfully removed %d matches having multiple matches, kept the match with highest confidence.' % counts['count_deleted_multi_matches']
+    else:
+        message += 'No multiple match records found.'
+    return message
 
 @advertise(scopes=['ads:oracle-service'], rate_limit=[1000, 3600 * 24])
 @bp.route('/cleanup', methods=['GET'])
 def cleanup():
     """
-    cleans up the db, removing tmp bibcodes and lower confidence of multi matches
+    starts a job in the background to clean up the db, removing tmp bibcodes and lower confidence of multi matches,
+    only the bibcodes that have changed since the last cleanup are examined unless parameter `full` is set
+
+    :return: id of the job, to get its status from /cleanup/<job_id>
+    """
+    full = request.args.get('full', 'false').lower() in ['true', '1']
+    job_id, _, status_code = start_cleanup_job(full)
+    if status_code == 409:
+        return return_response({'error': 'a cleanup job is queued or running already', 'job_id': job_id}, 409)
+    if job_id:
+        return return_response({'job_id': job_id}, 202)
+    return return_response({'details': 'unable to start the cleanup job'}, 400)
 
+@advertise(scopes=['ads:oracle-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/cleanup/<job_id>', methods=['GET'])
+def cleanup_status(job_id):
+    """
+    status of the cleanup job, the phase it is in and the counts of each phase
+
+    :param job_id:
     :return:
     """
-    counts, status = utils.clean_db()
-    if all(count >= 0 for count in counts.values()):
-        if counts.get('count_deleted_tmp', -1) > 0:
-            message = 'Successfully removed %d matches having tmp bibcode while matches with canonical bibcode exists. '%counts['count_deleted_tmp']
-        else:
-            message = 'No duplicate (tmp and canoncial) records found. '
-        if counts.get('count_updated_canonical', -1) > 0:
-            message += 'Successfully replaced %d tmp matches with its canonical bibcode. ' % counts['count_updated_canonical']
-        else:
-            message += 'No tmp bibcode was updated with the canonical bibcode. '
-        if counts.get('count_deleted_multi_matches') > 0:
-            message += 'Successfully removed %d matches having multiple matches, kept the match with highest confidence.' % counts['count_deleted_multi_matches']
-        else:
-            message += 'No multiple match records found.'
-
-        return return_response({'details': message}, 200)
-    else:
-        return return_response({'details':'unable to perform the cleanup, ERROR: %s'%status}, 400)
+    job, status_code = utils.get_cleanup_job(job_id)
+    if status_code != 200:
+        return return_response({'error': 'no cleanup job with id %s' % job_id}, 404)
+    if job['status'] == 'succeeded':
+        job['details'] = get_cleanup_details(job['counts'])
+    elif job['status'] == 'failed':
+        job['details'] = 'unable to perform the cleanup, ERROR: %s' % job['message']
+    return return_response(job, 200)
+
+def get_paging_params():
+    """
+    parameters `start` and `rows` of the listing endpoints
+
+    :return: start and rows, rows is None if not specified, both None if either is not a non negative integer
+    """
+    try:
+        start = int(request.args.get('start', 0))
+        rows = request.args.get('rows', None)
+        rows = int(rows) if rows is not None else None
+    except ValueError:
+        return None, None
+    if start < 0 or (rows is not None and rows < 0):
+        return None, None
+    return start, rows
 
 @advertise(scopes=['ads:oracle-service'], rate_limit=[1000, 3600 * 24])
 @bp.route('/list_tmps', methods=['GET'])
 def list_tmps():
     """
-    list tmp bibcodes in the db
+    list tmp bibcodes in the db, optionally a page at a time with parameters `start` and `rows`,
+    or only the number of them with `count_only`, or all of them streamed as newline delimited json with `stream`
 
     :return:
     """
-    results, status_code = utils.get_tmp_bibcodes()
+    if request.args.get('count_only', 'false').lower() == 'true':
+        count, status_code = utils.count_tmp_bibcodes()
+        if status_code != 200:
+            return return_response({'error': status_code}, 400)
+        return return_response({'count': count}, status_code)
+
+    if request.args.get('stream', 'false').lower() == 'true':
+        return return_ndjson_response(utils.stream_tmp_bibcodes(), 'tmp bibcodes')
+
+    start, rows = get_paging_params()
+    if start is None:
+        return return_response({'error': 'invalid value for parameter `start` or `rows`'}, 400)
+
+    results, status_code = utils.get_tmp_bibcodes(start, rows)
+    if status_code != 200:
+        return return_response({'error': status_code}, 400)
 
     current_app.logger.debug('tmp bibcodes results = %s'%json.dumps(results))
     current_app.logger.debug('tmp bibcodes status_code = %d'%status_code)
@@ -397,13 +615,45 @@ def list_tmps():
 @bp.route('/list_multis', methods=['GET'])
 def list_multis():
     """
-    list multi matched bibcodes from the db
+    list multi matched bibcodes from the db, optionally a page at a time with parameters `start` and `rows`
 
     :return:
     """
-    results, status_code = utils.get_muti_matches()
+    start, rows = get_paging_params()
+    if start is None:
+        return return_response({'error': 'invalid value for parameter `start` or `rows`'}, 400)
+
+    results, status_code = utils.get_muti_matches(start, rows)
+    if status_code != 200:
+        return return_response({'error': status_code}, 400)
 
     current_app.logger.debug('multi matches results = %s'%json.dumps(results))
     current_app.logger.debug('multi matches status_code = %d'%status_code)
 
     return return_response({'count':len(results), 'results':results}, status_code)
+
+@advertise(scopes=['ads:oracle-service'], rate_limit=[1000, 3600 * 24])
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    internal metrics of the service
+
+    :return:
+    """
+    results = {}
+    if getattr(current_app, 'write_behind', None):
+        results['write_behind'] = current_app.write_behind.get_metrics()
+    results['db_pool'] = {name: pool_metrics.get_metrics() for name, pool_metrics in getattr(current_app, 'pool_metrics', {}).items()}
+    results['db_queries'] = query_metrics.get_metrics()
+    if getattr(current_app, 'solr_client', None):
+        results['solr'] = current_app.solr_client.get_metrics()
+    if getattr(current_app, 'solr_cache', None):
+        results['solr_cache'] = current_app.solr_cache.get_metrics()
+    if current_app.config.get('ORACLE_SERVICE_SPECULATIVE_QUERIES_ENABLED', False) or \
+            current_app.config.get('ORACLE_SERVICE_PARALLEL_TITLE_QUERY_ENABLED', False):
+        results['speculative_queries'] = speculative_metrics.get_metrics()
+    if current_app.config.get('ORACLE_SERVICE_DOI_INDEX_ENABLED', False):
+        results['doi_index'] = doi_index_metrics.get_metrics()
+    if current_app.config.get('ORACLE_SERVICE_PRUNE_TITLE_CANDIDATES_ENABLED', False):
+        results['title_candidate_pruning'] = candidate_pruning_metrics.get_metrics()
+    return return_response(results, 200)
@@ -0,0 +1,213 @@
+import time
+import queue
+import atexit
+import threading
+
+from oraclesrv.utils import add_matches, add_a_record
+
+
+class WriteBehind(object):
+    """
+    saves the matches from docmatch_add in the background, matches are put in a bounded in-process queue,
+    and a background thread flushes them to db with one statement every batch_size matches or flush_interval,
+    whichever comes first, and once more on shutdown, a batch that fails is retried, and if it still fails
+    its matches are saved one at a time, so that a short db outage or one bad match does not lose the batch
+    """
+
+    def __init__(self, app):
+        """
+
+        :param app:
+        """
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['ORACLE_SERVICE_WRITE_BEHIND_QUEUE_SIZE'])
+        self.batch_size = app.config['ORACLE_SERVICE_WRITE_BEHIND_BATCH_SIZE']
+        self.flush_interval = app.config['ORACLE_SERVICE_WRITE_BEHIND_FLUSH_INTERVAL_MS'] / 1000.0
+        self.retries = app.config['ORACLE_SERVICE_WRITE_BEHIND_RETRIES']
+        self.retry_delay = app.config['ORACLE_SERVICE_WRITE_BEHIND_RETRY_DELAY_MS'] / 1000.0
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.metrics = {
+            'num_queued': 0,
+            'num_rejected': 0,
+            'num_flushes': 0,
+            'num_flush_errors': 0,
+            'num_flush_retries': 0,
+            'num_saved': 0,
+            'num_saved_one_at_a_time': 0,
+            'num_lost': 0,
+            'last_flush_ms': 0,
+            'max_flush_ms': 0,
+            'total_flush_ms': 0,
+        }
+
+    def start(self):
+        """
+        start the background thread
+
+        :return:
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name='write_behind', daemon=True)
+            self.thread.start()
+            atexit.register(self.stop)
+
+    def stop(self, timeout=None):
+        """
+        stop the background thread, after flushing what is in the queue
+
+        :param timeout:
+        :return:
+        """
+        if self.thread is not None:
+            self.stop_event.set()
+            self.thread.join(timeout)
+            self.thread = None
+
+    def put(self, match, source_bibcode_doctype=None):
+        """
+        queue a match to be saved
+
+        :param match: dict of source_bibcode, matched_bibcode, and confidence
+        :param source_bibcode_doctype:
+        :return: False if the queue is full, so that the caller can save it synchronously
+        """
+        try:
+            self.queue.put_nowait((match, source_bibcode_doctype))
+            with self.lock:
+                self.metrics['num_queued'] += 1
+            return True
+        except queue.Full:
+            with self.lock:
+                self.metrics['num_rejected'] += 1
+            self.app.logger.warning('write behind queue is full, unable to queue match %s' % match)
+            return False
+
+    def get_batch(self):
+        """
+        wait for up to batch_size matches, or until flush_interval has passed
+
+        :return:
+        """
+        batch = []
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def drain(self):
+        """
+        get everything that is in the queue without waiting
+
+        :return:
+        """
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                return batch
+
+    def run(self):
+        """
+        loop of the background thread
+
+        :return:
+        """
+        while not self.stop_event.is_set():
+            batch = self.get_batch()
+            if batch:
+                self.flush(batch)
+        # flush what is left before exiting
+        batch = self.drain()
+        for i in range(0, len(batch), self.batch_size):
+            self.flush(batch[i:i + self.batch_size])
+
+    def save(self, batch):
+        """
+
+        :param batch:
+        :return: success boolean, number of records inserted or updated, plus a status text
+        """
+        try:
+            with self.app.app_context():
+                return add_matches(batch)
+        except Exception as e:
+            return False, -1, str(e)
+
+    def save_one_at_a_time(self, batch):
+        """
+        last resort for a batch that could not be saved in one statement
+
+        :param batch:
+        :return: number of matches saved
+        """
+        num_saved = 0
+        for match, source_bibcode_doctype in batch:
+            try:
+                with self.app.app_context():
+                    status, text = add_a_record(match, source_bibcode_doctype)
+            except Exception as e:
+                status, text = False, str(e)
+            if status:
+                num_saved += 1
+            else:
+                self.app.logger.error("Unable to save match {match}: {text}".format(match=match, text=text))
+        return num_saved
+
+    def flush(self, batch):
+        """
+        save a batch of matches to db, retrying up to retries times, waiting retry_delay doubled with each retry,
+        and if it still fails, saving its matches one at a time
+
+        :param batch:
+        :return:
+        """
+        start_time = time.time()
+        status, count, text = self.save(batch)
+        for attempt in range(1, self.retries + 1):
+            if status:
+                break
+            self.app.logger.warning("Unable to flush {num_matches} matches, retry {attempt}: {text}".format(num_matches=len(batch), attempt=attempt, text=text))
+            with self.lock:
+                self.metrics['num_flush_retries'] += 1
+            time.sleep(self.retry_delay * (2 ** (attempt - 1)))
+            status, count, text = self.save(batch)
+        num_saved_one_at_a_time = 0 if status else self.save_one_at_a_time(batch)
+
+        duration = (time.time() - start_time) * 1000
+        with self.lock:
+            self.metrics['num_flushes'] += 1
+            self.metrics['last_flush_ms'] = duration
+            self.metrics['max_flush_ms'] = max(self.metrics['max_flush_ms'], duration)
+            self.metrics['total_flush_ms'] += duration
+            if status:
+                self.metrics['num_saved'] += count
+            else:
+                self.metrics['num_flush_errors'] += 1
+                self.metrics['num_saved_one_at_a_time'] += num_saved_one_at_a_time
+                self.metrics['num_lost'] += len(batch) - num_saved_one_at_a_time
+        if status:
+            self.app.logger.debug("Flushed {num_matches} matches in {duration} ms, {text}".format(num_matches=len(batch), duration=duration, text=text))
+        else:
+            self.app.logger.error("Unable to flush {num_matches} matches: {text}, saved {num_saved} of them one at a time".format(
+                num_matches=len(batch), text=text, num_saved=num_saved_one_at_a_time))
+        return status
+
+    def get_metrics(self):
+        """
+
+        :return:
+        """
+        with self.lock:
+            metrics = dict(self.metrics)
+        metrics['queue_depth'] = self.queue.qsize()
+        metrics['avg_flush_ms'] = metrics['total_flush_ms'] / metrics['num_flushes'] if metrics['num_flushes'] else 0
+        return metrics